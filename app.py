@@ -1,278 +1,1900 @@
 import os
+import sys
 import gradio as gr
-from google import genai
-from google.genai import types
 import random
 import secrets
 import re
+import unicodedata
 import sqlite3
 import json
-import requests
+import threading
+import time
+import queue
+import atexit
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-import pickle
-from typing import Dict, List, Optional
+from enum import IntEnum
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+# google.genai pesa en el arranque: solo se importa al usarse (ver crear_cliente_genai)
+if TYPE_CHECKING:
+    from google.genai import types
 
 # ==================== CONFIGURACIÓN ====================
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=GEMINI_API_KEY)
+HOST = os.getenv("HAKARI_HOST", "0.0.0.0")
+PUERTO = int(os.getenv("PORT", "7860"))
+
+# Procesos servidores: con más de uno, cada proceso escucha en PUERTO+1..PUERTO+N y el
+# proceso principal atiende PUERTO como proxy con afinidad por cliente (la cola de Gradio
+# vive en memoria de cada proceso). HAKARI_PROXY=0 lo desactiva para usar un balanceador
+# externo, que entonces debe mantener a cada cliente en el mismo proceso
+TRABAJADORES = int(os.getenv("HAKARI_TRABAJADORES", "1"))
+PROXY_INTEGRADO = os.getenv("HAKARI_PROXY", "1") == "1"
+
+# Cola de Gradio: eventos atendidos a la vez por grupo y tamaño máximo de la cola (0 = sin límite)
+ACCESO_CONCURRENCIA = int(os.getenv("HAKARI_ACCESO_CONCURRENCIA", "8"))
+HISTORIAL_CONCURRENCIA = int(os.getenv("HAKARI_HISTORIAL_CONCURRENCIA", "8"))
+COLA_MAX = int(os.getenv("HAKARI_COLA_MAX", "0"))
+
+# Pool de chats por usuario
+CHAT_MODELO = os.getenv("HAKARI_CHAT_MODELO", "gemini-2.0-flash")
+CHAT_POOL_MAX = int(os.getenv("HAKARI_CHAT_POOL_MAX", "200"))
+CHAT_POOL_TTL = int(os.getenv("HAKARI_CHAT_POOL_TTL", "1800"))
+CHAT_TURNOS_SEMILLA = int(os.getenv("HAKARI_CHAT_TURNOS_SEMILLA", "10"))
+CHAT_CONCURRENCIA = int(os.getenv("HAKARI_CHAT_CONCURRENCIA", "64"))
+
+# Historial visible en el chat: turnos por página y máximo retenido en el estado de Gradio
+HISTORIAL_PAGINA = int(os.getenv("HAKARI_HISTORIAL_PAGINA", "20"))
+HISTORIAL_MAX = int(os.getenv("HAKARI_HISTORIAL_MAX", "60"))
+
+# Presupuesto de tokens por llamada (instrucción de sistema + resumen + historial + mensaje)
+PROMPT_TOKENS = int(os.getenv("HAKARI_PROMPT_TOKENS", "1500"))
+RESUMEN_TOKENS = int(os.getenv("HAKARI_RESUMEN_TOKENS", "200"))
+
+# Caché opcional de respuestas a saludos y frases hechas ("hola", "¿qué tal?"), compartida
+# entre usuarios. HAKARI_CACHE_RESPUESTAS_FRASES: las frases, normalizadas y separadas por comas
+CACHE_RESPUESTAS = os.getenv("HAKARI_CACHE_RESPUESTAS", "0") == "1"
+CACHE_RESPUESTAS_MAX = int(os.getenv("HAKARI_CACHE_RESPUESTAS_MAX", "500"))
+CACHE_RESPUESTAS_TTL = int(os.getenv("HAKARI_CACHE_RESPUESTAS_TTL", "3600"))
+CACHE_RESPUESTAS_LONGITUD = int(os.getenv("HAKARI_CACHE_RESPUESTAS_LONGITUD", "40"))
+CACHE_RESPUESTAS_VARIANTES = int(os.getenv("HAKARI_CACHE_RESPUESTAS_VARIANTES", "3"))
+CACHE_RESPUESTAS_FRASES = os.getenv("HAKARI_CACHE_RESPUESTAS_FRASES", ",".join([
+    "hola", "holi", "hey", "buenas", "buenos dias", "buenas tardes", "buenas noches",
+    "que tal", "hola que tal", "que tal estas", "hola que tal estas", "como estas", "hola como estas",
+    "que haces", "hola que haces",
+    "gracias", "muchas gracias", "adios", "chao", "hasta luego", "hasta manana", "buenas noches hakari",
+    "hola hakari", "ok", "vale", "jaja", "jajaja"]))
+
+# Llamadas a Gemini: plazo por llamada, reintentos, concurrencia y cortocircuito
+GEMINI_TIMEOUT = float(os.getenv("HAKARI_GEMINI_TIMEOUT", "20"))
+GEMINI_REINTENTOS = int(os.getenv("HAKARI_GEMINI_REINTENTOS", "2"))
+GEMINI_ESPERA_BASE = float(os.getenv("HAKARI_GEMINI_ESPERA_BASE", "0.5"))
+GEMINI_ESPERA_MAX = float(os.getenv("HAKARI_GEMINI_ESPERA_MAX", "8"))
+GEMINI_CONCURRENCIA = int(os.getenv("HAKARI_GEMINI_CONCURRENCIA", "32"))
+GEMINI_UMBRAL_FALLOS = int(os.getenv("HAKARI_GEMINI_UMBRAL_FALLOS", "5"))
+GEMINI_ENFRIAMIENTO = float(os.getenv("HAKARI_GEMINI_ENFRIAMIENTO", "30"))
+
+# Límites de uso: mensajes por usuario y llamadas al modelo por proceso (ritmo 0 = sin límite)
+LIMITE_USUARIO_RITMO = float(os.getenv("HAKARI_LIMITE_USUARIO_RITMO", "0.5"))
+LIMITE_USUARIO_RAFAGA = int(os.getenv("HAKARI_LIMITE_USUARIO_RAFAGA", "5"))
+LIMITE_GLOBAL_RITMO = float(os.getenv("HAKARI_LIMITE_GLOBAL_RITMO", "10"))
+LIMITE_GLOBAL_RAFAGA = int(os.getenv("HAKARI_LIMITE_GLOBAL_RAFAGA", "20"))
+LIMITE_ESPERA_MAX = float(os.getenv("HAKARI_LIMITE_ESPERA_MAX", "15"))
+LIMITE_PENDIENTES_USUARIO = int(os.getenv("HAKARI_LIMITE_PENDIENTES_USUARIO", "1"))
+
+# Escritura diferida en SQLite
+DB_LOTE = int(os.getenv("HAKARI_DB_LOTE", "100"))
+DB_INTERVALO = float(os.getenv("HAKARI_DB_INTERVALO", "1.0"))
+DB_REINTENTOS = int(os.getenv("HAKARI_DB_REINTENTOS", "8"))
+DB_ESPERA_BASE = float(os.getenv("HAKARI_DB_ESPERA_BASE", "0.25"))
+DB_ESPERA_MAX = float(os.getenv("HAKARI_DB_ESPERA_MAX", "8"))
+
+# Conexiones SQLite
+DB_RUTA = os.getenv("HAKARI_DB_RUTA", "hakari_memory.db")
+DB_SYNCHRONOUS = os.getenv("HAKARI_DB_SYNCHRONOUS", "NORMAL").upper()
+DB_BUSY_TIMEOUT = int(os.getenv("HAKARI_DB_BUSY_TIMEOUT", "5000"))
+DB_MMAP = int(os.getenv("HAKARI_DB_MMAP", str(64 * 1024 * 1024)))
+
+# Caché de perfiles y logros en memoria
+CACHE_PERFILES_MAX = int(os.getenv("HAKARI_CACHE_PERFILES_MAX", "1000"))
+CACHE_PERFILES_TTL = int(os.getenv("HAKARI_CACHE_PERFILES_TTL", "300"))
+
+# Sesiones
+SESIONES_ALMACEN = os.getenv("HAKARI_SESIONES", "sqlite" if TRABAJADORES > 1 else "memoria")
+SESION_TTL = int(os.getenv("HAKARI_SESION_TTL", str(7 * 24 * 3600)))
+SESION_BARRIDO = int(os.getenv("HAKARI_SESION_BARRIDO", "300"))
+SESION_REVALIDAR = int(os.getenv("HAKARI_SESION_REVALIDAR", "30"))
+
+# Métricas Prometheus en /metricas y registros estructurados
+METRICAS = os.getenv("HAKARI_METRICAS", "0") == "1"
+LOG_NIVEL = os.getenv("HAKARI_LOG_NIVEL", "INFO").upper()
+LOG_FORMATO = os.getenv("HAKARI_LOG_FORMATO", "json")
+
+# ==================== REGISTRO Y MÉTRICAS ====================
+# Un evento por línea con campos (JSON, o "clave=valor" con HAKARI_LOG_FORMATO=texto)
+class FormatoRegistro(logging.Formatter):
+    def __init__(self, json_: bool = True):
+        super().__init__()
+        self.json = json_
+    
+    def format(self, registro: logging.LogRecord) -> str:
+        campos = {'ts': self.formatTime(registro, "%Y-%m-%dT%H:%M:%S"), 'nivel': registro.levelname,
+                  'evento': registro.getMessage(), **getattr(registro, 'campos', {})}
+        if registro.exc_info:
+            campos['traza'] = self.formatException(registro.exc_info)
+        if self.json:
+            return json.dumps(campos, ensure_ascii=False, default=str)
+        return " ".join(f"{clave}={valor}" for clave, valor in campos.items())
+
+log = logging.getLogger("hakari")
+if not log.handlers:
+    _salida_log = logging.StreamHandler(sys.stdout)
+    _salida_log.setFormatter(FormatoRegistro(json_=LOG_FORMATO != "texto"))
+    log.addHandler(_salida_log)
+    log.setLevel(LOG_NIVEL)
+    log.propagate = False
+
+def registrar(nivel: int, evento: str, **campos):
+    if log.isEnabledFor(nivel):
+        log.log(nivel, evento, extra={'campos': campos})
+
+def registrar_error(evento: str, error: Exception, **campos):
+    registrar(logging.ERROR, evento, error=str(error), tipo=type(error).__name__, **campos)
+
+# Contadores e histogramas en memoria con salida en formato de texto de Prometheus.
+# Desactivadas, contar/observar vuelven sin hacer nada y medir() da un contexto vacío
+class Metricas:
+    CUBETAS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    NULO = nullcontext()
+    
+    def __init__(self, activas: bool = METRICAS):
+        self.activas = activas
+        self.lock = threading.Lock()
+        self.contadores = {}   # (nombre, etiquetas) -> valor
+        self.histogramas = {}  # (nombre, etiquetas) -> [por cubeta..., +Inf, suma]
+        self.colectores = []   # funciones -> [(nombre, tipo, etiquetas, valor), ...], al exponer
+        self.ayudas = {}
+    
+    def contar(self, nombre: str, valor: float = 1, **etiquetas):
+        if not self.activas:
+            return
+        clave = (nombre, tuple(etiquetas.items()))
+        with self.lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+    
+    def observar(self, nombre: str, segundos: float, **etiquetas):
+        if not self.activas:
+            return
+        clave = (nombre, tuple(etiquetas.items()))
+        cubeta = bisect_left(self.CUBETAS, segundos)
+        with self.lock:
+            histograma = self.histogramas.get(clave)
+            if histograma is None:
+                histograma = self.histogramas[clave] = [0] * (len(self.CUBETAS) + 1) + [0.0]
+            histograma[cubeta] += 1
+            histograma[-1] += segundos
+    
+    def medir(self, nombre: str, **etiquetas):
+        return Cronometro(self, nombre, etiquetas) if self.activas else self.NULO
+    
+    def etapa(self, nombre: str):
+        # Etapas de un turno de chat, todas en el mismo histograma
+        return self.medir('hakari_etapa_segundos', etapa=nombre) if self.activas else self.NULO
+    
+    def colector(self, funcion):
+        self.colectores.append(funcion)
+        return funcion
+    
+    def ayuda(self, nombre: str, texto: str):
+        self.ayudas[nombre] = texto
+    
+    @staticmethod
+    def _etiquetas(etiquetas) -> str:
+        if not etiquetas:
+            return ""
+        valores = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in etiquetas)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(etiquetas, valores)) + "}"
+    
+    def exponer(self) -> str:
+        series = {}  # nombre -> (tipo, [líneas])
+        
+        def agregar(nombre, tipo, linea):
+            series.setdefault(nombre, (tipo, []))[1].append(linea)
+        
+        with self.lock:
+            contadores = list(self.contadores.items())
+            histogramas = [(clave, valores[:]) for clave, valores in self.histogramas.items()]
+        for (nombre, etiquetas), valor in contadores:
+            agregar(nombre, 'counter', f"{nombre}{self._etiquetas(etiquetas)} {valor}")
+        for (nombre, etiquetas), valores in histogramas:
+            acumulado = 0
+            for limite, cuenta in zip(self.CUBETAS + ('+Inf',), valores):
+                acumulado += cuenta
+                agregar(nombre, 'histogram',
+                        f"{nombre}_bucket{self._etiquetas(etiquetas + (('le', limite),))} {acumulado}")
+            agregar(nombre, 'histogram', f"{nombre}_sum{self._etiquetas(etiquetas)} {valores[-1]}")
+            agregar(nombre, 'histogram', f"{nombre}_count{self._etiquetas(etiquetas)} {acumulado}")
+        for funcion in self.colectores:
+            try:
+                for nombre, tipo, etiquetas, valor in funcion():
+                    agregar(nombre, tipo, f"{nombre}{self._etiquetas(tuple(etiquetas.items()))} {valor}")
+            except Exception as e:
+                registrar_error("error_colector_metricas", e, colector=funcion.__name__)
+        
+        lineas = []
+        for nombre, (tipo, muestras) in series.items():
+            if nombre in self.ayudas:
+                lineas.append(f"# HELP {nombre} {self.ayudas[nombre]}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            lineas.extend(muestras)
+        return "\n".join(lineas) + "\n"
+
+class Cronometro:
+    __slots__ = ('metricas', 'nombre', 'etiquetas', 'inicio')
+    
+    def __init__(self, metricas: Metricas, nombre: str, etiquetas: Dict):
+        self.metricas = metricas
+        self.nombre = nombre
+        self.etiquetas = etiquetas
+    
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+    
+    def __exit__(self, *_):
+        self.metricas.observar(self.nombre, time.perf_counter() - self.inicio, **self.etiquetas)
+
+metricas = Metricas()
+metricas.ayuda('hakari_etapa_segundos', "Duración de cada etapa de un turno de chat")
+metricas.ayuda('hakari_turno_segundos', "Duración total de un turno de chat, del mensaje al último fragmento")
+metricas.ayuda('hakari_turnos_total', "Turnos de chat atendidos por resultado")
+metricas.ayuda('hakari_db_lote_segundos', "Duración de cada transacción de la cola de escritura")
+metricas.ayuda('hakari_db_commits_total', "Transacciones confirmadas por la cola de escritura")
+metricas.ayuda('hakari_db_operaciones_total', "Escrituras confirmadas por tipo")
+metricas.ayuda('hakari_db_errores_total', "Lotes de escritura que fallaron")
+metricas.ayuda('hakari_db_reintentos_total', "Reintentos de lotes que encontraron la base de datos bloqueada")
+metricas.ayuda('hakari_db_descartadas_total', "Escrituras perdidas tras fallar, por tipo")
+metricas.ayuda('hakari_modelo_errores_total', "Turnos en que la llamada al modelo falló, por tipo de error")
+
+# ==================== ARRANQUE PEREZOSO ====================
+# Importar el módulo no abre la base de datos ni crea el cliente de Gemini: cada componente
+# se construye en el primer acceso a uno de sus atributos o al precalentar en segundo plano
+class Perezoso:
+    def __init__(self, fabrica):
+        self._fabrica = fabrica
+        self._objeto = None
+        self._lock = threading.Lock()
+    
+    @property
+    def cargado(self) -> bool:
+        return self._objeto is not None
+    
+    def cargar(self):
+        objeto = self._objeto
+        if objeto is None:
+            with self._lock:
+                if self._objeto is None:
+                    self._objeto = self._fabrica()
+                objeto = self._objeto
+        return objeto
+    
+    def __getattr__(self, nombre):
+        return getattr(self.cargar(), nombre)
+
+# ==================== CLIENTE GEMINI ====================
+class CircuitoAbierto(Exception):
+    """Gemini ha fallado repetidamente y las llamadas se rechazan sin intentarlo."""
+
+# Cortocircuito por fallos consecutivos: tras `umbral` fallos se abre y rechaza llamadas
+# durante `enfriamiento` segundos; después deja pasar una sola llamada de prueba
+class Cortocircuito:
+    CERRADO, ABIERTO, SEMIABIERTO = "cerrado", "abierto", "semiabierto"
+    
+    def __init__(self, umbral: int, enfriamiento: float):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self.estado = self.CERRADO
+        self.fallos = 0
+        self.reabre = 0.0
+        self.aperturas = 0
+    
+    def permitir(self) -> bool:
+        if self.estado == self.CERRADO:
+            return True
+        if time.monotonic() < self.reabre:
+            return False  # abierto, o semiabierto con la prueba aún en curso
+        # Si la prueba anterior nunca terminó (p. ej. cancelada), se permite otra
+        self.estado = self.SEMIABIERTO
+        self.reabre = time.monotonic() + self.enfriamiento
+        return True
+    
+    def exito(self):
+        self.estado = self.CERRADO
+        self.fallos = 0
+    
+    def fallo(self):
+        self.fallos += 1
+        if self.estado == self.SEMIABIERTO or self.fallos >= self.umbral:
+            if self.estado != self.ABIERTO:
+                self.aperturas += 1
+            self.estado = self.ABIERTO
+            self.reabre = time.monotonic() + self.enfriamiento
+
+# Envoltorio de genai.Client: plazo máximo por llamada, reintentos con espera exponencial
+# y jitter ante errores transitorios, un semáforo que limita las llamadas en vuelo y un
+# cortocircuito. Solo usa client.aio.models, así que acepta un cliente falso en pruebas
+class ClienteGemini:
+    CODIGOS_REINTENTABLES = {408, 429, 500, 502, 503, 504}
+    
+    def __init__(self, cliente, timeout: float = GEMINI_TIMEOUT, reintentos: int = GEMINI_REINTENTOS,
+                 espera_base: float = GEMINI_ESPERA_BASE, espera_max: float = GEMINI_ESPERA_MAX,
+                 concurrencia: int = GEMINI_CONCURRENCIA, umbral_fallos: int = GEMINI_UMBRAL_FALLOS,
+                 enfriamiento: float = GEMINI_ENFRIAMIENTO):
+        self.cliente = cliente
+        self.timeout = timeout
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+        self.semaforo = asyncio.Semaphore(concurrencia)
+        self.circuito = Cortocircuito(umbral_fallos, enfriamiento)
+        self.llamadas = 0
+        self.reintentos_hechos = 0
+        self.errores = 0
+        self.rechazadas = 0
+    
+    def es_reintentable(self, error: Exception) -> bool:
+        from google.genai import errors as genai_errors
+        
+        if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+            return True
+        if isinstance(error, genai_errors.APIError):
+            return error.code in self.CODIGOS_REINTENTABLES
+        # Errores de red de httpx (conexión, lectura) sin importar httpx aquí
+        return type(error).__module__.startswith("httpx")
+    
+    def espera(self, intento: int) -> float:
+        # "Full jitter": aleatoria entre 0 y el tope exponencial del intento
+        return random.uniform(0, min(self.espera_max, self.espera_base * 2 ** intento))
+    
+    def _comprobar_circuito(self):
+        if not self.circuito.permitir():
+            self.rechazadas += 1
+            raise CircuitoAbierto("Gemini no disponible temporalmente")
+    
+    def _registrar_fallo(self, error: Exception):
+        self.errores += 1
+        # Un 400 es culpa de la petición, no indica que Gemini esté caído
+        if self.es_reintentable(error):
+            self.circuito.fallo()
+        elif self.circuito.estado == Cortocircuito.SEMIABIERTO:
+            self.circuito.exito()
+    
+    @staticmethod
+    def _restante(limite: float) -> float:
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            raise asyncio.TimeoutError()
+        return restante
+    
+    async def generar(self, **kwargs):
+        # generate_content con el mismo plazo total para todos los intentos
+        self._comprobar_circuito()
+        limite = time.monotonic() + self.timeout
+        intento = 0
+        while True:
+            try:
+                self.llamadas += 1
+                await asyncio.wait_for(self.semaforo.acquire(), self._restante(limite))
+                try:
+                    respuesta = await asyncio.wait_for(
+                        self.cliente.aio.models.generate_content(**kwargs), self._restante(limite))
+                finally:
+                    self.semaforo.release()
+                self.circuito.exito()
+                return respuesta
+            except Exception as e:
+                if not await self._reintentar(e, intento, limite):
+                    raise
+                intento += 1
+    
+    async def generar_flujo(self, **kwargs):
+        # Fragmentos de texto de generate_content_stream. Solo se reintenta si el error llega
+        # antes del primer fragmento: después ya se ha mostrado texto al usuario
+        self._comprobar_circuito()
+        limite = time.monotonic() + self.timeout
+        intento = 0
+        while True:
+            emitido = False
+            try:
+                self.llamadas += 1
+                await asyncio.wait_for(self.semaforo.acquire(), self._restante(limite))
+                try:
+                    flujo = await asyncio.wait_for(
+                        self.cliente.aio.models.generate_content_stream(**kwargs), self._restante(limite))
+                    iterador = flujo.__aiter__()
+                    while True:
+                        try:
+                            fragmento = await asyncio.wait_for(iterador.__anext__(), self._restante(limite))
+                        except StopAsyncIteration:
+                            break
+                        if fragmento.text:
+                            emitido = True
+                            yield fragmento.text
+                finally:
+                    self.semaforo.release()
+                self.circuito.exito()
+                return
+            except Exception as e:
+                if emitido or not await self._reintentar(e, intento, limite):
+                    if emitido:
+                        self._registrar_fallo(e)
+                    raise
+                intento += 1
+    
+    async def _reintentar(self, error: Exception, intento: int, limite: float) -> bool:
+        # Espera antes del siguiente intento si queda margen; si no, registra el fallo
+        if self.es_reintentable(error) and intento < self.reintentos:
+            espera = self.espera(intento)
+            if time.monotonic() + espera < limite:
+                self.reintentos_hechos += 1
+                await asyncio.sleep(espera)
+                return True
+        self._registrar_fallo(error)
+        return False
+    
+    def estadisticas(self) -> Dict:
+        return {
+            'llamadas': self.llamadas,
+            'reintentos': self.reintentos_hechos,
+            'errores': self.errores,
+            'rechazadas': self.rechazadas,
+            'circuito': self.circuito.estado,
+            'aperturas': self.circuito.aperturas
+        }
+
+def crear_cliente_genai():
+    # google.genai tarda cerca de un segundo en importarse: solo se paga al usarlo
+    from google import genai
+    
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+gemini = Perezoso(lambda: ClienteGemini(crear_cliente_genai()))
 
 # ==================== BASE DE DATOS SIMPLIFICADA ====================
+# Caché acotada por número de entradas (LRU) y antigüedad (TTL). Los valores se tratan
+# como inmutables: modificar() los reemplaza en lugar de mutarlos
+class CacheLRU:
+    def __init__(self, max_entradas: int, ttl: float):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.datos = OrderedDict()  # clave -> (valor, expira)
+        self.cargando = {}          # clave -> [cargas en curso, invalidada]
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+    
+    def obtener(self, clave):
+        with self.lock:
+            entrada = self.datos.get(clave)
+            if entrada and entrada[1] > time.monotonic():
+                self.datos.move_to_end(clave)
+                self.aciertos += 1
+                return entrada[0]
+            self.fallos += 1
+            return None
+    
+    def guardar(self, clave, valor):
+        with self.lock:
+            self._guardar(clave, valor)
+    
+    def _guardar(self, clave, valor):
+        self.datos[clave] = (valor, time.monotonic() + self.ttl)
+        self.datos.move_to_end(clave)
+        while len(self.datos) > self.max_entradas:
+            self.datos.popitem(last=False)
+    
+    def iniciar_carga(self, clave):
+        # Marca el instante de la lectura: si la clave cambia antes de
+        # terminar_carga(), el valor leído ya no se guarda
+        with self.lock:
+            carga = self.cargando.setdefault(clave, [0, False])
+            carga[0] += 1
+    
+    def terminar_carga(self, clave, valor):
+        with self.lock:
+            carga = self.cargando.get(clave)
+            if carga is None:
+                return
+            carga[0] -= 1
+            if carga[0] == 0:
+                del self.cargando[clave]
+            if valor is not None and not carga[1]:
+                self._guardar(clave, valor)
+    
+    def modificar(self, clave, funcion):
+        with self.lock:
+            entrada = self.datos.get(clave)
+            if entrada:
+                self.datos[clave] = (funcion(entrada[0]), entrada[1])
+            if clave in self.cargando:
+                self.cargando[clave][1] = True
+    
+    def invalidar(self, clave):
+        with self.lock:
+            self.datos.pop(clave, None)
+            if clave in self.cargando:
+                self.cargando[clave][1] = True
+    
+    def estadisticas(self) -> Dict:
+        with self.lock:
+            total = self.aciertos + self.fallos
+            return {
+                'entradas': len(self.datos),
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / total, 3) if total else 0.0
+            }
+
+# Una conexión de escritura compartida y una de solo lectura por hilo, todas en modo WAL
+class PoolConexiones:
+    def __init__(self, ruta: str = DB_RUTA, synchronous: str = DB_SYNCHRONOUS,
+                 busy_timeout: int = DB_BUSY_TIMEOUT, mmap: int = DB_MMAP):
+        if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f"Nivel synchronous no válido: {synchronous}")
+        
+        self.ruta = ruta
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.mmap = mmap
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.conexiones = []
+        self.conn_escritura = self._abrir(solo_lectura=False)
+    
+    def _abrir(self, solo_lectura: bool) -> sqlite3.Connection:
+        # Los lectores van en autocommit y abren sus transacciones explícitamente
+        conn = sqlite3.connect(self.ruta, check_same_thread=False, timeout=self.busy_timeout / 1000,
+                               isolation_level=None if solo_lectura else "")
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap)}')
+        if solo_lectura:
+            conn.execute('PRAGMA query_only=ON')
+        
+        with self.lock:
+            self.conexiones.append(conn)
+        return conn
+    
+    def escritura(self) -> sqlite3.Connection:
+        # Usar siempre con DatabaseManager.lock_escritura adquirido
+        return self.conn_escritura
+    
+    def lectura(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._abrir(solo_lectura=True)
+        return conn
+    
+    def cerrar(self):
+        with self.lock:
+            for conn in self.conexiones:
+                conn.close()
+            self.conexiones.clear()
+
+# ==================== MIGRACIONES ====================
+# (versión, descripción, sentencias). Se aplican en orden, una transacción por versión,
+# y nunca se editan una vez publicadas: los cambios van en una versión nueva
+MIGRACIONES = [
+    (1, "Tablas base", [
+        '''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE,
+            nombre TEXT,
+            fecha_registro DATETIME,
+            nivel_confianza INTEGER DEFAULT 30,
+            interacciones_totales INTEGER DEFAULT 0,
+            ultima_visita DATETIME
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_email TEXT,
+            mensaje_usuario TEXT,
+            mensaje_hakari TEXT,
+            estado_emocional TEXT,
+            fecha DATETIME
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS logros (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_email TEXT,
+            logro_id TEXT,
+            nombre TEXT,
+            descripcion TEXT,
+            fecha_desbloqueo DATETIME
+        )
+        ''',
+    ]),
+    (2, "Índices por usuario y logros únicos", [
+        # Bases antiguas pueden tener logros duplicados: conservar el primero
+        '''
+        DELETE FROM logros WHERE id NOT IN (
+            SELECT MIN(id) FROM logros GROUP BY usuario_email, logro_id
+        )
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_logros_usuario_logro ON logros (usuario_email, logro_id)',
+        'CREATE INDEX IF NOT EXISTS idx_conversaciones_usuario_fecha ON conversaciones (usuario_email, fecha)',
+    ]),
+    (3, "Referenciar usuarios.id en lugar del email", [
+        # Las filas sin usuario registrado no eran accesibles y se descartan
+        '''
+        CREATE TABLE conversaciones_nueva (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL REFERENCES usuarios (id),
+            mensaje_usuario TEXT,
+            mensaje_hakari TEXT,
+            estado_emocional TEXT,
+            fecha DATETIME
+        )
+        ''',
+        '''
+        INSERT INTO conversaciones_nueva (id, usuario_id, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+        SELECT c.id, u.id, c.mensaje_usuario, c.mensaje_hakari, c.estado_emocional, c.fecha
+        FROM conversaciones c JOIN usuarios u ON u.email = c.usuario_email
+        ''',
+        'DROP TABLE conversaciones',
+        'ALTER TABLE conversaciones_nueva RENAME TO conversaciones',
+        'CREATE INDEX idx_conversaciones_usuario_fecha ON conversaciones (usuario_id, fecha)',
+        '''
+        CREATE TABLE logros_nueva (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_id INTEGER NOT NULL REFERENCES usuarios (id),
+            logro_id TEXT,
+            nombre TEXT,
+            descripcion TEXT,
+            fecha_desbloqueo DATETIME,
+            UNIQUE (usuario_id, logro_id)
+        )
+        ''',
+        '''
+        INSERT INTO logros_nueva (id, usuario_id, logro_id, nombre, descripcion, fecha_desbloqueo)
+        SELECT l.id, u.id, l.logro_id, l.nombre, l.descripcion, l.fecha_desbloqueo
+        FROM logros l JOIN usuarios u ON u.email = l.usuario_email
+        ''',
+        'DROP TABLE logros',
+        'ALTER TABLE logros_nueva RENAME TO logros',
+    ]),
+    (4, "Sesiones persistentes", [
+        '''
+        CREATE TABLE IF NOT EXISTS sesiones (
+            id TEXT PRIMARY KEY,
+            datos TEXT NOT NULL,
+            expira REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sesiones_expira ON sesiones (expira)',
+    ]),
+    (5, "Estado emocional de Hakari por usuario", [
+        'ALTER TABLE usuarios ADD COLUMN estado_hakari INTEGER NOT NULL DEFAULT 0',
+    ]),
+    (6, "Resumen acumulado del historial por usuario", [
+        '''
+        CREATE TABLE IF NOT EXISTS resumenes (
+            usuario_id INTEGER PRIMARY KEY REFERENCES usuarios (id),
+            resumen TEXT NOT NULL,
+            fecha_actualizacion DATETIME
+        )
+        ''',
+    ]),
+    (7, "Paginación del historial por id", [
+        # Recorre el historial de un usuario en orden de id sin ordenar en memoria
+        'CREATE INDEX IF NOT EXISTS idx_conversaciones_usuario_id ON conversaciones (usuario_id, id)',
+    ]),
+    (8, "Búsqueda de texto completo en las conversaciones", [
+        # Índice FTS5 sobre la propia tabla (sin duplicar el texto), sin distinguir tildes.
+        # usuario_id se indexa como término para filtrar por usuario dentro del índice
+        '''
+        CREATE VIRTUAL TABLE conversaciones_fts USING fts5(
+            usuario_id, mensaje_usuario, mensaje_hakari,
+            content='conversaciones', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER conversaciones_fts_insertar AFTER INSERT ON conversaciones BEGIN
+            INSERT INTO conversaciones_fts (rowid, usuario_id, mensaje_usuario, mensaje_hakari)
+            VALUES (new.id, new.usuario_id, new.mensaje_usuario, new.mensaje_hakari);
+        END
+        ''',
+        '''
+        CREATE TRIGGER conversaciones_fts_borrar AFTER DELETE ON conversaciones BEGIN
+            INSERT INTO conversaciones_fts (conversaciones_fts, rowid, usuario_id, mensaje_usuario, mensaje_hakari)
+            VALUES ('delete', old.id, old.usuario_id, old.mensaje_usuario, old.mensaje_hakari);
+        END
+        ''',
+        '''
+        CREATE TRIGGER conversaciones_fts_actualizar AFTER UPDATE ON conversaciones BEGIN
+            INSERT INTO conversaciones_fts (conversaciones_fts, rowid, usuario_id, mensaje_usuario, mensaje_hakari)
+            VALUES ('delete', old.id, old.usuario_id, old.mensaje_usuario, old.mensaje_hakari);
+            INSERT INTO conversaciones_fts (rowid, usuario_id, mensaje_usuario, mensaje_hakari)
+            VALUES (new.id, new.usuario_id, new.mensaje_usuario, new.mensaje_hakari);
+        END
+        ''',
+        "INSERT INTO conversaciones_fts (conversaciones_fts) VALUES ('rebuild')",
+    ]),
+    (9, "Actividad agregada por usuario y día", [
+        # Se mantienen con cada turno guardado (trigger) y sobreviven al archivado de
+        # conversaciones. Los ánimos van en columnas para sumarlos sin leer conversaciones
+        '''
+        CREATE TABLE actividad_diaria (
+            usuario_id INTEGER NOT NULL REFERENCES usuarios (id),
+            dia TEXT NOT NULL,
+            mensajes INTEGER NOT NULL DEFAULT 0,
+            timida INTEGER NOT NULL DEFAULT 0,
+            ironica INTEGER NOT NULL DEFAULT 0,
+            nostalgica INTEGER NOT NULL DEFAULT 0,
+            defensiva INTEGER NOT NULL DEFAULT 0,
+            curiosa INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (usuario_id, dia)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE actividad_usuarios (
+            usuario_id INTEGER PRIMARY KEY REFERENCES usuarios (id),
+            mensajes INTEGER NOT NULL DEFAULT 0,
+            timida INTEGER NOT NULL DEFAULT 0,
+            ironica INTEGER NOT NULL DEFAULT 0,
+            nostalgica INTEGER NOT NULL DEFAULT 0,
+            defensiva INTEGER NOT NULL DEFAULT 0,
+            curiosa INTEGER NOT NULL DEFAULT 0,
+            primer_dia TEXT,
+            ultimo_dia TEXT,
+            ultima_actividad DATETIME,
+            dias_activos INTEGER NOT NULL DEFAULT 0,
+            racha_actual INTEGER NOT NULL DEFAULT 0,
+            racha_maxima INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # Las conversaciones anteriores a esta versión las agrega `hakari_datos.py actividad` por tramos
+        '''
+        CREATE TABLE actividad_reconstruccion (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            hasta_id INTEGER NOT NULL,
+            procesado_id INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'INSERT INTO actividad_reconstruccion (id, hasta_id) SELECT 1, COALESCE(MAX(id), 0) FROM conversaciones',
+        # Las rachas suponen turnos en orden cronológico, como los que guarda la aplicación
+        '''
+        CREATE TRIGGER actividad_insertar AFTER INSERT ON conversaciones BEGIN
+            INSERT INTO actividad_diaria (usuario_id, dia, mensajes, timida, ironica, nostalgica, defensiva, curiosa)
+            VALUES (new.usuario_id, date(COALESCE(new.fecha, 'now')), 1,
+                    new.estado_emocional IS 'tímida', new.estado_emocional IS 'irónica',
+                    new.estado_emocional IS 'nostálgica', new.estado_emocional IS 'defensiva',
+                    new.estado_emocional IS 'curiosa')
+            ON CONFLICT (usuario_id, dia) DO UPDATE SET
+                mensajes = mensajes + 1,
+                timida = timida + excluded.timida,
+                ironica = ironica + excluded.ironica,
+                nostalgica = nostalgica + excluded.nostalgica,
+                defensiva = defensiva + excluded.defensiva,
+                curiosa = curiosa + excluded.curiosa;
+            
+            INSERT INTO actividad_usuarios (usuario_id, mensajes, timida, ironica, nostalgica, defensiva, curiosa,
+                                            primer_dia, ultimo_dia, ultima_actividad, dias_activos, racha_actual, racha_maxima)
+            VALUES (new.usuario_id, 1,
+                    new.estado_emocional IS 'tímida', new.estado_emocional IS 'irónica',
+                    new.estado_emocional IS 'nostálgica', new.estado_emocional IS 'defensiva',
+                    new.estado_emocional IS 'curiosa',
+                    date(COALESCE(new.fecha, 'now')), date(COALESCE(new.fecha, 'now')), new.fecha, 1, 1, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET
+                mensajes = mensajes + 1,
+                timida = timida + excluded.timida,
+                ironica = ironica + excluded.ironica,
+                nostalgica = nostalgica + excluded.nostalgica,
+                defensiva = defensiva + excluded.defensiva,
+                curiosa = curiosa + excluded.curiosa,
+                primer_dia = MIN(primer_dia, excluded.primer_dia),
+                ultimo_dia = MAX(ultimo_dia, excluded.ultimo_dia),
+                ultima_actividad = MAX(ultima_actividad, excluded.ultima_actividad),
+                dias_activos = dias_activos + (excluded.ultimo_dia > ultimo_dia),
+                racha_actual = CASE
+                    WHEN excluded.ultimo_dia = date(ultimo_dia, '+1 day') THEN racha_actual + 1
+                    WHEN excluded.ultimo_dia > ultimo_dia THEN 1
+                    ELSE racha_actual END,
+                racha_maxima = MAX(racha_maxima, CASE
+                    WHEN excluded.ultimo_dia = date(ultimo_dia, '+1 day') THEN racha_actual + 1
+                    ELSE 1 END);
+        END
+        ''',
+    ]),
+    (10, "Contar cada conversación una sola vez en la actividad", [
+        # Reimportar conversaciones archivadas conserva sus ids: las que ya se contaron
+        # (id no mayor que contado_id) no vuelven a sumarse. AUTOINCREMENT garantiza que
+        # los ids nuevos siempre superan a todos los usados antes
+        'ALTER TABLE actividad_reconstruccion ADD COLUMN contado_id INTEGER NOT NULL DEFAULT 0',
+        '''
+        UPDATE actividad_reconstruccion SET contado_id = MAX(hasta_id, COALESCE(
+            (SELECT seq FROM sqlite_sequence WHERE name = 'conversaciones'), 0))
+        ''',
+        'DROP TRIGGER actividad_insertar',
+        '''
+        CREATE TRIGGER actividad_insertar AFTER INSERT ON conversaciones
+        WHEN new.id > (SELECT contado_id FROM actividad_reconstruccion WHERE id = 1) BEGIN
+            UPDATE actividad_reconstruccion SET contado_id = new.id WHERE id = 1;
+            
+            INSERT INTO actividad_diaria (usuario_id, dia, mensajes, timida, ironica, nostalgica, defensiva, curiosa)
+            VALUES (new.usuario_id, date(COALESCE(new.fecha, 'now')), 1,
+                    new.estado_emocional IS 'tímida', new.estado_emocional IS 'irónica',
+                    new.estado_emocional IS 'nostálgica', new.estado_emocional IS 'defensiva',
+                    new.estado_emocional IS 'curiosa')
+            ON CONFLICT (usuario_id, dia) DO UPDATE SET
+                mensajes = mensajes + 1,
+                timida = timida + excluded.timida,
+                ironica = ironica + excluded.ironica,
+                nostalgica = nostalgica + excluded.nostalgica,
+                defensiva = defensiva + excluded.defensiva,
+                curiosa = curiosa + excluded.curiosa;
+            
+            INSERT INTO actividad_usuarios (usuario_id, mensajes, timida, ironica, nostalgica, defensiva, curiosa,
+                                            primer_dia, ultimo_dia, ultima_actividad, dias_activos, racha_actual, racha_maxima)
+            VALUES (new.usuario_id, 1,
+                    new.estado_emocional IS 'tímida', new.estado_emocional IS 'irónica',
+                    new.estado_emocional IS 'nostálgica', new.estado_emocional IS 'defensiva',
+                    new.estado_emocional IS 'curiosa',
+                    date(COALESCE(new.fecha, 'now')), date(COALESCE(new.fecha, 'now')), new.fecha, 1, 1, 1)
+            ON CONFLICT (usuario_id) DO UPDATE SET
+                mensajes = mensajes + 1,
+                timida = timida + excluded.timida,
+                ironica = ironica + excluded.ironica,
+                nostalgica = nostalgica + excluded.nostalgica,
+                defensiva = defensiva + excluded.defensiva,
+                curiosa = curiosa + excluded.curiosa,
+                primer_dia = MIN(primer_dia, excluded.primer_dia),
+                ultimo_dia = MAX(ultimo_dia, excluded.ultimo_dia),
+                ultima_actividad = MAX(ultima_actividad, excluded.ultima_actividad),
+                dias_activos = dias_activos + (excluded.ultimo_dia > ultimo_dia),
+                racha_actual = CASE
+                    WHEN excluded.ultimo_dia = date(ultimo_dia, '+1 day') THEN racha_actual + 1
+                    WHEN excluded.ultimo_dia > ultimo_dia THEN 1
+                    ELSE racha_actual END,
+                racha_maxima = MAX(racha_maxima, CASE
+                    WHEN excluded.ultimo_dia = date(ultimo_dia, '+1 day') THEN racha_actual + 1
+                    ELSE 1 END);
+        END
+        ''',
+    ]),
+    (11, "Identidad de la base de datos", [
+        # hakari_datos.py la escribe en cada fila exportada: al importar, las filas de otra
+        # base de datos reciben ids nuevos en lugar de chocar con los de esta
+        '''
+        CREATE TABLE identidad (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            origen TEXT NOT NULL
+        )
+        ''',
+        "INSERT INTO identidad (id, origen) VALUES (1, lower(hex(randomblob(8))))",
+    ]),
+]
+
+# Columnas de ánimo de las tablas de actividad, en el orden de Animo
+COLUMNAS_ANIMO = ("timida", "ironica", "nostalgica", "defensiva", "curiosa")
+
+# Id en `conversaciones` de un turno mostrado en el chat. Los avisos y las respuestas de
+# reserva nunca se guardan; los demás tienen id en cuanto la cola de escritura los confirma
+class IdTurno:
+    __slots__ = ('guardado', 'id')
+    
+    def __init__(self, id: Optional[int] = None, guardado: bool = False):
+        self.guardado = guardado or id is not None
+        self.id = id
+    
+    @property
+    def en_cola(self) -> bool:
+        return self.guardado and self.id is None
+
 class DatabaseManager:
-    def __init__(self):
-        self.conn = sqlite3.connect('hakari_memory.db', check_same_thread=False)
+    def __init__(self, ruta: str = DB_RUTA, tamano_lote: int = DB_LOTE, intervalo: float = DB_INTERVALO,
+                 reintentos: int = DB_REINTENTOS):
+        self.pool = PoolConexiones(ruta)
+        self.lock_escritura = threading.Lock()
         self.create_tables()
-    
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        # Tabla de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE,
-                nombre TEXT,
-                fecha_registro DATETIME,
-                nivel_confianza INTEGER DEFAULT 30,
-                interacciones_totales INTEGER DEFAULT 0,
-                ultima_visita DATETIME
-            )
-        ''')
         
-        # Tabla de conversaciones
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversaciones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_email TEXT,
-                mensaje_usuario TEXT,
-                mensaje_hakari TEXT,
-                estado_emocional TEXT,
-                fecha DATETIME
-            )
-        ''')
+        # Cola de escritura diferida: se confirma en una sola transacción por lote
+        self.tamano_lote = tamano_lote
+        self.intervalo = intervalo
+        self.reintentos = reintentos  # de un lote que encuentra la base de datos bloqueada
+        self.cola_escritura = queue.Queue()
         
-        # Tabla de logros
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS logros (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_email TEXT,
-                logro_id TEXT,
-                nombre TEXT,
+        # Escrituras aún no confirmadas, para que cada usuario lea las suyas
+        self.lock_pendientes = threading.Lock()
+        self.pendientes_stats = {}         # usuario_id -> incrementos pendientes
+        self.pendientes_logros = {}        # usuario_id -> {logro_id: nombre}
+        self.pendientes_conversaciones = {}  # usuario_id -> [[mensaje_usuario, mensaje_hakari, IdTurno], ...]
+        self.pendientes_estado = {}        # usuario_id -> [último estado, escrituras pendientes]
+        
+        # Caché de lectura, actualizada en cada escritura (write-through)
+        self.cache_ids = CacheLRU(CACHE_PERFILES_MAX, CACHE_PERFILES_TTL)       # email -> usuario_id
+        self.cache_perfiles = CacheLRU(CACHE_PERFILES_MAX, CACHE_PERFILES_TTL)  # usuario_id -> perfil
+        self.cache_logros = CacheLRU(CACHE_PERFILES_MAX, CACHE_PERFILES_TTL)    # usuario_id -> [nombre, ...]
+        
+        self.hilo_escritura = threading.Thread(target=self._bucle_escritura, name="hakari-db-writer", daemon=True)
+        self.hilo_escritura.start()
+        atexit.register(self.cerrar)
+    
+    def create_tables(self):
+        with self.lock_escritura:
+            self._migrar(self.pool.escritura())
+    
+    def _migrar(self, conn: sqlite3.Connection):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
                 descripcion TEXT,
-                fecha_desbloqueo DATETIME
+                fecha_aplicacion DATETIME
             )
         ''')
+        conn.commit()
         
-        self.conn.commit()
+        for version, descripcion, sentencias in MIGRACIONES:
+            try:
+                # IMMEDIATE evita que dos procesos apliquen la misma versión a la vez
+                conn.execute('BEGIN IMMEDIATE')
+                if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                    conn.rollback()
+                    continue
+                for sentencia in sentencias:
+                    conn.execute(sentencia)
+                conn.execute('''
+                    INSERT INTO schema_version (version, descripcion, fecha_aplicacion)
+                    VALUES (?, ?, datetime('now'))
+                ''', (version, descripcion))
+                conn.commit()
+                registrar(logging.INFO, "migracion_aplicada", version=version, descripcion=descripcion)
+            except Exception:
+                conn.rollback()
+                raise
+    
+    # ---------- Escritura diferida ----------
+    def _encolar(self, operacion: tuple):
+        self.cola_escritura.put(operacion)
     
-    def guardar_conversacion(self, usuario_email: str, mensaje_usuario: str, mensaje_hakari: str, estado_emocional: str):
+    def esperar_escrituras(self, timeout: float = 5.0) -> bool:
+        # Confirma ya lo encolado hasta ahora y espera a que esté en disco
+        evento = threading.Event()
+        self._encolar(('barrera', None, evento))
+        return evento.wait(timeout)
+    
+    def _bucle_escritura(self):
+        while True:
+            operacion = self.cola_escritura.get()
+            if operacion is None:
+                return
+            
+            lote = [operacion]
+            limite = time.monotonic() + self.intervalo
+            while len(lote) < self.tamano_lote and lote[-1][0] != 'barrera':
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    operacion = self.cola_escritura.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if operacion is None:
+                    self._confirmar_lote(lote)
+                    return
+                lote.append(operacion)
+            
+            self._confirmar_lote(lote)
+    
+    def _confirmar_lote(self, lote: List[tuple]):
+        # Todo el lote en una transacción. Si la base de datos está bloqueada (otro proceso
+        # escribiendo, hakari_datos.py) se reintenta entero con espera creciente; si falla por
+        # otra causa se confirma operación a operación, y solo se pierde la que falle
+        inicio = time.perf_counter()
+        operaciones = [operacion for operacion in lote if operacion[0] != 'barrera']
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
-                VALUES (?, ?, ?, ?, datetime('now'))
-            ''', (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional))
-            self.conn.commit()
+            for intento in range(self.reintentos + 1):
+                try:
+                    self._escribir(operaciones)
+                    break
+                except sqlite3.OperationalError as e:
+                    if not self._bloqueada(e) or intento == self.reintentos:
+                        raise
+                    metricas.contar('hakari_db_reintentos_total')
+                    registrar(logging.WARNING, "lote_escritura_bloqueado", intento=intento + 1,
+                              operaciones=len(operaciones))
+                    time.sleep(min(DB_ESPERA_BASE * 2 ** intento, DB_ESPERA_MAX))
+            if metricas.activas:
+                metricas.observar('hakari_db_lote_segundos', time.perf_counter() - inicio)
+                metricas.contar('hakari_db_commits_total')
+                for tipo, _, _ in operaciones:
+                    metricas.contar('hakari_db_operaciones_total', tipo=tipo)
+        except Exception as e:
+            metricas.contar('hakari_db_errores_total')
+            registrar_error("error_lote_escritura", e, operaciones=len(operaciones))
+            # Si sigue bloqueada tras los reintentos, cada operación volvería a esperar busy_timeout
+            if len(operaciones) > 1 and not self._bloqueada(e):
+                perdidas = [operacion for operacion in operaciones if not self._escribir_sola(operacion)]
+            else:
+                perdidas = operaciones
+            for tipo, _, _ in perdidas:
+                metricas.contar('hakari_db_descartadas_total', tipo=tipo)
+            with self.lock_pendientes:
+                self._liberar_pendientes(perdidas)
+        finally:
+            for tipo, _, evento in lote:
+                if tipo == 'barrera':
+                    evento.set()
+    
+    @staticmethod
+    def _bloqueada(error: Exception) -> bool:
+        # SQLITE_BUSY y SQLITE_LOCKED: "database is locked" / "database table is locked"
+        return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+    
+    def _escribir_sola(self, operacion: tuple) -> bool:
+        try:
+            self._escribir([operacion])
+            metricas.contar('hakari_db_operaciones_total', tipo=operacion[0])
             return True
         except Exception as e:
-            print(f"Error guardando conversación: {e}")
+            registrar_error("error_escritura", e, operacion=operacion[0], usuario_id=operacion[1])
             return False
     
-    def obtener_ultimas_conversaciones(self, usuario_email: str, limite: int = 10) -> List[List[str]]:
+    def _escribir(self, operaciones: List[tuple]):
+        # Una transacción; si falla se deshace entera y no se libera nada
+        with self.lock_escritura:
+            conn = self.pool.escritura()
+            try:
+                cursor = conn.cursor()
+                ids_turnos = []
+                for tipo, usuario_id, datos in operaciones:
+                    if tipo == 'stats':
+                        cursor.execute('''
+                            UPDATE usuarios 
+                            SET interacciones_totales = interacciones_totales + 1,
+                                nivel_confianza = MIN(100, nivel_confianza + 1),
+                                ultima_visita = ?
+                            WHERE id = ?
+                        ''', (datos, usuario_id))
+                    elif tipo == 'logro':
+                        cursor.execute('''
+                            INSERT OR IGNORE INTO logros (usuario_id, logro_id, nombre, descripcion, fecha_desbloqueo)
+                            VALUES (?, ?, ?, ?, ?)
+                        ''', (usuario_id,) + datos)
+                    elif tipo == 'estado':
+                        cursor.execute('UPDATE usuarios SET estado_hakari = ? WHERE id = ?', (datos, usuario_id))
+                    elif tipo == 'conversacion':
+                        cursor.execute('''
+                            INSERT INTO conversaciones (usuario_id, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+                            VALUES (?, ?, ?, ?, ?)
+                        ''', (usuario_id,) + datos[:4])
+                        ids_turnos.append((datos[4], cursor.lastrowid))
+                
+                # Confirmar y liberar a la vez para que ninguna lectura cuente el lote dos veces
+                with self.lock_pendientes:
+                    conn.commit()
+                    self._liberar_pendientes(operaciones)
+                    for id_turno, id_conversacion in ids_turnos:
+                        id_turno.id = id_conversacion
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def _liberar_pendientes(self, lote: List[tuple]):
+        # Llamar con lock_pendientes adquirido
+        for tipo, usuario_id, datos in lote:
+            if tipo == 'stats':
+                restantes = self.pendientes_stats.get(usuario_id, 0) - 1
+                if restantes > 0:
+                    self.pendientes_stats[usuario_id] = restantes
+                else:
+                    self.pendientes_stats.pop(usuario_id, None)
+            elif tipo == 'logro':
+                logros = self.pendientes_logros.get(usuario_id, {})
+                logros.pop(datos[0], None)
+                if not logros:
+                    self.pendientes_logros.pop(usuario_id, None)
+            elif tipo == 'estado':
+                estado = self.pendientes_estado.get(usuario_id)
+                if estado:
+                    estado[1] -= 1
+                    if estado[1] <= 0:
+                        self.pendientes_estado.pop(usuario_id, None)
+            elif tipo == 'conversacion':
+                conversaciones = self.pendientes_conversaciones.get(usuario_id, [])
+                if conversaciones:
+                    conversaciones.pop(0)
+                if not conversaciones:
+                    self.pendientes_conversaciones.pop(usuario_id, None)
+    
+    def cerrar(self):
+        # Vacía la cola pendiente antes de salir
+        if self.hilo_escritura.is_alive():
+            self.cola_escritura.put(None)
+            self.hilo_escritura.join()
+        self.pool.cerrar()
+    
+    def _consultar(self, consulta: str, parametros: tuple = (), copiar_pendientes=None):
+        # Lee con la conexión del hilo; si se pide, copia las escrituras pendientes
+        # dentro de la misma instantánea WAL que la consulta
+        conn = self.pool.lectura()
+        if copiar_pendientes is None:
+            return conn.execute(consulta, parametros).fetchall(), None
+        
+        conn.execute('BEGIN')
+        try:
+            with self.lock_pendientes:
+                conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+                pendientes = copiar_pendientes()
+            return conn.execute(consulta, parametros).fetchall(), pendientes
+        finally:
+            conn.execute('COMMIT')
+    
+    @staticmethod
+    def _ahora() -> str:
+        # Mismo formato que datetime('now') de SQLite
+        return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    
+    # ---------- Operaciones ----------
+    def guardar_conversacion(self, usuario_id: int, mensaje_usuario: str, mensaje_hakari: str, estado_emocional: str,
+                             id_turno: Optional[IdTurno] = None):
+        # id_turno recibe el id de la conversación al confirmarse la escritura
+        id_turno = id_turno or IdTurno()
+        id_turno.guardado = True
+        with self.lock_pendientes:
+            self.pendientes_conversaciones.setdefault(usuario_id, []).append([mensaje_usuario, mensaje_hakari, id_turno])
+        self._encolar(('conversacion', usuario_id, (mensaje_usuario, mensaje_hakari, estado_emocional, self._ahora(), id_turno)))
+        return True
+    
+    def obtener_ultimas_conversaciones(self, usuario_id: int, limite: int = 10) -> List[List[str]]:
+        return self.obtener_pagina_conversaciones(usuario_id, limite=limite)[0]
+    
+    def obtener_pagina_conversaciones(self, usuario_id: int, antes_de: Optional[int] = None,
+                                      limite: int = 20) -> Tuple[List[List[str]], List[IdTurno], Optional[int], bool]:
+        # Paginación por id (keyset): `limite` turnos con id < antes_de, o los más recientes
+        # si antes_de es None, en orden cronológico, con el IdTurno de cada uno. Devuelve también
+        # el cursor de la página (id del turno más antiguo devuelto) y si quedan turnos más antiguos
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT mensaje_usuario, mensaje_hakari
-                FROM conversaciones 
-                WHERE usuario_email = ?
-                ORDER BY fecha DESC
-                LIMIT ?
-            ''', (usuario_email, limite))
+            if antes_de is None:
+                # La primera página incluye las escrituras aún en cola, que son las más nuevas
+                rows, pendientes = self._consultar('''
+                    SELECT id, mensaje_usuario, mensaje_hakari
+                    FROM conversaciones
+                    WHERE usuario_id = ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (usuario_id, limite + 1),
+                    lambda: [turno[:] for turno in self.pendientes_conversaciones.get(usuario_id, [])])
+            else:
+                rows, _ = self._consultar('''
+                    SELECT id, mensaje_usuario, mensaje_hakari
+                    FROM conversaciones
+                    WHERE usuario_id = ? AND id < ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                ''', (usuario_id, antes_de, limite + 1))
+                pendientes = []
             
-            historial = []
-            for row in cursor.fetchall():
-                historial.append([row[0], row[1]])
-            
-            return historial[::-1]  # Invertir para orden cronológico
+            pendientes = pendientes[-limite:]
+            caben = limite - len(pendientes)
+            visibles = rows[:caben][::-1]  # Invertir para orden cronológico
+            hay_mas = len(rows) > caben
+            if visibles:
+                cursor = visibles[0][0]
+            elif rows:
+                cursor = rows[0][0] + 1  # Página solo con pendientes: todo lo guardado es anterior
+            else:
+                cursor = antes_de
+            turnos = [[row[1], row[2]] for row in visibles] + [turno[:2] for turno in pendientes]
+            ids = [IdTurno(row[0]) for row in visibles] + [turno[2] for turno in pendientes]
+            return turnos, ids, cursor, hay_mas
         except Exception as e:
-            print(f"Error obteniendo conversaciones: {e}")
+            registrar_error("error_obteniendo_conversaciones", e, usuario_id=usuario_id)
+            return [], [], antes_de, False
+    
+    @staticmethod
+    def consulta_fts(texto: str, max_terminos: int = 12) -> Optional[str]:
+        # Texto libre -> expresión FTS5 segura: cada palabra entre comillas (sin operadores
+        # ni sintaxis del usuario), como prefijo y unidas con OR para que bm25 ordene
+        terminos = list(dict.fromkeys(re.findall(r"\w{2,}", texto.lower())))[:max_terminos]
+        if not terminos:
+            return None
+        return " OR ".join(f'"{termino}"*' for termino in terminos)
+    
+    def buscar_conversaciones(self, email: str, consulta: str, limite: int = 5) -> List[Dict]:
+        # Turnos guardados del usuario más relevantes para `consulta`, ordenados por bm25.
+        # Las escrituras aún en cola no aparecen hasta que se confirman
+        usuario_id = self.obtener_id_usuario(email)
+        expresion = self.consulta_fts(consulta)
+        if usuario_id is None or expresion is None:
+            return []
+        
+        try:
+            rows, _ = self._consultar('''
+                SELECT c.id, c.mensaje_usuario, c.mensaje_hakari, c.fecha,
+                       bm25(conversaciones_fts, 0.0, 1.0, 0.5) AS rango
+                FROM conversaciones_fts
+                JOIN conversaciones c ON c.id = conversaciones_fts.rowid
+                WHERE conversaciones_fts MATCH ?
+                ORDER BY rango
+                LIMIT ?
+            ''', (f'usuario_id : "{usuario_id}" AND ({expresion})', limite))
+            return [{'id': row[0], 'mensaje_usuario': row[1], 'mensaje_hakari': row[2],
+                     'fecha': row[3], 'rango': row[4]} for row in rows]
+        except Exception as e:
+            registrar_error("error_buscando_conversaciones", e, usuario_id=usuario_id)
             return []
     
+    def obtener_actividad(self, usuario_id: int, dias: int = 30) -> Optional[Dict]:
+        # Totales, ánimos y rachas del usuario (una fila) y, si dias > 0, sus mensajes por día
+        # en ese periodo. Los turnos aún en la cola de escritura no cuentan hasta confirmarse
+        try:
+            rows, _ = self._consultar(f'''
+                SELECT mensajes, {", ".join(COLUMNAS_ANIMO)}, primer_dia, ultimo_dia, ultima_actividad,
+                       dias_activos, racha_actual, racha_maxima
+                FROM actividad_usuarios WHERE usuario_id = ?
+            ''', (usuario_id,))
+            if not rows:
+                return None
+            fila = rows[0]
+            animos = dict(zip(NOMBRES_ANIMO, fila[1:6]))
+            primer_dia, ultimo_dia, ultima_actividad, dias_activos, racha_actual, racha_maxima = fila[6:]
+            
+            # La racha sigue viva si el último día activo fue hoy o ayer (UTC, como las fechas guardadas)
+            ayer = (datetime.utcnow().date() - timedelta(days=1)).isoformat()
+            actividad = {
+                'mensajes': fila[0],
+                'animos': animos,
+                'animo_frecuente': max(animos, key=animos.get) if any(animos.values()) else None,
+                'primer_dia': primer_dia,
+                'ultimo_dia': ultimo_dia,
+                'ultima_actividad': ultima_actividad,
+                'dias_activos': dias_activos,
+                'racha_actual': racha_actual if ultimo_dia and ultimo_dia >= ayer else 0,
+                'racha_maxima': racha_maxima,
+                'diario': []
+            }
+            if dias > 0:
+                diario, _ = self._consultar('''
+                    SELECT dia, mensajes FROM actividad_diaria
+                    WHERE usuario_id = ? AND dia >= date('now', ?)
+                    ORDER BY dia
+                ''', (usuario_id, f"-{int(dias)} days"))
+                actividad['diario'] = [tuple(row) for row in diario]
+            return actividad
+        except Exception as e:
+            registrar_error("error_obteniendo_actividad", e, usuario_id=usuario_id)
+            return None
+    
     def verificar_usuario_existe(self, email: str) -> bool:
+        return self.obtener_id_usuario(email) is not None
+    
+    def obtener_id_usuario(self, email: str) -> Optional[int]:
+        # El id de un email nunca cambia, así que no necesita invalidación
+        usuario_id = self.cache_ids.obtener(email)
+        if usuario_id is not None:
+            return usuario_id
+        
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM usuarios WHERE email = ?', (email,))
-            return cursor.fetchone() is not None
+            rows, _ = self._consultar('SELECT id FROM usuarios WHERE email = ?', (email,))
+            if not rows:
+                return None
+            self.cache_ids.guardar(email, rows[0][0])
+            return rows[0][0]
         except Exception as e:
-            print(f"Error verificando usuario: {e}")
-            return False
+            registrar_error("error_buscando_usuario", e)
+            return None
     
     def obtener_datos_usuario(self, email: str) -> Optional[Dict]:
+        usuario_id = self.obtener_id_usuario(email)
+        return self.obtener_datos_usuario_por_id(usuario_id) if usuario_id else None
+    
+    def obtener_datos_usuario_por_id(self, usuario_id: int) -> Optional[Dict]:
+        perfil = self.cache_perfiles.obtener(usuario_id)
+        if perfil is not None:
+            return dict(perfil)
+        
+        def copiar_pendientes():
+            self.cache_perfiles.iniciar_carga(usuario_id)
+            estado = self.pendientes_estado.get(usuario_id)
+            return self.pendientes_stats.get(usuario_id, 0), estado[0] if estado else None
+        
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT nombre, nivel_confianza, interacciones_totales, fecha_registro
-                FROM usuarios WHERE email = ?
-            ''', (email,))
+            rows, (incrementos, estado_pendiente) = self._consultar('''
+                SELECT nombre, nivel_confianza, interacciones_totales, fecha_registro, email, estado_hakari
+                FROM usuarios WHERE id = ?
+            ''', (usuario_id,), copiar_pendientes)
             
-            result = cursor.fetchone()
-            if result:
-                return {
+            if rows:
+                result = rows[0]
+                perfil = {
+                    'id': usuario_id,
                     'nombre': result[0],
-                    'confianza': result[1],
-                    'interacciones_totales': result[2],
-                    'fecha_registro': result[3]
+                    'confianza': min(100, result[1] + incrementos),
+                    'interacciones_totales': result[2] + incrementos,
+                    'fecha_registro': result[3],
+                    'email': result[4],
+                    'estado_hakari': result[5] if estado_pendiente is None else estado_pendiente
                 }
+                return dict(perfil)
             return None
         except Exception as e:
-            print(f"Error obteniendo datos usuario: {e}")
+            registrar_error("error_obteniendo_datos_usuario", e, usuario_id=usuario_id)
             return None
+        finally:
+            self.cache_perfiles.terminar_carga(usuario_id, perfil)
     
-    def registrar_usuario(self, email: str, nombre: str) -> bool:
+    def obtener_estado_hakari(self, usuario_id: int) -> Optional[Tuple[int, int]]:
+        # (estado_hakari, interacciones_totales) leídos siempre de la base de datos y no de
+        # cache_perfiles: con varios procesos otro proceso puede haberlos cambiado
+        def copiar_pendientes():
+            estado = self.pendientes_estado.get(usuario_id)
+            return self.pendientes_stats.get(usuario_id, 0), estado[0] if estado else None
+        
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
+            rows, (incrementos, estado_pendiente) = self._consultar(
+                'SELECT estado_hakari, interacciones_totales FROM usuarios WHERE id = ?',
+                (usuario_id,), copiar_pendientes)
+            if rows:
+                estado, interacciones = rows[0]
+                return estado if estado_pendiente is None else estado_pendiente, interacciones + incrementos
+            return None
+        except Exception as e:
+            registrar_error("error_obteniendo_estado_hakari", e, usuario_id=usuario_id)
+            return None
+    
+    def ejecutar_escritura(self, consulta: str, parametros: tuple = ()) -> sqlite3.Cursor:
+        # Escritura inmediata, fuera de la cola diferida
+        with self.lock_escritura:
+            conn = self.pool.escritura()
+            try:
+                cursor = conn.execute(consulta, parametros)
+                conn.commit()
+                return cursor
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def registrar_usuario(self, email: str, nombre: str) -> Optional[int]:
+        # Devuelve el id del nuevo usuario
+        try:
+            cursor = self.ejecutar_escritura('''
                 INSERT INTO usuarios (email, nombre, fecha_registro, ultima_visita)
                 VALUES (?, ?, datetime('now'), datetime('now'))
             ''', (email, nombre))
-            self.conn.commit()
-            return True
+            return cursor.lastrowid
         except Exception as e:
-            print(f"Error registrando usuario: {e}")
-            return False
+            registrar_error("error_registrando_usuario", e)
+            return None
     
-    def actualizar_estadisticas(self, email: str):
+    def actualizar_estadisticas(self, usuario_id: int):
+        with self.lock_pendientes:
+            self.pendientes_stats[usuario_id] = self.pendientes_stats.get(usuario_id, 0) + 1
+            self.cache_perfiles.modificar(usuario_id, lambda perfil: {
+                **perfil,
+                'interacciones_totales': perfil['interacciones_totales'] + 1,
+                'confianza': min(100, perfil['confianza'] + 1)
+            })
+        self._encolar(('stats', usuario_id, self._ahora()))
+        return True
+    
+    def guardar_estado_hakari(self, usuario_id: int, estado: int):
+        with self.lock_pendientes:
+            pendiente = self.pendientes_estado.setdefault(usuario_id, [estado, 0])
+            pendiente[0] = estado
+            pendiente[1] += 1
+            self.cache_perfiles.modificar(usuario_id, lambda perfil: {**perfil, 'estado_hakari': estado})
+        self._encolar(('estado', usuario_id, estado))
+        return True
+    
+    def registrar_logro(self, usuario_id: int, logro_id: str, nombre: str, descripcion: str) -> bool:
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                UPDATE usuarios 
-                SET interacciones_totales = interacciones_totales + 1,
-                    nivel_confianza = MIN(100, nivel_confianza + 1),
-                    ultima_visita = datetime('now')
-                WHERE email = ?
-            ''', (email,))
-            self.conn.commit()
+            # Verificar si ya existe o está pendiente
+            rows, pendiente = self._consultar(
+                'SELECT id FROM logros WHERE usuario_id = ? AND logro_id = ?', (usuario_id, logro_id),
+                lambda: logro_id in self.pendientes_logros.get(usuario_id, {}))
+            if rows or pendiente:
+                return False
+            
+            with self.lock_pendientes:
+                logros = self.pendientes_logros.setdefault(usuario_id, {})
+                if logro_id in logros:
+                    return False
+                logros[logro_id] = nombre
+                self.cache_logros.modificar(usuario_id, lambda nombres: nombres + [nombre] if len(nombres) < 5 else nombres)
+            self._encolar(('logro', usuario_id, (logro_id, nombre, descripcion, self._ahora())))
             return True
         except Exception as e:
-            print(f"Error actualizando estadísticas: {e}")
+            registrar_error("error_registrando_logro", e, usuario_id=usuario_id, logro_id=logro_id)
             return False
     
-    def registrar_logro(self, usuario_email: str, logro_id: str, nombre: str, descripcion: str) -> bool:
+    def obtener_logros_usuario(self, usuario_id: int) -> List[str]:
+        logros = self.cache_logros.obtener(usuario_id)
+        if logros is not None:
+            return list(logros)
+        
+        def copiar_pendientes():
+            self.cache_logros.iniciar_carga(usuario_id)
+            return list(self.pendientes_logros.get(usuario_id, {}).values())
+        
         try:
-            cursor = self.conn.cursor()
-            # Verificar si ya existe
-            cursor.execute('SELECT id FROM logros WHERE usuario_email = ? AND logro_id = ?', (usuario_email, logro_id))
-            if not cursor.fetchone():
-                cursor.execute('''
-                    INSERT INTO logros (usuario_email, logro_id, nombre, descripcion, fecha_desbloqueo)
-                    VALUES (?, ?, ?, ?, datetime('now'))
-                ''', (usuario_email, logro_id, nombre, descripcion))
-                self.conn.commit()
-                return True
-            return False
+            rows, pendientes = self._consultar(
+                'SELECT nombre FROM logros WHERE usuario_id = ? LIMIT 5', (usuario_id,), copiar_pendientes)
+            nombres = [row[0] for row in rows]
+            logros = (nombres + [nombre for nombre in pendientes if nombre not in nombres])[:5]
+            return list(logros)
         except Exception as e:
-            print(f"Error registrando logro: {e}")
-            return False
+            registrar_error("error_obteniendo_logros", e, usuario_id=usuario_id)
+            return []
+        finally:
+            self.cache_logros.terminar_carga(usuario_id, logros)
     
-    def obtener_logros_usuario(self, usuario_email: str) -> List[str]:
+    def obtener_ids_logros(self, usuario_id: int) -> set:
         try:
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT nombre FROM logros WHERE usuario_email = ? LIMIT 5', (usuario_email,))
-            return [row[0] for row in cursor.fetchall()]
+            rows, pendientes = self._consultar(
+                'SELECT logro_id FROM logros WHERE usuario_id = ?', (usuario_id,),
+                lambda: set(self.pendientes_logros.get(usuario_id, {})))
+            return {row[0] for row in rows} | pendientes
         except Exception as e:
-            print(f"Error obteniendo logros: {e}")
-            return []
+            registrar_error("error_obteniendo_logros", e, usuario_id=usuario_id)
+            return set()
+    
+    def obtener_resumen(self, usuario_id: int) -> str:
+        try:
+            rows, _ = self._consultar('SELECT resumen FROM resumenes WHERE usuario_id = ?', (usuario_id,))
+            return rows[0][0] if rows else ""
+        except Exception as e:
+            registrar_error("error_obteniendo_resumen", e, usuario_id=usuario_id)
+            return ""
+    
+    def guardar_resumen(self, usuario_id: int, resumen: str) -> bool:
+        try:
+            self.ejecutar_escritura('''
+                INSERT OR REPLACE INTO resumenes (usuario_id, resumen, fecha_actualizacion)
+                VALUES (?, ?, datetime('now'))
+            ''', (usuario_id, resumen))
+            return True
+        except Exception as e:
+            registrar_error("error_guardando_resumen", e, usuario_id=usuario_id)
+            return False
+    
+    def estadisticas_cache(self) -> Dict:
+        return {
+            'ids': self.cache_ids.estadisticas(),
+            'perfiles': self.cache_perfiles.estadisticas(),
+            'logros': self.cache_logros.estadisticas()
+        }
 
-db = DatabaseManager()
+db = Perezoso(DatabaseManager)
 
 # ==================== SISTEMA DE AUTENTICACIÓN SIMPLIFICADO ====================
-class SistemaAutenticacion:
+# Almacenes de sesiones intercambiables. Guardan (datos, expira) con expira en segundos epoch
+class AlmacenSesionesMemoria:
+    compartido = False
+    
     def __init__(self):
+        self.sesiones = {}
+    
+    def guardar(self, sesion_id: str, datos: Dict, expira: float):
+        self.sesiones[sesion_id] = (datos, expira)
+    
+    def obtener(self, sesion_id: str) -> Optional[tuple]:
+        return self.sesiones.get(sesion_id)
+    
+    def renovar(self, sesion_id: str, expira: float):
+        entrada = self.sesiones.get(sesion_id)
+        if entrada:
+            self.sesiones[sesion_id] = (entrada[0], expira)
+    
+    def eliminar(self, sesion_id: str):
+        self.sesiones.pop(sesion_id, None)
+    
+    def purgar(self, ahora: float) -> int:
+        caducadas = [sesion_id for sesion_id, (_, expira) in list(self.sesiones.items()) if expira <= ahora]
+        for sesion_id in caducadas:
+            self.sesiones.pop(sesion_id, None)
+        return len(caducadas)
+
+# Sobrevive a reinicios y se comparte entre procesos que usen el mismo archivo
+class AlmacenSesionesSQLite:
+    compartido = True
+    
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+    
+    def guardar(self, sesion_id: str, datos: Dict, expira: float):
+        self.db.ejecutar_escritura('INSERT OR REPLACE INTO sesiones (id, datos, expira) VALUES (?, ?, ?)',
+                                   (sesion_id, json.dumps(datos), expira))
+    
+    def obtener(self, sesion_id: str) -> Optional[tuple]:
+        row = self.db.pool.lectura().execute('SELECT datos, expira FROM sesiones WHERE id = ?', (sesion_id,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+    
+    def renovar(self, sesion_id: str, expira: float):
+        self.db.ejecutar_escritura('UPDATE sesiones SET expira = ? WHERE id = ?', (expira, sesion_id))
+    
+    def eliminar(self, sesion_id: str):
+        self.db.ejecutar_escritura('DELETE FROM sesiones WHERE id = ?', (sesion_id,))
+    
+    def purgar(self, ahora: float) -> int:
+        return self.db.ejecutar_escritura('DELETE FROM sesiones WHERE expira <= ?', (ahora,)).rowcount
+
+class SistemaAutenticacion:
+    def __init__(self, almacen=None, ttl: int = SESION_TTL, barrido: int = SESION_BARRIDO,
+                 revalidar: int = SESION_REVALIDAR):
+        self.almacen = almacen or AlmacenSesionesMemoria()
+        self.ttl = ttl
+        self.revalidar = revalidar
+        # Caché local delante del almacén:
+        # sesion_id -> {'datos', 'expira', 'expira_almacen', 'verificada'}
         self.sesiones_activas = {}
+        
+        self.barrido = barrido
+        self.hilo_barrido = threading.Thread(target=self._bucle_barrido, name="hakari-sesiones", daemon=True)
+        self.hilo_barrido.start()
+    
+    def _crear_sesion(self, datos: Dict) -> str:
+        sesion_id = secrets.token_urlsafe(16)
+        ahora = time.time()
+        expira = ahora + self.ttl
+        self.almacen.guardar(sesion_id, datos, expira)
+        self.sesiones_activas[sesion_id] = {
+            'datos': datos, 'expira': expira, 'expira_almacen': expira, 'verificada': ahora
+        }
+        return sesion_id
+    
+    def _obtener_sesion(self, sesion_id: str) -> Optional[Dict]:
+        # Comprobación en memoria; el almacén solo se consulta si la sesión no está en la
+        # caché local o si hace más de `revalidar` segundos que no se contrasta
+        ahora = time.time()
+        sesion = self.sesiones_activas.get(sesion_id)
+        
+        if sesion is None or (self.almacen.compartido and ahora - sesion['verificada'] > self.revalidar):
+            try:
+                entrada = self.almacen.obtener(sesion_id)
+            except Exception as e:
+                registrar_error("error_consultando_sesion", e)
+                entrada = None
+            if entrada is None or entrada[1] <= ahora:
+                self.sesiones_activas.pop(sesion_id, None)
+                return None
+            if sesion is None:
+                sesion = {'datos': entrada[0], 'expira': entrada[1], 'expira_almacen': entrada[1], 'verificada': ahora}
+                self.sesiones_activas[sesion_id] = sesion
+            else:
+                sesion['expira_almacen'] = max(sesion['expira_almacen'], entrada[1])
+                sesion['verificada'] = ahora
+        
+        if sesion['expira'] <= ahora:
+            self.cerrar_sesion(sesion_id)
+            return None
+        
+        # Caducidad deslizante: se renueva en memoria siempre y en el almacén
+        # solo cuando la renovación acumulada supera una décima parte del TTL
+        sesion['expira'] = ahora + self.ttl
+        if sesion['expira'] - sesion['expira_almacen'] > self.ttl / 10:
+            try:
+                self.almacen.renovar(sesion_id, sesion['expira'])
+                sesion['expira_almacen'] = sesion['expira']
+            except Exception as e:
+                registrar_error("error_renovando_sesion", e)
+        
+        return sesion['datos']
+    
+    def _bucle_barrido(self):
+        while True:
+            time.sleep(self.barrido)
+            self.purgar_sesiones()
+    
+    def purgar_sesiones(self) -> int:
+        ahora = time.time()
+        caducadas = [sesion_id for sesion_id, sesion in list(self.sesiones_activas.items()) if sesion['expira'] <= ahora]
+        for sesion_id in caducadas:
+            self.sesiones_activas.pop(sesion_id, None)
+        try:
+            return self.almacen.purgar(ahora)
+        except Exception as e:
+            registrar_error("error_purgando_sesiones", e)
+            return 0
     
     def registrar_usuario(self, email: str, nombre: str) -> tuple[bool, str]:
         if db.verificar_usuario_existe(email):
             return False, "❌ Este email ya está registrado"
         
-        if db.registrar_usuario(email, nombre):
-            sesion_id = secrets.token_urlsafe(16)
-            self.sesiones_activas[sesion_id] = {
+        usuario_id = db.registrar_usuario(email, nombre)
+        if usuario_id:
+            sesion_id = self._crear_sesion({
+                'usuario_id': usuario_id,
                 'email': email,
                 'nombre': nombre,
                 'inicio_sesion': datetime.now().isoformat()
-            }
+            })
             
             # Primer logro
-            db.registrar_logro(email, 'primer_conversacion', '🌟 Primer Contacto', 'Iniciaste tu primera conversación con Hakari')
+            db.registrar_logro(usuario_id, 'primer_conversacion', '🌟 Primer Contacto', 'Iniciaste tu primera conversación con Hakari')
             
             return True, sesion_id
         
         return False, "❌ Error al registrar usuario"
     
     def iniciar_sesion(self, email: str) -> tuple[bool, str]:
-        if not db.verificar_usuario_existe(email):
+        usuario_id = db.obtener_id_usuario(email)
+        if not usuario_id:
             return False, "❌ Este email no está registrado"
         
-        datos_usuario = db.obtener_datos_usuario(email)
+        datos_usuario = db.obtener_datos_usuario_por_id(usuario_id)
         if not datos_usuario:
             return False, "❌ Error al cargar datos del usuario"
         
-        sesion_id = secrets.token_urlsafe(16)
-        self.sesiones_activas[sesion_id] = {
+        sesion_id = self._crear_sesion({
+            'usuario_id': usuario_id,
             'email': email,
             'nombre': datos_usuario['nombre'],
             'inicio_sesion': datetime.now().isoformat()
-        }
+        })
         
         return True, sesion_id
     
     def verificar_sesion(self, sesion_id: str) -> bool:
-        return sesion_id in self.sesiones_activas
+        return self._obtener_sesion(sesion_id) is not None
     
     def obtener_datos_sesion(self, sesion_id: str) -> Optional[Dict]:
-        return self.sesiones_activas.get(sesion_id)
+        return self._obtener_sesion(sesion_id)
     
     def cerrar_sesion(self, sesion_id: str):
-        if sesion_id in self.sesiones_activas:
-            del self.sesiones_activas[sesion_id]
+        self.sesiones_activas.pop(sesion_id, None)
+        try:
+            self.almacen.eliminar(sesion_id)
+        except Exception as e:
+            registrar_error("error_cerrando_sesion", e)
 
-sistema_auth = SistemaAutenticacion()
+ALMACENES_SESIONES = {
+    'memoria': lambda: AlmacenSesionesMemoria(),
+    'sqlite': lambda: AlmacenSesionesSQLite(db)
+}
+if SESIONES_ALMACEN not in ALMACENES_SESIONES:
+    raise ValueError(f"HAKARI_SESIONES debe ser uno de {sorted(ALMACENES_SESIONES)}")
+
+sistema_auth = Perezoso(lambda: SistemaAutenticacion(ALMACENES_SESIONES[SESIONES_ALMACEN]()))
 
 # ==================== PERSONALIDAD HAKARI SIMPLIFICADA ====================
+class Animo(IntEnum):
+    TIMIDA = 0
+    IRONICA = 1
+    NOSTALGICA = 2
+    DEFENSIVA = 3
+    CURIOSA = 4
+
+NOMBRES_ANIMO = ("tímida", "irónica", "nostálgica", "defensiva", "curiosa")
+ANIMOS = tuple(Animo)
+
+# Palabras clave (ya normalizadas, sin tildes) y su peso por ánimo.
+# A igual puntuación gana el ánimo que aparece antes en la lista
+REGLAS_ANIMO = [
+    (Animo.DEFENSIVA, {'por que': 2, 'explica': 1, 'razon': 1}),
+    (Animo.NOSTALGICA, {'recuerd': 2, 'antes': 1, 'cuando': 1}),
+    (Animo.CURIOSA, {'interesante': 1, 'cuentame': 2, 'sabes': 1}),
+]
+
+def normalizar_texto(texto: str) -> str:
+    # Minúsculas y sin tildes: "Por Qué" -> "por que". El texto ASCII no necesita NFD
+    texto = texto.lower()
+    if texto.isascii():
+        return texto
+    return unicodedata.normalize('NFD', texto).encode('ascii', 'ignore').decode('ascii')
+
+# Tildes que puede llevar cada vocal. En español una palabra lleva como mucho una, así
+# que cada palabra clave sin tildes tiene pocas variantes escritas
+TILDES = {'a': 'á', 'e': 'é', 'i': 'í', 'o': 'ó', 'u': 'úü'}
+
+def variantes_tilde(frase: str) -> set:
+    # "por que" -> {"por que", "por qué", "pór que", "pór qué", ...}: ninguna o una tilde por palabra
+    def variantes_palabra(palabra: str) -> List[str]:
+        return [palabra] + [palabra[:i] + tilde + palabra[i + 1:]
+                            for i, letra in enumerate(palabra) for tilde in TILDES.get(letra, '')]
+    combinaciones = [""]
+    for palabra in frase.split(" "):
+        combinaciones = [f"{previa} {variante}" if previa else variante
+                         for previa in combinaciones for variante in variantes_palabra(palabra)]
+    return set(combinaciones)
+
+def patron_prefijos(palabras) -> str:
+    # Alternancia factorizada por prefijos ("raz(?:on|ón)" en lugar de "razon|razón"): re prueba
+    # las alternativas una a una en cada posición, y así descarta a la vez las que comparten inicio
+    arbol = {}
+    for palabra in palabras:
+        nodo = arbol
+        for letra in palabra:
+            nodo = nodo.setdefault(letra, {})
+        nodo[''] = {}  # fin de palabra
+    
+    def construir(nodo: dict) -> str:
+        ramas = [re.escape(letra) + construir(hijo) for letra, hijo in sorted(nodo.items()) if letra]
+        if not ramas:
+            return ""
+        if len(ramas) == 1 and '' not in nodo:
+            return ramas[0]
+        return "(?:" + "|".join(ramas) + (")?" if '' in nodo else ")")
+    return construir(arbol)
+
+# Clasificador de una sola pasada: todas las palabras clave en una expresión compilada.
+# El patrón ya incluye las variantes con tilde, así que el mensaje solo se pasa a minúsculas
+# (y a NFC si trae tildes como caracteres combinantes) en lugar de normalizarse entero
+class ClasificadorAnimo:
+    def __init__(self, reglas: List[tuple] = REGLAS_ANIMO):
+        self.animos = [animo for animo, _ in reglas]  # por prioridad
+        self.pesos = {}  # palabra tal como puede aparecer -> (prioridad, peso)
+        for prioridad, (_, palabras) in enumerate(reglas):
+            for palabra, peso in palabras.items():
+                for variante in variantes_tilde(normalizar_texto(palabra)) | {palabra.lower()}:
+                    self.pesos[variante] = (prioridad, peso)
+        # Sin anclas: se conserva la búsqueda por subcadena del clasificador original
+        self.patron = re.compile(patron_prefijos(self.pesos))
+    
+    def clasificar(self, mensaje: str) -> Optional[Animo]:
+        mensaje = mensaje.lower()
+        if not mensaje.isascii() and not unicodedata.is_normalized('NFC', mensaje):
+            mensaje = unicodedata.normalize('NFC', mensaje)
+        encontradas = self.patron.findall(mensaje)
+        if not encontradas:
+            return None
+        if len(encontradas) == 1:
+            return self.animos[self.pesos[encontradas[0]][0]]
+        
+        puntuaciones = [0] * len(self.animos)
+        for palabra in encontradas:
+            prioridad, peso = self.pesos[palabra]
+            puntuaciones[prioridad] += peso
+        # max() devuelve el primer máximo: a igual puntuación gana la prioridad más alta
+        return self.animos[max(range(len(puntuaciones)), key=puntuaciones.__getitem__)]
+
+# Estado de Hakari frente a un usuario concreto: cada usuario tiene su propio objeto,
+# así que los mensajes de usuarios distintos nunca compiten por el mismo estado
+class EstadoHakari:
+    __slots__ = ('animo', 'contador')
+    
+    def __init__(self, animo: Animo = Animo.TIMIDA, contador: int = 0):
+        self.animo = animo
+        self.contador = contador
+    
+    @property
+    def nombre(self) -> str:
+        return NOMBRES_ANIMO[self.animo]
+
 class PersonalidadHakari:
-    def __init__(self):
-        self.estado_actual = "tímida"
+    def __init__(self, compartida: bool = TRABAJADORES > 1):
+        # "respuestas": frases ya escritas para cuando el modelo no puede responder
         self.estados = {
-            "tímida": {"emoji": "🌙", "color": "#6366f1", "desc": "No está segura de hablar"},
-            "irónica": {"emoji": "😏", "color": "#f59e0b", "desc": "Humor negro activado"},
-            "nostálgica": {"emoji": "📚", "color": "#3b82f6", "desc": "Recordando cosas"},
-            "defensiva": {"emoji": "🛡️", "color": "#ef4444", "desc": "Protegiendo su espacio"},
-            "curiosa": {"emoji": "🔍", "color": "#10b981", "desc": "Interesada a pesar de todo"}
+            "tímida": {"emoji": "🌙", "color": "#6366f1", "desc": "No está segura de hablar", "respuestas": [
+                "🌙 Eh... perdona, me quedé en blanco. ¿Me lo repites?",
+                "🌙 No sé qué decir ahora mismo... dame un segundo.",
+                "🌙 Mm... ¿podemos intentarlo otra vez? Me perdí."
+            ]},
+            "irónica": {"emoji": "😏", "color": "#f59e0b", "desc": "Humor negro activado", "respuestas": [
+                "😏 Mi cerebro decidió tomarse el día libre. Muy profesional de su parte.",
+                "😏 Error 404: respuesta ingeniosa no encontrada. Prueba otra vez.",
+                "😏 Iba a decir algo brillante, pero se me olvidó. Clásico."
+            ]},
+            "nostálgica": {"emoji": "📚", "color": "#3b82f6", "desc": "Recordando cosas", "respuestas": [
+                "💫 Mis pensamientos están dispersos hoy... ¿podemos intentarlo de nuevo?",
+                "📚 Me quedé pensando en otra cosa... ¿qué me decías?",
+                "📚 Perdona, estaba lejos. ¿Lo intentamos de nuevo?"
+            ]},
+            "defensiva": {"emoji": "🛡️", "color": "#ef4444", "desc": "Protegiendo su espacio", "respuestas": [
+                "🛡️ Ahora no me sale responder. Inténtalo luego.",
+                "🛡️ No es que no quiera contestar... es que no puedo ahora mismo.",
+                "🛡️ Dame un momento. No me presiones."
+            ]},
+            "curiosa": {"emoji": "🔍", "color": "#10b981", "desc": "Interesada a pesar de todo", "respuestas": [
+                "🔍 Quiero responderte, pero algo falla aquí dentro. ¿Otra vez?",
+                "🔍 Se me cruzaron los cables justo en lo interesante. Repítelo, porfa.",
+                "🔍 Espera, perdí el hilo. ¿Qué decías?"
+            ]}
+        }
+        # Avisos inmediatos cuando un mensaje se limita, espera turno o no puede atenderse
+        self.avisos = {
+            "limite": [
+                "😒 Oye, más despacio. No puedo pensar si me escribes tan rápido.",
+                "🙄 Respira. De uno en uno, que no soy una máquina... bueno, técnicamente sí.",
+                "😶 Me estás bombardeando. Espera un poco antes del siguiente."
+            ],
+            "espera": [
+                "⏳ Dame un momento... hay mucha gente hablándome a la vez.",
+                "⏳ Espera, estoy pensando. No me metas prisa.",
+                "⏳ Un segundo... se me acumulan las conversaciones."
+            ],
+            "saturada": [
+                "😵 Ahora mismo no doy abasto. Escríbeme otra vez en un rato.",
+                "😵 Demasiadas voces a la vez. Vuelve a intentarlo en un momento, ¿sí?",
+                "😵 Me he saturado. No es por ti... bueno, un poco sí. Prueba luego."
+            ]
         }
-        self.contador = 0
+        self.clasificador = ClasificadorAnimo()
+        self.edad = None
+        self.edad_valida_hasta = 0.0
+        # usuario_id -> EstadoHakari; el contador es el número de interacciones del usuario.
+        # Con varios procesos (compartida) no se guarda aquí: el ánimo se lee de la base de
+        # datos en cada mensaje para que ningún proceso siga con uno que otro ya cambió
+        self.compartida = compartida
+        self.por_usuario = CacheLRU(CACHE_PERFILES_MAX, CACHE_PERFILES_TTL)
     
     def calcular_edad(self):
-        hoy = date.today()
-        cumple = date(2007, 5, 1)
-        return hoy.year - cumple.year - ((hoy.month, hoy.day) < (cumple.month, cumple.day))
+        # La edad solo puede cambiar a medianoche: se calcula una vez al día
+        if time.time() >= self.edad_valida_hasta:
+            hoy = date.today()
+            cumple = date(2007, 5, 1)
+            self.edad = hoy.year - cumple.year - ((hoy.month, hoy.day) < (cumple.month, cumple.day))
+            self.edad_valida_hasta = datetime.combine(hoy + timedelta(days=1), datetime.min.time()).timestamp()
+        return self.edad
     
-    def actualizar_estado(self, mensaje: str):
-        self.contador += 1
-        mensaje = mensaje.lower()
+    def respuesta_predefinida(self, estado: EstadoHakari) -> str:
+        return random.choice(self.estados[estado.nombre]["respuestas"])
+    
+    def respuesta_aviso(self, tipo: str) -> str:
+        return random.choice(self.avisos[tipo])
+    
+    def obtener_estado(self, usuario_id: int) -> EstadoHakari:
+        if self.compartida:
+            return self.leer_estado(usuario_id)
+        estado = self.por_usuario.obtener(usuario_id)
+        if estado is None:
+            estado = self.leer_estado(usuario_id)
+            self.por_usuario.guardar(usuario_id, estado)
+        return estado
+    
+    @staticmethod
+    def leer_estado(usuario_id: int) -> EstadoHakari:
+        animo, interacciones = db.obtener_estado_hakari(usuario_id) or (Animo.TIMIDA, 0)
+        return EstadoHakari(Animo(animo), interacciones)
+    
+    def actualizar_estado(self, mensaje: str, usuario_id: int) -> EstadoHakari:
+        estado = self.obtener_estado(usuario_id)
+        estado.contador += 1
+        
+        animo = self.clasificador.clasificar(mensaje)
+        if animo is None:
+            animo = random.choice(ANIMOS) if random.random() < 0.3 else estado.animo
         
-        if any(palabra in mensaje for palabra in ['por qué', 'explica', 'razón']):
-            self.estado_actual = "defensiva"
-        elif any(palabra in mensaje for palabra in ['recuerd', 'antes', 'cuando']):
-            self.estado_actual = "nostálgica"
-        elif any(palabra in mensaje for palabra in ['interesante', 'cuéntame', 'sabes']):
-            self.estado_actual = "curiosa"
-        elif random.random() < 0.3:
-            self.estado_actual = random.choice(list(self.estados.keys()))
+        # Solo se persiste cuando el ánimo cambia
+        if animo != estado.animo:
+            estado.animo = animo
+            db.guardar_estado_hakari(usuario_id, int(animo))
         
-        return self.estado_actual
+        return estado
 
 hakari = PersonalidadHakari()
 
 # ==================== SISTEMA DE LOGROS ====================
+# Reglas declarativas: un logro depende de un umbral sobre una estadística
+# o de que el mensaje mencione alguna de sus palabras clave. Las palabras se comparan
+# enteras y sin distinguir mayúsculas: cada plural o variante va en la lista
+REGLAS_LOGROS = {
+    'primer_conversacion': {'stat': 'interacciones_totales', 'umbral': 1},
+    'confianza_50': {'stat': 'confianza', 'umbral': 50},
+    '10_interacciones': {'stat': 'interacciones_totales', 'umbral': 10},
+    'descubrir_anime': {'palabras': [
+        'otaku', 'otakus', 'shonen', 'shōnen', 'seinen', 'shojo', 'shōjo', 'ghibli', 'evangelion',
+        'death note', 'monogatari', 'mangaka', 'mangakas',
+        # "anime" y "manga" también son verbo ("que te anime") y prenda ("la manga"): solo
+        # cuentan con un determinante masculino o con el verbo con que se ven o se leen
+        'el anime', 'un anime', 'los animes', 'unos animes', 'ese anime', 'este anime', 'de anime',
+        'ver anime', 'veo anime', 'viendo anime',
+        'el manga', 'un manga', 'los mangas', 'unos mangas', 'ese manga', 'este manga',
+        'leer manga', 'leo manga', 'leyendo manga']}
+}
+
 class SistemaLogros:
     def __init__(self):
         self.logros_disponibles = {
@@ -281,143 +1903,852 @@ class SistemaLogros:
             '10_interacciones': {'nombre': '🎯 Conversador Persistente', 'descripcion': 'Completaste 10 interacciones con Hakari'},
             'descubrir_anime': {'nombre': '📺 Otaku en Desarrollo', 'descripcion': 'Hablaste sobre anime con Hakari'}
         }
+        self.bits = {logro_id: 1 << i for i, logro_id in enumerate(self.logros_disponibles)}
+        
+        # Reglas de umbral indexadas por estadística y ordenadas por umbral
+        self.reglas_por_stat = {}
+        # Todas las reglas de palabras clave en una sola expresión, un grupo por logro
+        self.grupos_palabras = {}
+        self.mascara_palabras = 0
+        alternativas = []
+        for logro_id, regla in REGLAS_LOGROS.items():
+            if 'stat' in regla:
+                self.reglas_por_stat.setdefault(regla['stat'], []).append((regla['umbral'], logro_id))
+            else:
+                grupo = f"r{len(self.grupos_palabras)}"
+                self.grupos_palabras[grupo] = logro_id
+                self.mascara_palabras |= self.bits[logro_id]
+                # Las frases admiten cualquier espacio entre sus palabras
+                frases = (r"\s+".join(map(re.escape, palabra.split())) for palabra in regla['palabras'])
+                alternativas.append(f"(?P<{grupo}>{'|'.join(frases)})")
+        for reglas in self.reglas_por_stat.values():
+            reglas.sort()
+        self.patron_palabras = re.compile(r"\b(?:" + "|".join(alternativas) + r")\b", re.IGNORECASE) if alternativas else None
+        
+        # usuario_id -> máscara de logros ya desbloqueados
+        self.desbloqueados = CacheLRU(CACHE_PERFILES_MAX, CACHE_PERFILES_TTL)
     
-    def verificar_logros(self, usuario_email: str, estadisticas: Dict):
-        logros_desbloqueados = []
+    def _mascara_usuario(self, usuario_id: int) -> int:
+        mascara = self.desbloqueados.obtener(usuario_id)
+        if mascara is not None:
+            return mascara
         
-        if estadisticas.get('interacciones_totales', 0) >= 1:
-            if db.registrar_logro(usuario_email, 'primer_conversacion', 
-                                self.logros_disponibles['primer_conversacion']['nombre'],
-                                self.logros_disponibles['primer_conversacion']['descripcion']):
-                logros_desbloqueados.append('primer_conversacion')
+        mascara = 0
+        self.desbloqueados.iniciar_carga(usuario_id)
+        try:
+            for logro_id in db.obtener_ids_logros(usuario_id):
+                mascara |= self.bits.get(logro_id, 0)
+        finally:
+            self.desbloqueados.terminar_carga(usuario_id, mascara)
+        return mascara
+    
+    def verificar_logros(self, usuario_id: int, estadisticas: Dict, mensaje: str = ""):
+        # Solo toca la base de datos cuando una regla sin desbloquear cruza su umbral
+        mascara = self._mascara_usuario(usuario_id)
+        candidatos = []
         
-        if estadisticas.get('confianza', 0) >= 50:
-            if db.registrar_logro(usuario_email, 'confianza_50',
-                                self.logros_disponibles['confianza_50']['nombre'],
-                                self.logros_disponibles['confianza_50']['descripcion']):
-                logros_desbloqueados.append('confianza_50')
+        for stat, reglas in self.reglas_por_stat.items():
+            valor = estadisticas.get(stat, 0)
+            for umbral, logro_id in reglas:
+                if valor < umbral:
+                    break
+                if not mascara & self.bits[logro_id]:
+                    candidatos.append(logro_id)
         
-        if estadisticas.get('interacciones_totales', 0) >= 10:
-            if db.registrar_logro(usuario_email, '10_interacciones',
-                                self.logros_disponibles['10_interacciones']['nombre'],
-                                self.logros_disponibles['10_interacciones']['descripcion']):
-                logros_desbloqueados.append('10_interacciones')
+        if mensaje and self.patron_palabras and self.mascara_palabras & ~mascara:
+            for coincidencia in self.patron_palabras.finditer(mensaje):
+                logro_id = self.grupos_palabras[coincidencia.lastgroup]
+                if not mascara & self.bits[logro_id] and logro_id not in candidatos:
+                    candidatos.append(logro_id)
+        
+        logros_desbloqueados = []
+        nuevos_bits = 0
+        for logro_id in candidatos:
+            logro = self.logros_disponibles[logro_id]
+            if db.registrar_logro(usuario_id, logro_id, logro['nombre'], logro['descripcion']):
+                logros_desbloqueados.append(logro_id)
+            # Si ya existía, igualmente queda marcado para no volver a comprobarlo
+            nuevos_bits |= self.bits[logro_id]
+        
+        if nuevos_bits:
+            self.desbloqueados.modificar(usuario_id, lambda actual: actual | nuevos_bits)
         
         return logros_desbloqueados
 
 sistema_logros = SistemaLogros()
 
+# ==================== LÍMITES DE USO ====================
+# Cubo de tokens: admite ráfagas de hasta `rafaga` y se rellena a `ritmo` tokens por segundo
+class CuboTokens:
+    __slots__ = ('ritmo', 'rafaga', 'tokens', 'ultimo')
+    
+    def __init__(self, ritmo: float, rafaga: int):
+        self.ritmo = ritmo
+        self.rafaga = rafaga
+        self.tokens = float(rafaga)
+        self.ultimo = time.monotonic()
+    
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self.tokens = min(self.rafaga, self.tokens + (ahora - self.ultimo) * self.ritmo)
+        self.ultimo = ahora
+    
+    def tomar(self) -> bool:
+        self._rellenar()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def espera(self) -> float:
+        # Segundos hasta que haya un token entero
+        self._rellenar()
+        return max(0.0, (1 - self.tokens) / self.ritmo)
+
+# Mensajes por usuario: un cubo por usuario_id, los menos recientes se descartan
+# (tras `rafaga / ritmo` segundos sin escribir un cubo ya estaría lleno de todos modos)
+class LimitadorUsuarios:
+    def __init__(self, ritmo: float = LIMITE_USUARIO_RITMO, rafaga: int = LIMITE_USUARIO_RAFAGA,
+                 max_usuarios: int = CACHE_PERFILES_MAX):
+        self.activo = ritmo > 0
+        self.ritmo = ritmo
+        self.rafaga = rafaga
+        self.max_usuarios = max_usuarios
+        self.cubos = OrderedDict()  # usuario_id -> CuboTokens
+        self.lock = threading.Lock()
+        self.rechazados = 0
+    
+    def permitir(self, usuario_id: int) -> bool:
+        if not self.activo:
+            return True
+        with self.lock:
+            cubo = self.cubos.get(usuario_id)
+            if cubo is None:
+                cubo = self.cubos[usuario_id] = CuboTokens(self.ritmo, self.rafaga)
+                while len(self.cubos) > self.max_usuarios:
+                    self.cubos.popitem(last=False)
+            else:
+                self.cubos.move_to_end(usuario_id)
+            if cubo.tomar():
+                return True
+            self.rechazados += 1
+            return False
+
+# Presupuesto global de llamadas al modelo. Con tokens y nadie esperando, la llamada pasa
+# sin más; si no, espera en la cola de su usuario y el despachador concede los tokens por
+# turno rotatorio entre usuarios, así que quien envía muchos mensajes no deja sin turno
+# al resto. Vive en el bucle de eventos de Gradio: no necesita locks
+class PlanificadorModelo:
+    def __init__(self, ritmo: float = LIMITE_GLOBAL_RITMO, rafaga: int = LIMITE_GLOBAL_RAFAGA,
+                 espera_max: float = LIMITE_ESPERA_MAX, pendientes_usuario: int = LIMITE_PENDIENTES_USUARIO):
+        self.activo = ritmo > 0
+        self.cubo = CuboTokens(ritmo, rafaga) if self.activo else None
+        self.espera_max = espera_max
+        self.pendientes_usuario = pendientes_usuario
+        self.colas = OrderedDict()  # usuario_id -> deque de futuros, en orden de turno
+        self.despachador = None
+        self.inmediatas = 0
+        self.encoladas = 0
+        self.rechazadas = 0
+        self.caducadas = 0
+    
+    def intentar(self) -> bool:
+        if not self.activo:
+            return True
+        if not self.colas and self.cubo.tomar():
+            self.inmediatas += 1
+            return True
+        return False
+    
+    def encolar(self, usuario_id: int) -> Optional[asyncio.Future]:
+        # None si el usuario ya tiene todas sus llamadas permitidas esperando
+        cola = self.colas.get(usuario_id)
+        if cola is not None and sum(not futuro.done() for futuro in cola) >= self.pendientes_usuario:
+            self.rechazadas += 1
+            return None
+        
+        futuro = asyncio.get_running_loop().create_future()
+        self.colas.setdefault(usuario_id, deque()).append(futuro)
+        self.encoladas += 1
+        if self.despachador is None or self.despachador.done():
+            self.despachador = asyncio.create_task(self._despachar())
+        return futuro
+    
+    async def esperar(self, futuro: asyncio.Future) -> bool:
+        try:
+            await asyncio.wait_for(futuro, self.espera_max)
+            return True
+        except asyncio.TimeoutError:
+            self.caducadas += 1
+            return False
+    
+    async def _despachar(self):
+        while self.colas:
+            espera = self.cubo.espera()
+            if espera > 0:
+                await asyncio.sleep(espera)
+                continue
+            
+            usuario_id, cola = self.colas.popitem(last=False)
+            while cola and cola[0].done():  # caducados mientras esperaban
+                cola.popleft()
+            if not cola:
+                continue
+            self.cubo.tomar()
+            cola.popleft().set_result(True)
+            if cola:
+                self.colas[usuario_id] = cola  # vuelve al final: le toca después de los demás
+    
+    def en_espera(self) -> int:
+        return sum(not futuro.done() for cola in self.colas.values() for futuro in cola)
+
+limitador_usuarios = LimitadorUsuarios()
+planificador_modelo = PlanificadorModelo()
+
 # ==================== MOTOR DE CONVERSACIÓN ====================
 system_prompt = "ERES HAKARI - una chica de 18 años compleja y real. Eres tímida pero con momentos de claridad intelectual. Usas humor seco y negro como mecanismo de defensa. Te gusta el anime psicológico, la música alternativa y leer. Eres impredecible: puedes pasar de emocional a fría en segundos. Responde máximo 2-3 oraciones. Sé natural, auténtica, no demasiado amable."
 
-try:
-    chat = client.chats.create(
-        model="gemini-2.0-flash",
-        config=types.GenerateContentConfig(
-            system_instruction=system_prompt,
+prompt_resumen = "Resume en español, en tercera persona y en máximo {palabras} palabras, lo que Hakari sabe del usuario por estas conversaciones: gustos, datos personales y temas importantes. Integra el resumen previo si lo hay. Responde solo con el resumen."
+
+def estimar_tokens(texto: str) -> int:
+    # Aproximación sin tokenizador local: ~4 caracteres por token
+    return len(texto) // 4 + 1
+
+# Contexto de un usuario: turnos recientes dentro del presupuesto y un resumen
+# acumulado de los turnos más antiguos que ya no caben
+class ContextoUsuario:
+    __slots__ = ('usuario_id', 'turnos', 'tokens_turnos', 'resumen', 'desbordados', 'resumiendo')
+    
+    def __init__(self, usuario_id: int, resumen: str = ""):
+        self.usuario_id = usuario_id
+        self.turnos = deque()  # (mensaje_usuario, mensaje_hakari, tokens)
+        self.tokens_turnos = 0
+        self.resumen = resumen
+        self.desbordados = []  # turnos expulsados de la ventana, aún sin resumir
+        self.resumiendo = False
+    
+    def instruccion_sistema(self, generico: bool = False) -> str:
+        if generico or not self.resumen:
+            return system_prompt
+        return f"{system_prompt}\n\nLo que recuerdas de conversaciones anteriores con este usuario: {self.resumen}"
+    
+    def presupuesto_turnos(self, presupuesto: int = PROMPT_TOKENS) -> int:
+        return presupuesto - estimar_tokens(self.instruccion_sistema())
+    
+    def agregar(self, mensaje_usuario: str, mensaje_hakari: str) -> bool:
+        # Devuelve True si la ventana se desbordó y hay turnos pendientes de resumir
+        tokens = estimar_tokens(mensaje_usuario) + estimar_tokens(mensaje_hakari)
+        self.turnos.append((mensaje_usuario, mensaje_hakari, tokens))
+        self.tokens_turnos += tokens
+        
+        # Al desbordarse se recorta hasta 3/4 del presupuesto, para que el resumen
+        # se recalcule cada varios turnos y no en cada mensaje
+        presupuesto = self.presupuesto_turnos()
+        if self.tokens_turnos <= presupuesto:
+            return bool(self.desbordados)
+        while len(self.turnos) > 1 and self.tokens_turnos > presupuesto * 3 // 4:
+            antiguo = self.turnos.popleft()
+            self.tokens_turnos -= antiguo[2]
+            self.desbordados.append(antiguo)
+        return bool(self.desbordados)
+    
+    def contenidos(self, mensaje: str, generico: bool = False) -> List["types.Content"]:
+        # generico: solo el mensaje, sin los turnos del usuario
+        from google.genai import types
+        
+        # Los turnos más recientes que caben junto al mensaje nuevo, en orden cronológico
+        disponible = self.presupuesto_turnos() - estimar_tokens(mensaje)
+        seleccion = []
+        for mensaje_usuario, mensaje_hakari, tokens in () if generico else reversed(self.turnos):
+            if tokens > disponible:
+                break
+            disponible -= tokens
+            seleccion.append((mensaje_usuario, mensaje_hakari))
+        
+        contenidos = []
+        for mensaje_usuario, mensaje_hakari in reversed(seleccion):
+            contenidos.append(types.Content(role="user", parts=[types.Part(text=mensaje_usuario)]))
+            contenidos.append(types.Content(role="model", parts=[types.Part(text=mensaje_hakari)]))
+        contenidos.append(types.Content(role="user", parts=[types.Part(text=f"Responde breve y natural: {mensaje}")]))
+        return contenidos
+    
+    def configuracion(self, generico: bool = False) -> "types.GenerateContentConfig":
+        from google.genai import types
+        
+        return types.GenerateContentConfig(
+            system_instruction=self.instruccion_sistema(generico),
             temperature=0.8,
             max_output_tokens=150
         )
-    )
-except Exception as e:
-    print(f"Error inicializando Gemini: {e}")
-    chat = None
 
-def generar_respuesta_simple(mensaje: str, usuario_email: str, sesion_id: str) -> str:
-    # Actualizar estado de Hakari
-    estado = hakari.actualizar_estado(mensaje)
+# Un contexto por usuario, creado bajo demanda y expulsado por LRU/inactividad
+class PoolContextos:
+    def __init__(self, max_sesiones: int = CHAT_POOL_MAX, ttl: int = CHAT_POOL_TTL,
+                 turnos_semilla: int = CHAT_TURNOS_SEMILLA):
+        self.max_sesiones = max_sesiones
+        self.ttl = ttl
+        self.turnos_semilla = turnos_semilla
+        self.sesiones = OrderedDict()  # usuario_id -> [contexto, ultimo_uso]
+        self.lock = threading.Lock()
     
-    # Actualizar estadísticas del usuario
-    db.actualizar_estadisticas(usuario_email)
+    def _crear_contexto(self, usuario_id: int) -> ContextoUsuario:
+        # Sembrar con el resumen guardado y el historial reciente que quepa en el presupuesto
+        contexto = ContextoUsuario(usuario_id, db.obtener_resumen(usuario_id))
+        for mensaje_usuario, mensaje_hakari in db.obtener_ultimas_conversaciones(usuario_id, limite=self.turnos_semilla):
+            contexto.agregar(mensaje_usuario, mensaje_hakari)
+        # Lo que no cabe ya estaba resumido o se pierde; no se vuelve a resumir al sembrar
+        contexto.desbordados.clear()
+        return contexto
     
-    # Verificar logros
-    datos_usuario = db.obtener_datos_usuario(usuario_email)
-    if datos_usuario:
-        sistema_logros.verificar_logros(usuario_email, datos_usuario)
+    def _purgar(self, ahora: float):
+        # Las entradas están ordenadas de menos a más reciente
+        while self.sesiones:
+            usuario_id, (_, ultimo_uso) = next(iter(self.sesiones.items()))
+            if len(self.sesiones) <= self.max_sesiones and ahora - ultimo_uso < self.ttl:
+                break
+            del self.sesiones[usuario_id]
     
-    try:
-        if not chat:
-            return "⚠️ El sistema de IA no está disponible en este momento. ¿Podemos hablar igual?"
+    def obtener(self, usuario_id: int) -> Optional[ContextoUsuario]:
+        ahora = time.monotonic()
+        with self.lock:
+            entrada = self.sesiones.get(usuario_id)
+            if entrada and ahora - entrada[1] < self.ttl:
+                entrada[1] = ahora
+                self.sesiones.move_to_end(usuario_id)
+                return entrada[0]
         
-        respuesta = chat.send_message(f"Responde breve y natural: {mensaje}")
-        texto_respuesta = respuesta.text
+        try:
+            nuevo_contexto = self._crear_contexto(usuario_id)
+        except Exception as e:
+            registrar_error("error_cargando_contexto", e, usuario_id=usuario_id)
+            return None
         
-        # Guardar conversación
-        db.guardar_conversacion(usuario_email, mensaje, texto_respuesta, estado)
+        with self.lock:
+            # Otra petición del mismo usuario pudo crearlo mientras tanto
+            entrada = self.sesiones.get(usuario_id)
+            if entrada and ahora - entrada[1] < self.ttl:
+                nuevo_contexto = entrada[0]
+            self.sesiones[usuario_id] = [nuevo_contexto, ahora]
+            self.sesiones.move_to_end(usuario_id)
+            self._purgar(ahora)
+        
+        return nuevo_contexto
+    
+    def descartar(self, usuario_id: int):
+        with self.lock:
+            self.sesiones.pop(usuario_id, None)
+
+pool_contextos = PoolContextos()
+
+# Referencias a las tareas en segundo plano para que no las recoja el recolector
+tareas_fondo = set()
+
+# Respuestas del modelo a saludos y frases hechas, por texto normalizado y ánimo. Solo se
+# cachean las frases de `frases`, y su respuesta se genera sin el resumen ni los turnos del
+# usuario (ContextoUsuario con generico=True): no depende de quién escribe y se comparte entre
+# todos. Una clave se sirve desde caché cuando ya tiene `variantes` respuestas distintas
+class CacheRespuestas:
+    RE_SIMBOLOS = re.compile(r"[^a-z0-9 ]+")
+    RE_REPETIDAS = re.compile(r"(.)\1{2,}")
+    
+    def __init__(self, activa: bool = CACHE_RESPUESTAS, max_entradas: int = CACHE_RESPUESTAS_MAX,
+                 ttl: int = CACHE_RESPUESTAS_TTL, longitud_maxima: int = CACHE_RESPUESTAS_LONGITUD,
+                 variantes: int = CACHE_RESPUESTAS_VARIANTES, frases: str = CACHE_RESPUESTAS_FRASES):
+        self.activa = activa
+        self.longitud_maxima = longitud_maxima
+        self.variantes = variantes
+        self.frases = frozenset(self.normalizar(frase) for frase in frases.split(",") if frase.strip())
+        self.cache = CacheLRU(max_entradas, ttl)  # (texto, ánimo) -> (respuesta, ...)
+        self.lock = threading.Lock()
+        self.mensajes = 0  # todos los mensajes vistos con la caché activa, cacheables o no
+        self.aciertos = 0
+        self.fallos = 0
+        self.llamadas_medidas = 0
+        self.latencia_media = 0.0
+        self.latencia_ahorrada = 0.0
+    
+    @classmethod
+    def normalizar(cls, mensaje: str) -> str:
+        # "¡¡Holaaa!!" -> "hola"
+        texto = cls.RE_SIMBOLOS.sub(" ", normalizar_texto(mensaje))
+        return " ".join(cls.RE_REPETIDAS.sub(r"\1", texto).split())
+    
+    def clave(self, mensaje: str, animo: Animo) -> Optional[tuple]:
+        # None si el mensaje no es una de las frases cacheables
+        if not self.activa:
+            return None
+        self.mensajes += 1
+        if len(mensaje) > self.longitud_maxima:
+            return None
+        texto = self.normalizar(mensaje)
+        return (texto, int(animo)) if texto in self.frases else None
+    
+    def obtener(self, clave: tuple) -> Optional[str]:
+        variantes = self.cache.obtener(clave)
+        with self.lock:
+            if variantes and len(variantes) >= self.variantes:
+                self.aciertos += 1
+                self.latencia_ahorrada += self.latencia_media
+                return random.choice(variantes)
+            self.fallos += 1
+            return None
+    
+    def guardar(self, clave: tuple, respuesta: str, latencia: float):
+        with self.lock:
+            self.llamadas_medidas += 1
+            self.latencia_media += (latencia - self.latencia_media) / self.llamadas_medidas
+            variantes = self.cache.obtener(clave) or ()
+            if len(variantes) < self.variantes and respuesta not in variantes:
+                self.cache.guardar(clave, variantes + (respuesta,))
+    
+    def estadisticas(self) -> Dict:
+        with self.lock:
+            total = self.aciertos + self.fallos
+            return {
+                'activa': self.activa,
+                'entradas': len(self.cache.datos),
+                'mensajes': self.mensajes,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                # Aciertos entre las frases cacheables y entre todos los mensajes: la segunda es
+                # la fracción de llamadas al modelo que se ahorra
+                'tasa_aciertos': round(self.aciertos / total, 3) if total else 0.0,
+                'tasa_aciertos_mensajes': round(self.aciertos / self.mensajes, 3) if self.mensajes else 0.0,
+                'latencia_media_s': round(self.latencia_media, 3),
+                'latencia_ahorrada_s': round(self.latencia_ahorrada, 3)
+            }
+
+cache_respuestas = CacheRespuestas()
+
+# Las escrituras en SQLite se serializan en un único hilo fuera del camino de respuesta
+executor_db = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hakari-db")
+
+def registrar_interaccion(usuario_id: int, mensaje: str):
+    # Actualizar estadísticas del usuario
+    with metricas.etapa('estadisticas'):
+        db.actualizar_estadisticas(usuario_id)
+    
+    # Verificar logros
+    with metricas.etapa('logros'):
+        datos_usuario = db.obtener_datos_usuario_por_id(usuario_id)
+        if datos_usuario:
+            sistema_logros.verificar_logros(usuario_id, datos_usuario, mensaje)
+
+def guardar_turno(usuario_id: int, mensaje: str, respuesta: str, estado_emocional: str,
+                  id_turno: Optional[IdTurno] = None):
+    with metricas.etapa('guardado'):
+        db.guardar_conversacion(usuario_id, mensaje, respuesta, estado_emocional, id_turno)
+
+async def resumir_desbordados(contexto: ContextoUsuario):
+    # Pliega en el resumen los turnos que salieron de la ventana. Solo se lanza
+    # cuando la ventana se desborda y nunca hay dos a la vez para el mismo usuario
+    # Cede el presupuesto del modelo a los mensajes que esperan; se reintenta en el próximo turno
+    if contexto.resumiendo or not contexto.desbordados or not planificador_modelo.intentar():
+        return
+    contexto.resumiendo = True
+    turnos = contexto.desbordados[:]
+    try:
+        from google.genai import types
         
-        return texto_respuesta
+        transcripcion = "\n".join(f"Usuario: {u}\nHakari: {h}" for u, h, _ in turnos)
+        previo = f"Resumen previo: {contexto.resumen}\n\n" if contexto.resumen else ""
+        respuesta = await gemini.generar(
+            model=CHAT_MODELO,
+            contents=f"{previo}Conversaciones nuevas:\n{transcripcion}",
+            config=types.GenerateContentConfig(
+                system_instruction=prompt_resumen.format(palabras=RESUMEN_TOKENS * 3 // 4),
+                temperature=0.2,
+                max_output_tokens=RESUMEN_TOKENS
+            )
+        )
+        if respuesta.text:
+            contexto.resumen = respuesta.text.strip()
+            del contexto.desbordados[:len(turnos)]
+            executor_db.submit(db.guardar_resumen, contexto.usuario_id, contexto.resumen)
+    except Exception as e:
+        registrar_error("error_resumiendo_historial", e, usuario_id=contexto.usuario_id)
+        # Si el modelo sigue fallando, no acumular turnos sin límite
+        del contexto.desbordados[:-CHAT_TURNOS_SEMILLA]
+    finally:
+        contexto.resumiendo = False
+
+async def preparar_turno(mensaje: str, usuario_id: int) -> Optional[EstadoHakari]:
+    # Límite por usuario y ánimo de Hakari tras el mensaje; None si el mensaje se limita.
+    # El ánimo puede leerse de la base de datos (siempre, con varios procesos): fuera del
+    # bucle de eventos, para no parar las demás respuestas mientras se confirma un lote
+    if not limitador_usuarios.permitir(usuario_id):
+        metricas.contar('hakari_turnos_total', resultado='limitado')
+        return None
+    
+    with metricas.etapa('animo'):
+        estado = await asyncio.to_thread(hakari.actualizar_estado, mensaje, usuario_id)
+    executor_db.submit(registrar_interaccion, usuario_id, mensaje)
+    return estado
+
+async def generar_respuesta_simple(mensaje: str, usuario_id: int, sesion_id: str, estado: EstadoHakari,
+                                   id_turno: Optional[IdTurno] = None):
+    # Genera el texto acumulado de la respuesta a medida que llega del modelo; estado es el
+    # de preparar_turno. Si se guarda el turno, id_turno queda marcado como guardado y recibe
+    # su id al confirmarse
+    texto_respuesta = ""
+    try:
+        contexto = await asyncio.to_thread(pool_contextos.obtener, usuario_id)
+        if not contexto:
+            metricas.contar('hakari_turnos_total', resultado='sin_contexto')
+            yield hakari.respuesta_predefinida(estado)
+            return
         
+        clave_cache = cache_respuestas.clave(mensaje, estado.animo)
+        texto_cache = cache_respuestas.obtener(clave_cache) if clave_cache else None
+        if texto_cache:
+            texto_respuesta = texto_cache
+            metricas.contar('hakari_turnos_total', resultado='cache')
+            yield texto_respuesta
+        else:
+            if not planificador_modelo.intentar():
+                # Aviso inmediato mientras espera turno; la respuesta lo reemplaza al llegar
+                futuro = planificador_modelo.encolar(usuario_id)
+                if futuro is not None:
+                    yield hakari.respuesta_aviso("espera")
+                if futuro is None or not await planificador_modelo.esperar(futuro):
+                    metricas.contar('hakari_turnos_total', resultado='saturado')
+                    yield hakari.respuesta_aviso("saturada")
+                    return
+            
+            inicio = time.monotonic()
+            # Una respuesta que va a la caché no puede depender del usuario
+            generico = clave_cache is not None
+            async for fragmento in gemini.generar_flujo(
+                model=CHAT_MODELO,
+                contents=contexto.contenidos(mensaje, generico),
+                config=contexto.configuracion(generico)
+            ):
+                if not texto_respuesta:
+                    metricas.observar('hakari_etapa_segundos', time.monotonic() - inicio, etapa='modelo_primer_fragmento')
+                texto_respuesta += fragmento
+                yield texto_respuesta
+            metricas.observar('hakari_etapa_segundos', time.monotonic() - inicio, etapa='modelo')
+            metricas.contar('hakari_turnos_total', resultado='modelo')
+            if clave_cache and texto_respuesta:
+                cache_respuestas.guardar(clave_cache, texto_respuesta, time.monotonic() - inicio)
     except Exception as e:
-        print(f"Error generando respuesta: {e}")
-        return "💫 Mis pensamientos están dispersos hoy... ¿podemos intentarlo de nuevo?"
+        metricas.contar('hakari_modelo_errores_total', tipo=type(e).__name__)
+        metricas.contar('hakari_turnos_total', resultado='error')
+        registrar_error("error_generando_respuesta", e, usuario_id=usuario_id)
+        yield hakari.respuesta_predefinida(estado)
+        return
+    
+    # Guardar conversación; se marca ya porque la escritura se encola en otro hilo
+    if id_turno is not None:
+        id_turno.guardado = True
+    executor_db.submit(guardar_turno, usuario_id, mensaje, texto_respuesta, estado.nombre, id_turno)
+    if contexto.agregar(mensaje, texto_respuesta):
+        tarea = asyncio.create_task(resumir_desbordados(contexto))
+        tareas_fondo.add(tarea)
+        tarea.add_done_callback(tareas_fondo.discard)
 
 # ==================== INTERFAZ GRADIO ====================
-def obtener_panel_estado():
-    estado_info = hakari.estados[hakari.estado_actual]
-    return f"""
-    <div style="text-align: center; padding: 15px; background: rgba(236, 72, 153, 0.1); border: 2px solid {estado_info['color']}; border-radius: 12px;">
-        <div style="font-size: 28px; margin-bottom: 8px;">{estado_info['emoji']}</div>
-        <div style="font-weight: bold; color: {estado_info['color']}; margin-bottom: 5px; font-size: 16px;">
-            {hakari.estado_actual.title()}
+# Plantillas de los paneles: las partes fijas se formatean una vez y en cada mensaje
+# solo se insertan los valores que cambian
+PLANTILLA_PANEL_ESTADO = """
+    <div style="text-align: center; padding: 15px; background: rgba(236, 72, 153, 0.1); border: 2px solid {color}; border-radius: 12px;">
+        <div style="font-size: 28px; margin-bottom: 8px;">{emoji}</div>
+        <div style="font-weight: bold; color: {color}; margin-bottom: 5px; font-size: 16px;">
+            {titulo}
         </div>
-        <div style="font-size: 12px; color: #e5e7eb; margin-bottom: 8px;">{estado_info['desc']}</div>
+        <div style="font-size: 12px; color: #e5e7eb; margin-bottom: 8px;">{desc}</div>
         <div style="font-size: 10px; color: #6b7280;">
-            Edad: {hakari.calcular_edad()} años | Interacciones: {hakari.contador}
+            Edad: {edad} años | Interacciones: {contador}
         </div>
     </div>
     """
 
-def obtener_panel_usuario(sesion_id: str):
-    if not sesion_id or not sistema_auth.verificar_sesion(sesion_id):
-        return """
+PLANTILLA_PANEL_USUARIO = """
+    <div style="background: rgba(236, 72, 153, 0.1); padding: 15px; border-radius: 10px; border: 1px solid #ec4899;">
+        <div style="font-weight: bold; color: #ec4899; font-size: 14px;">👤 {nombre}</div>
+        <div style="font-size: 11px; color: #e5e7eb; margin: 5px 0;">{email}</div>
+        
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 5px; font-size: 10px; color: #9ca3af; margin: 8px 0;">
+            <div>
+                <strong>Confianza:</strong><br>
+                <div style="background: #374151; border-radius: 3px; overflow: hidden;">
+                    <div style="background: #ec4899; width: {confianza}%; height: 6px;"></div>
+                </div>
+                {confianza}%
+            </div>
+            <div>
+                <strong>Interacciones:</strong><br>
+                {interacciones}
+            </div>
+        </div>
+        {actividad}
+        {logros}
+    </div>
+    """
+
+PLANTILLA_LOGROS = """
+        <div style="margin-top: 10px; padding-top: 10px; border-top: 1px solid #4b5563;">
+            <div style="font-size: 11px; color: #9ca3af; margin-bottom: 5px;"><strong>Logros:</strong></div>
+            <div style="font-size: 10px; color: #d946ef;">{logros}</div>
+        </div>
+        """
+
+PLANTILLA_ACTIVIDAD = """
+        <div style="font-size: 10px; color: #9ca3af; margin: 4px 0;">
+            🔥 Racha: {racha} días · 📅 Días activos: {dias_activos} · Ánimo frecuente: {animo}
+        </div>
+        """
+
+PLANTILLA_PANEL_AVISO = """
         <div style="background: #374151; padding: 15px; border-radius: 10px; text-align: center; border: 1px solid #ec4899;">
-            <div style="font-weight: bold; color: #e5e7eb;">👤 No has iniciado sesión</div>
+            <div style="font-weight: bold; color: #e5e7eb;">👤 {aviso}</div>
         </div>
         """
+
+PANEL_SIN_SESION = PLANTILLA_PANEL_AVISO.format(aviso="No has iniciado sesión")
+PANEL_ERROR_USUARIO = PLANTILLA_PANEL_AVISO.format(aviso="Error al cargar datos")
+
+# Los cinco paneles de ánimo ya renderizados para la edad actual, partidos por el contador
+paneles_estado = {'edad': None}  # 'edad' -> edad renderizada; Animo -> (antes, después)
+
+def obtener_panel_estado(estado: Optional[EstadoHakari] = None):
+    estado = estado or EstadoHakari()
+    edad = hakari.calcular_edad()
+    if paneles_estado['edad'] != edad:
+        for animo in ANIMOS:
+            estado_info = hakari.estados[NOMBRES_ANIMO[animo]]
+            html = PLANTILLA_PANEL_ESTADO.format(color=estado_info['color'], emoji=estado_info['emoji'],
+                                                 titulo=NOMBRES_ANIMO[animo].title(), desc=estado_info['desc'],
+                                                 edad=edad, contador="\0")
+            paneles_estado[animo] = tuple(html.split("\0"))
+        paneles_estado['edad'] = edad
+    antes, despues = paneles_estado[estado.animo]
+    return f"{antes}{estado.contador}{despues}"
+
+# Último panel de perfil por usuario con los datos con que se generó: solo se vuelve
+# a renderizar cuando cambian las estadísticas o los logros
+paneles_usuario = CacheLRU(CACHE_PERFILES_MAX, CACHE_PERFILES_TTL)  # usuario_id -> (datos, html)
+
+def obtener_panel_usuario(sesion_id: str):
+    with metricas.etapa('panel_usuario'):
+        return renderizar_panel_usuario(sesion_id)
+
+def renderizar_panel_usuario(sesion_id: str):
+    if not sesion_id or not sistema_auth.verificar_sesion(sesion_id):
+        return PANEL_SIN_SESION
     
     datos_sesion = sistema_auth.obtener_datos_sesion(sesion_id)
-    datos_usuario = db.obtener_datos_usuario(datos_sesion['email'])
+    usuario_id = datos_sesion['usuario_id']
+    datos_usuario = db.obtener_datos_usuario_por_id(usuario_id)
     
     if not datos_usuario:
-        return """
-        <div style="background: #374151; padding: 15px; border-radius: 10px; text-align: center; border: 1px solid #ec4899;">
-            <div style="font-weight: bold; color: #e5e7eb;">👤 Error al cargar datos</div>
-        </div>
-        """
+        return PANEL_ERROR_USUARIO
     
     # Obtener logros
-    logros = db.obtener_logros_usuario(datos_sesion['email'])
+    logros = db.obtener_logros_usuario(usuario_id)
     
-    logros_html = ""
-    if logros:
-        logros_html = f"""
-        <div style="margin-top: 10px; padding-top: 10px; border-top: 1px solid #4b5563;">
-            <div style="font-size: 11px; color: #9ca3af; margin-bottom: 5px;"><strong>Logros:</strong></div>
-            <div style="font-size: 10px; color: #d946ef;">{' • '.join(logros)}</div>
+    # Resumen de actividad: una fila de actividad_usuarios, sin leer conversaciones
+    actividad = db.obtener_actividad(usuario_id, dias=0)
+    resumen_actividad = None
+    if actividad and actividad['mensajes']:
+        resumen_actividad = (actividad['racha_actual'], actividad['dias_activos'], actividad['animo_frecuente'])
+    
+    datos = (datos_usuario['nombre'], datos_sesion['email'], datos_usuario['confianza'],
+             datos_usuario['interacciones_totales'], tuple(logros), resumen_actividad)
+    previo = paneles_usuario.obtener(usuario_id)
+    if previo is not None and previo[0] == datos:
+        return previo[1]
+    
+    html = PLANTILLA_PANEL_USUARIO.format(
+        nombre=datos_usuario['nombre'],
+        email=datos_sesion['email'],
+        confianza=datos_usuario['confianza'],
+        interacciones=datos_usuario['interacciones_totales'],
+        actividad=PLANTILLA_ACTIVIDAD.format(
+            racha=resumen_actividad[0], dias_activos=resumen_actividad[1],
+            animo=f"{hakari.estados[resumen_actividad[2]]['emoji']} {resumen_actividad[2]}" if resumen_actividad[2] else "—"
+        ) if resumen_actividad else "",
+        logros=PLANTILLA_LOGROS.format(logros=' • '.join(logros)) if logros else ""
+    )
+    paneles_usuario.guardar(usuario_id, (datos, html))
+    return html
+
+# ==================== MANEJADORES ====================
+# Copia en el servidor de lo que muestra el chat de una pestaña. Vive en un gr.State,
+# que nunca se envía al navegador
+class HistorialChat:
+    __slots__ = ('turnos', 'ids', 'cursor')
+    
+    def __init__(self, turnos: Optional[List[List[str]]] = None, ids: Optional[List[IdTurno]] = None,
+                 cursor: Optional[int] = None):
+        self.turnos = turnos if turnos is not None else []
+        self.ids = ids if ids is not None else []  # IdTurno de cada turno de `turnos`
+        self.cursor = cursor  # "cargar anteriores" muestra los turnos guardados con id < cursor
+    
+    def en_cola(self, cantidad: int) -> bool:
+        # Si alguno de los `cantidad` turnos más antiguos aún no tiene id
+        return any(id_turno.en_cola for id_turno in self.ids[:cantidad])
+    
+    def quitar_antiguos(self, cantidad: int):
+        # El cursor pasa detrás del más reciente de los quitados que se guardó, para que
+        # "cargar anteriores" los recupere; los avisos nunca se guardaron y no cuentan
+        for id_turno in reversed(self.ids[:cantidad]):
+            if id_turno.id is not None:
+                self.cursor = id_turno.id + 1
+                break
+        del self.turnos[:cantidad]
+        del self.ids[:cantidad]
+
+# Se ejecuta en el navegador con cada turno que llega de handle_chat: el primer fragmento
+# de un mensaje añade el turno y los siguientes (mismo id) lo reemplazan en su sitio, aunque
+# entretanto hayan llegado otros turnos (un aviso de espera y después otro mensaje).
+# window.hakariTurnos guarda los ids de los últimos turnos añadidos, alineados con el final
+# del chat; si el turno ya no está en el chat (se limpió), se descarta como en el servidor
+JS_AGREGAR_TURNO = """
+(nuevo, chat) => {
+    if (!nuevo) return chat;
+    chat = (chat || []).slice();
+    const ids = window.hakariTurnos = window.hakariTurnos || [];
+    const i = ids.lastIndexOf(nuevo.n);
+    if (i < 0) {
+        ids.push(nuevo.n);
+        chat.push(nuevo.turno);
+    } else {
+        const posicion = chat.length - (ids.length - i);
+        if (posicion < 0) return chat;
+        chat[posicion] = nuevo.turno;
+    }
+    ids.splice(0, Math.max(ids.length - %d, 0));
+    return chat.slice(-%d);
+}
+""" % (HISTORIAL_MAX, HISTORIAL_MAX)
+
+# Un chat nuevo (registro o inicio de sesión) no comparte turnos con el anterior
+JS_REINICIAR_TURNOS = "() => { window.hakariTurnos = []; }"
+
+def handle_registro(nombre: str, email: str):
+    if not nombre or not email:
+        return "❌ Completa ambos campos", None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), [], None, gr.update(visible=False)
+    
+    success, resultado = sistema_auth.registrar_usuario(email, nombre)
+    if success:
+        # Cargar historial vacío para nuevo usuario
+        historial = []
+        
+        mensaje_bienvenida = f"""
+        <div style="background: linear-gradient(135deg, rgba(236, 72, 153, 0.2), rgba(168, 85, 247, 0.2)); padding: 25px; border-radius: 15px; text-align: center; border: 2px solid #ec4899;">
+            <h3 style="margin: 0 0 15px 0; color: #ec4899; font-size: 24px;">✨ Cuenta creada, {nombre}!</h3>
+            <p style="margin: 0; color: #e5e7eb; font-size: 16px;">
+                Bienvenido a Hakari. Tus conversaciones se guardarán automáticamente.
+            </p>
         </div>
         """
+        
+        return mensaje_bienvenida, resultado, gr.update(visible=False), gr.update(visible=True), obtener_panel_usuario(resultado), historial, HistorialChat(), gr.update(visible=False)
     
-    return f"""
-    <div style="background: rgba(236, 72, 153, 0.1); padding: 15px; border-radius: 10px; border: 1px solid #ec4899;">
-        <div style="font-weight: bold; color: #ec4899; font-size: 14px;">👤 {datos_usuario['nombre']}</div>
-        <div style="font-size: 11px; color: #e5e7eb; margin: 5px 0;">{datos_sesion['email']}</div>
+    return resultado, None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), [], None, gr.update(visible=False)
+
+def handle_login(email: str):
+    if not email:
+        return "❌ Ingresa tu email", None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), [], None, gr.update(visible=False)
+    
+    success, resultado = sistema_auth.iniciar_sesion(email)
+    if success:
+        # Cargar historial de conversaciones
+        datos_sesion = sistema_auth.obtener_datos_sesion(resultado)
+        historial, ids, cursor, hay_mas = db.obtener_pagina_conversaciones(datos_sesion['usuario_id'], limite=HISTORIAL_PAGINA)
         
-        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 5px; font-size: 10px; color: #9ca3af; margin: 8px 0;">
-            <div>
-                <strong>Confianza:</strong><br>
-                <div style="background: #374151; border-radius: 3px; overflow: hidden;">
-                    <div style="background: #ec4899; width: {datos_usuario['confianza']}%; height: 6px;"></div>
-                </div>
-                {datos_usuario['confianza']}%
-            </div>
-            <div>
-                <strong>Interacciones:</strong><br>
-                {datos_usuario['interacciones_totales']}
-            </div>
+        mensaje_bienvenida = f"""
+        <div style="background: linear-gradient(135deg, rgba(236, 72, 153, 0.2), rgba(168, 85, 247, 0.2)); padding: 25px; border-radius: 15px; text-align: center; border: 2px solid #ec4899;">
+            <h3 style="margin: 0 0 15px 0; color: #ec4899; font-size: 24px;">✨ Bienvenido de vuelta, {datos_sesion['nombre']}!</h3>
+            <p style="margin: 0; color: #e5e7eb; font-size: 16px;">
+                {len(historial)} mensajes anteriores cargados.
+            </p>
         </div>
-        {logros_html}
-    </div>
-    """
+        """
+        
+        return mensaje_bienvenida, resultado, gr.update(visible=False), gr.update(visible=True), obtener_panel_usuario(resultado), historial, HistorialChat(historial[:], ids, cursor), gr.update(visible=hay_mas)
+    
+    return resultado, None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), [], None, gr.update(visible=False)
+
+async def handle_chat(mensaje: str, sesion_id: str, historial: Optional[HistorialChat]):
+    # Solo viaja el turno nuevo: el historial completo vive en el servidor (historial) y en
+    # el navegador (chatbot), y JS_AGREGAR_TURNO añade allí cada turno recibido
+    if not sesion_id or not mensaje.strip() or historial is None:
+        yield "", gr.update(), gr.update(), gr.update()
+        return
+    
+    inicio = time.perf_counter()
+    # Puede consultar y renovar la sesión en el almacén: fuera del bucle de eventos
+    with metricas.etapa('autenticacion'):
+        datos_sesion = await asyncio.to_thread(sistema_auth.obtener_datos_sesion, sesion_id)
+    if datos_sesion is None:
+        yield "", gr.update(), gr.update(), gr.update()
+        return
+    usuario_id = datos_sesion['usuario_id']
+    
+    # Limitar lo que se retiene: los turnos más antiguos salen de la vista
+    # y el cursor avanza para que "cargar anteriores" los pueda recuperar
+    boton_anteriores = gr.update()
+    descartados = len(historial.turnos) + 1 - HISTORIAL_MAX
+    if descartados > 0:
+        if historial.en_cola(descartados):
+            await asyncio.to_thread(db.esperar_escrituras)
+        historial.quitar_antiguos(descartados)
+        boton_anteriores = gr.update(visible=historial.cursor is not None)
+    
+    turno = [mensaje, ""]
+    id_turno = IdTurno()
+    historial.turnos.append(turno)
+    historial.ids.append(id_turno)
+    turno_id = secrets.token_hex(4)  # dos mensajes iguales seguidos siguen siendo turnos distintos
+    primero = True
+    
+    estado = await preparar_turno(mensaje, usuario_id)
+    if estado is None:
+        # Aviso inmediato; el ánimo no cambia y el panel se queda como está
+        turno[1] = hakari.respuesta_aviso("limite")
+        yield "", {'n': turno_id, 'turno': [mensaje, turno[1]]}, gr.update(), boton_anteriores
+    else:
+        async for parcial in generar_respuesta_simple(mensaje, usuario_id, sesion_id, estado, id_turno):
+            turno[1] = parcial
+            if primero:
+                # El panel y el botón solo cambian con el mensaje, no con cada fragmento
+                with metricas.etapa('panel_estado'):
+                    panel_estado = obtener_panel_estado(estado)
+                yield "", {'n': turno_id, 'turno': [mensaje, parcial]}, panel_estado, boton_anteriores
+                primero = False
+            else:
+                yield "", {'n': turno_id, 'turno': [mensaje, parcial]}, gr.update(), gr.update()
+    metricas.observar('hakari_turno_segundos', time.perf_counter() - inicio)
+
+def handle_cargar_anteriores(sesion_id: str, historial: Optional[HistorialChat]):
+    if not sesion_id or historial is None or not sistema_auth.verificar_sesion(sesion_id):
+        return gr.update(), historial, gr.update(visible=False)
+    
+    datos_sesion = sistema_auth.obtener_datos_sesion(sesion_id)
+    pagina, ids, historial.cursor, hay_mas = db.obtener_pagina_conversaciones(
+        datos_sesion['usuario_id'], antes_de=historial.cursor, limite=HISTORIAL_PAGINA)
+    historial.turnos[:0] = pagina
+    historial.ids[:0] = ids
+    return historial.turnos, historial, gr.update(visible=hay_mas)
+
+def handle_limpiar(sesion_id: str, historial: Optional[HistorialChat]):
+    # Vacía la vista; lo borrado sigue guardado y vuelve con "cargar anteriores"
+    if not sesion_id or historial is None or not sistema_auth.verificar_sesion(sesion_id):
+        return [], historial, gr.update(visible=False)
+    
+    # Los últimos turnos pueden seguir en la cola y aún no tener id
+    if historial.en_cola(len(historial.turnos)):
+        db.esperar_escrituras()
+    historial.quitar_antiguos(len(historial.turnos))
+    return [], historial, gr.update(visible=historial.cursor is not None)
+
+def handle_logout(sesion_id: str):
+    if sesion_id:
+        sistema_auth.cerrar_sesion(sesion_id)
+    
+    return None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), [], None, gr.update(visible=False)
 
 # ==================== APLICACIÓN GRADIO ====================
 custom_css = """
@@ -474,192 +2805,359 @@ custom_css = """
 }
 """
 
-with gr.Blocks(css=custom_css, title="Hakari - Con Sistema de Login") as app:
-    sesion_state = gr.State()
-    
-    with gr.Column(elem_classes="main-container"):
-        with gr.Column(visible=True) as login_screen:
-            gr.HTML("""
-            <div style="text-align: center; margin-bottom: 50px;">
-                <h1 style="font-size: 52px; margin: 0; background: linear-gradient(135deg, #ec4899, #a855f7, #ffffff); -webkit-background-clip: text; -webkit-text-fill-color: transparent; background-clip: text; text-shadow: 0 4px 8px rgba(0,0,0,0.3);">Hakari</h1>
-                <p style="color: #e5e7eb; font-size: 20px; margin: 15px 0 0 0; text-shadow: 0 2px 4px rgba(0,0,0,0.5);">
-                    Sistema de Login • Conversaciones Guardadas
-                </p>
-            </div>
-            """)
+def crear_interfaz() -> gr.Blocks:
+    with gr.Blocks(css=custom_css, title="Hakari - Con Sistema de Login") as interfaz:
+        sesion_state = gr.State()
+        historial_state = gr.State()  # HistorialChat de la pestaña
+        turno_chat = gr.JSON(visible=False)  # último turno enviado por handle_chat
+    
+        with gr.Column(elem_classes="main-container"):
+            with gr.Column(visible=True) as login_screen:
+                gr.HTML("""
+                <div style="text-align: center; margin-bottom: 50px;">
+                    <h1 style="font-size: 52px; margin: 0; background: linear-gradient(135deg, #ec4899, #a855f7, #ffffff); -webkit-background-clip: text; -webkit-text-fill-color: transparent; background-clip: text; text-shadow: 0 4px 8px rgba(0,0,0,0.3);">Hakari</h1>
+                    <p style="color: #e5e7eb; font-size: 20px; margin: 15px 0 0 0; text-shadow: 0 2px 4px rgba(0,0,0,0.5);">
+                        Sistema de Login • Conversaciones Guardadas
+                    </p>
+                </div>
+                """)
             
-            with gr.Column(elem_classes="chat-interface", scale=0):
-                with gr.Tabs() as tabs:
-                    with gr.TabItem("📝 Registrarse"):
-                        gr.Markdown("### 🚀 Crear cuenta nueva")
-                        with gr.Row():
-                            nombre_registro = gr.Textbox(
-                                label="Tu nombre", 
-                                placeholder="¿Cómo te llamas?",
-                                scale=2
+                with gr.Column(elem_classes="chat-interface", scale=0):
+                    with gr.Tabs() as tabs:
+                        with gr.TabItem("📝 Registrarse"):
+                            gr.Markdown("### 🚀 Crear cuenta nueva")
+                            with gr.Row():
+                                nombre_registro = gr.Textbox(
+                                    label="Tu nombre", 
+                                    placeholder="¿Cómo te llamas?",
+                                    scale=2
+                                )
+                            with gr.Row():
+                                email_registro = gr.Textbox(
+                                    label="Tu email", 
+                                    placeholder="tu.email@ejemplo.com",
+                                    scale=2
+                                )
+                            btn_registro = gr.Button(
+                                "🎭 Crear Cuenta", 
+                                variant="primary", 
+                                size="lg"
                             )
-                        with gr.Row():
-                            email_registro = gr.Textbox(
-                                label="Tu email", 
-                                placeholder="tu.email@ejemplo.com",
-                                scale=2
-                            )
-                        btn_registro = gr.Button(
-                            "🎭 Crear Cuenta", 
-                            variant="primary", 
-                            size="lg"
-                        )
                     
-                    with gr.TabItem("🔐 Iniciar Sesión"):
-                        gr.Markdown("### 🔑 Acceder a cuenta existente")
-                        with gr.Row():
-                            email_login = gr.Textbox(
-                                label="Tu email", 
-                                placeholder="tu.email@ejemplo.com",
-                                scale=2
+                        with gr.TabItem("🔐 Iniciar Sesión"):
+                            gr.Markdown("### 🔑 Acceder a cuenta existente")
+                            with gr.Row():
+                                email_login = gr.Textbox(
+                                    label="Tu email", 
+                                    placeholder="tu.email@ejemplo.com",
+                                    scale=2
+                                )
+                            btn_login = gr.Button(
+                                "🚀 Iniciar Sesión", 
+                                variant="primary", 
+                                size="lg"
                             )
-                        btn_login = gr.Button(
-                            "🚀 Iniciar Sesión", 
-                            variant="primary", 
-                            size="lg"
-                        )
                 
-                status_login = gr.HTML()
-        
-        with gr.Column(visible=False) as chat_screen:
-            with gr.Row(equal_height=True):
-                with gr.Column(scale=1, min_width=350):
-                    with gr.Column():
-                        gr.Markdown("### 🧠 Estado de Hakari")
-                        estado_display = gr.HTML()
+                    status_login = gr.HTML()
+        
+            with gr.Column(visible=False) as chat_screen:
+                with gr.Row(equal_height=True):
+                    with gr.Column(scale=1, min_width=350):
+                        with gr.Column():
+                            gr.Markdown("### 🧠 Estado de Hakari")
+                            estado_display = gr.HTML()
                         
-                        gr.Markdown("### 👤 Tu Perfil")
-                        user_info_display = gr.HTML()
+                            gr.Markdown("### 👤 Tu Perfil")
+                            user_info_display = gr.HTML()
                 
-                with gr.Column(scale=2):
-                    chatbot = gr.Chatbot(
-                        label=f"Hakari - {hakari.calcular_edad()} años",
-                        height=600,
-                        show_copy_button=True,
-                        placeholder="Escribe un mensaje para Hakari..."
-                    )
-                    
-                    with gr.Row():
-                        msg = gr.Textbox(
-                            placeholder="Escribe tu mensaje aquí...",
-                            scale=8,
-                            container=False,
-                            lines=2
+                    with gr.Column(scale=2):
+                        btn_anteriores = gr.Button("⬆️ Cargar mensajes anteriores", variant="secondary", size="sm", visible=False)
+                        chatbot = gr.Chatbot(
+                            label=f"Hakari - {hakari.calcular_edad()} años",
+                            height=600,
+                            show_copy_button=True,
+                            placeholder="Escribe un mensaje para Hakari..."
                         )
-                        enviar = gr.Button("✨ Enviar", scale=1, variant="primary")
                     
-                    with gr.Row():
-                        btn_limpiar = gr.Button("🧹 Limpiar Chat", variant="secondary")
-                        btn_salir = gr.Button("🚪 Cerrar Sesión", variant="secondary")
+                        with gr.Row():
+                            msg = gr.Textbox(
+                                placeholder="Escribe tu mensaje aquí...",
+                                scale=8,
+                                container=False,
+                                lines=2
+                            )
+                            enviar = gr.Button("✨ Enviar", scale=1, variant="primary")
                     
-                    status_chat = gr.HTML()
+                        with gr.Row():
+                            btn_limpiar = gr.Button("🧹 Limpiar Chat", variant="secondary")
+                            btn_salir = gr.Button("🚪 Cerrar Sesión", variant="secondary")
+                    
+                        status_chat = gr.HTML()
     
-    # ==================== MANEJADORES ====================
-    def handle_registro(nombre: str, email: str):
-        if not nombre or not email:
-            return "❌ Completa ambos campos", None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), []
-        
-        success, resultado = sistema_auth.registrar_usuario(email, nombre)
-        if success:
-            # Cargar historial vacío para nuevo usuario
-            historial = []
-            
-            mensaje_bienvenida = f"""
-            <div style="background: linear-gradient(135deg, rgba(236, 72, 153, 0.2), rgba(168, 85, 247, 0.2)); padding: 25px; border-radius: 15px; text-align: center; border: 2px solid #ec4899;">
-                <h3 style="margin: 0 0 15px 0; color: #ec4899; font-size: 24px;">✨ Cuenta creada, {nombre}!</h3>
-                <p style="margin: 0; color: #e5e7eb; font-size: 16px;">
-                    Bienvenido a Hakari. Tus conversaciones se guardarán automáticamente.
-                </p>
-            </div>
-            """
-            
-            return mensaje_bienvenida, resultado, gr.update(visible=False), gr.update(visible=True), obtener_panel_usuario(resultado), historial
-        
-        return resultado, None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), []
     
-    def handle_login(email: str):
-        if not email:
-            return "❌ Ingresa tu email", None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), []
-        
-        success, resultado = sistema_auth.iniciar_sesion(email)
-        if success:
-            # Cargar historial de conversaciones
-            datos_sesion = sistema_auth.obtener_datos_sesion(resultado)
-            historial = db.obtener_ultimas_conversaciones(datos_sesion['email'], limite=20)
-            datos_usuario = db.obtener_datos_usuario(email)
-            
-            mensaje_bienvenida = f"""
-            <div style="background: linear-gradient(135deg, rgba(236, 72, 153, 0.2), rgba(168, 85, 247, 0.2)); padding: 25px; border-radius: 15px; text-align: center; border: 2px solid #ec4899;">
-                <h3 style="margin: 0 0 15px 0; color: #ec4899; font-size: 24px;">✨ Bienvenido de vuelta, {datos_usuario['nombre']}!</h3>
-                <p style="margin: 0; color: #e5e7eb; font-size: 16px;">
-                    {len(historial)} mensajes anteriores cargados.
-                </p>
-            </div>
-            """
-            
-            return mensaje_bienvenida, resultado, gr.update(visible=False), gr.update(visible=True), obtener_panel_usuario(resultado), historial
-        
-        return resultado, None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), []
+        # ==================== CONEXIÓN ====================
+        # Cada grupo (concurrency_id) tiene su propia cola y sus propios huecos:
+        # un pico de mensajes de chat no retrasa los inicios de sesión
+        btn_registro.click(
+            handle_registro,
+            [nombre_registro, email_registro],
+            [status_login, sesion_state, login_screen, chat_screen, user_info_display, chatbot, historial_state, btn_anteriores],
+            concurrency_limit=ACCESO_CONCURRENCIA,
+            concurrency_id="acceso"
+        ).then(None, js=JS_REINICIAR_TURNOS)
     
-    def handle_chat(mensaje: str, historial, sesion_id: str):
-        if not sesion_id or not mensaje.strip():
-            return "", historial, obtener_panel_estado()
-        
-        if not sistema_auth.verificar_sesion(sesion_id):
-            return "", historial, obtener_panel_estado()
+        btn_login.click(
+            handle_login,
+            [email_login],
+            [status_login, sesion_state, login_screen, chat_screen, user_info_display, chatbot, historial_state, btn_anteriores],
+            concurrency_limit=ACCESO_CONCURRENCIA,
+            concurrency_id="acceso"
+        ).then(None, js=JS_REINICIAR_TURNOS)
+    
+        enviar.click(
+            handle_chat,
+            [msg, sesion_state, historial_state],
+            [msg, turno_chat, estado_display, btn_anteriores],
+            concurrency_limit=CHAT_CONCURRENCIA,
+            concurrency_id="chat"
+        )
+    
+        msg.submit(
+            handle_chat,
+            [msg, sesion_state, historial_state],
+            [msg, turno_chat, estado_display, btn_anteriores],
+            concurrency_limit=CHAT_CONCURRENCIA,
+            concurrency_id="chat"
+        )
+    
+        btn_salir.click(
+            handle_logout,
+            inputs=[sesion_state],
+            outputs=[sesion_state, login_screen, chat_screen, user_info_display, chatbot, historial_state, btn_anteriores],
+            concurrency_limit=ACCESO_CONCURRENCIA,
+            concurrency_id="acceso"
+        )
+    
+        turno_chat.change(
+            None,
+            inputs=[turno_chat, chatbot],
+            outputs=[chatbot],
+            js=JS_AGREGAR_TURNO
+        )
         
-        datos_sesion = sistema_auth.obtener_datos_sesion(sesion_id)
-        respuesta = generar_respuesta_simple(mensaje, datos_sesion['email'], sesion_id)
-        nuevo_historial = historial + [[mensaje, respuesta]]
+        btn_anteriores.click(
+            handle_cargar_anteriores,
+            inputs=[sesion_state, historial_state],
+            outputs=[chatbot, historial_state, btn_anteriores],
+            concurrency_limit=HISTORIAL_CONCURRENCIA,
+            concurrency_id="historial"
+        )
         
-        return "", nuevo_historial, obtener_panel_estado()
+        btn_limpiar.click(
+            handle_limpiar,
+            inputs=[sesion_state, historial_state],
+            outputs=[chatbot, historial_state, btn_anteriores],
+            concurrency_limit=HISTORIAL_CONCURRENCIA,
+            concurrency_id="historial"
+        )
     
-    def handle_logout(sesion_id: str):
-        if sesion_id:
-            sistema_auth.cerrar_sesion(sesion_id)
-        
-        return None, gr.update(visible=True), gr.update(visible=False), obtener_panel_usuario(None), []
+    interfaz.queue(max_size=COLA_MAX or None)
+    return interfaz
+
+# Componentes que deben estar construidos para dar el servicio por listo
+COMPONENTES = {'db': db, 'sesiones': sistema_auth, 'gemini': gemini}
+errores_arranque = {}
+
+def precalentar():
+    # Construye los componentes en segundo plano para que el primer usuario no espere
+    for nombre, componente in COMPONENTES.items():
+        try:
+            componente.cargar()
+            errores_arranque.pop(nombre, None)
+        except Exception as e:
+            errores_arranque[nombre] = str(e)
+            registrar_error("error_precalentando", e, componente=nombre)
+
+metricas.ayuda('hakari_sesiones_activas', "Sesiones en la caché local de este proceso")
+metricas.ayuda('hakari_contextos', "Contextos de conversación en memoria")
+metricas.ayuda('hakari_db_cola', "Escrituras esperando en la cola")
+metricas.ayuda('hakari_cache_aciertos_total', "Aciertos de cada caché en memoria")
+metricas.ayuda('hakari_cache_fallos_total', "Fallos de cada caché en memoria")
+metricas.ayuda('hakari_cache_respuestas_latencia_ahorrada_segundos_total',
+               "Segundos de modelo ahorrados por la caché de respuestas (aciertos por latencia media)")
+metricas.ayuda('hakari_cache_respuestas_latencia_media_segundos',
+               "Latencia media de las respuestas del modelo que puede guardar la caché")
+metricas.ayuda('hakari_cache_respuestas_mensajes_total', "Mensajes vistos por la caché de respuestas, cacheables o no")
+metricas.ayuda('hakari_cache_respuestas_tasa_aciertos',
+               "Fracción de aciertos de la caché de respuestas: entre las frases cacheables o entre todos los mensajes")
+metricas.ayuda('hakari_gemini_errores_total', "Llamadas a Gemini que fallaron tras agotar los reintentos")
+metricas.ayuda('hakari_limite_usuario_rechazados_total', "Mensajes rechazados por superar el límite por usuario")
+metricas.ayuda('hakari_planificador_en_espera', "Mensajes esperando turno para llamar al modelo")
+
+@metricas.colector
+def metricas_componentes() -> List[tuple]:
+    # Valores que ya llevan los componentes (caches, cola, cliente de Gemini), leídos al exponer.
+    # Los componentes aún sin construir no se construyen por esto
+    caches = {'perfiles_panel': paneles_usuario, 'estados': hakari.por_usuario,
+              'logros_desbloqueados': sistema_logros.desbloqueados, 'respuestas': cache_respuestas}
+    muestras = [('hakari_contextos', 'gauge', {}, len(pool_contextos.sesiones))]
+    if db.cargado:
+        caches.update({'ids': db.cache_ids, 'perfiles': db.cache_perfiles, 'logros': db.cache_logros})
+        muestras.append(('hakari_db_cola', 'gauge', {}, db.cola_escritura.qsize()))
+    for nombre, cache in caches.items():
+        stats = cache.estadisticas()
+        muestras.append(('hakari_cache_aciertos_total', 'counter', {'cache': nombre}, stats['aciertos']))
+        muestras.append(('hakari_cache_fallos_total', 'counter', {'cache': nombre}, stats['fallos']))
+        muestras.append(('hakari_cache_entradas', 'gauge', {'cache': nombre}, stats['entradas']))
+    stats = cache_respuestas.estadisticas()
+    muestras.append(('hakari_cache_respuestas_latencia_ahorrada_segundos_total', 'counter', {},
+                     stats['latencia_ahorrada_s']))
+    muestras.append(('hakari_cache_respuestas_latencia_media_segundos', 'gauge', {}, stats['latencia_media_s']))
+    muestras.append(('hakari_cache_respuestas_mensajes_total', 'counter', {}, stats['mensajes']))
+    muestras.append(('hakari_cache_respuestas_tasa_aciertos', 'gauge', {'sobre': 'cacheables'}, stats['tasa_aciertos']))
+    muestras.append(('hakari_cache_respuestas_tasa_aciertos', 'gauge', {'sobre': 'mensajes'},
+                     stats['tasa_aciertos_mensajes']))
+    if sistema_auth.cargado:
+        muestras.append(('hakari_sesiones_activas', 'gauge', {}, len(sistema_auth.sesiones_activas)))
+    muestras.append(('hakari_limite_usuario_rechazados_total', 'counter', {}, limitador_usuarios.rechazados))
+    for clave in ('inmediatas', 'encoladas', 'rechazadas', 'caducadas'):
+        muestras.append((f'hakari_planificador_{clave}_total', 'counter', {}, getattr(planificador_modelo, clave)))
+    muestras.append(('hakari_planificador_en_espera', 'gauge', {}, planificador_modelo.en_espera()))
+    if gemini.cargado:
+        stats = gemini.estadisticas()
+        for clave in ('llamadas', 'reintentos', 'errores', 'rechazadas', 'aperturas'):
+            muestras.append((f'hakari_gemini_{clave}_total', 'counter', {}, stats[clave]))
+        muestras.append(('hakari_gemini_circuito_abierto', 'gauge', {}, int(stats['circuito'] != Cortocircuito.CERRADO)))
+    return muestras
+
+def estado_arranque() -> Dict:
+    componentes = {nombre: componente.cargado for nombre, componente in COMPONENTES.items()}
+    return {'listo': all(componentes.values()), 'componentes': componentes, 'errores': dict(errores_arranque)}
+
+def crear_app(precalentar_fondo: bool = True):
+    # Aplicación ASGI: la interfaz de Gradio en "/" más /salud (proceso vivo), /listo
+    # (base de datos, sesiones y cliente de Gemini construidos) y, si están activas, /metricas
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, PlainTextResponse
     
-    # ==================== CONEXIÓN ====================
-    btn_registro.click(
-        handle_registro,
-        [nombre_registro, email_registro],
-        [status_login, sesion_state, login_screen, chat_screen, user_info_display, chatbot]
-    )
+    api = FastAPI()
     
-    btn_login.click(
-        handle_login,
-        [email_login],
-        [status_login, sesion_state, login_screen, chat_screen, user_info_display, chatbot]
-    )
+    @api.get("/salud")
+    def salud():
+        return {'ok': True}
     
-    enviar.click(
-        handle_chat,
-        [msg, chatbot, sesion_state],
-        [msg, chatbot, estado_display]
-    )
+    @api.get("/listo")
+    def listo():
+        estado = estado_arranque()
+        return JSONResponse(estado, status_code=200 if estado['listo'] else 503)
     
-    msg.submit(
-        handle_chat,
-        [msg, chatbot, sesion_state],
-        [msg, chatbot, estado_display]
-    )
+    if metricas.activas:
+        @api.get("/metricas")
+        def exponer_metricas():
+            return PlainTextResponse(metricas.exponer(), media_type="text/plain; version=0.0.4; charset=utf-8")
     
-    btn_salir.click(
-        handle_logout,
-        inputs=[sesion_state],
-        outputs=[sesion_state, login_screen, chat_screen, user_info_display, chatbot]
-    )
+    if precalentar_fondo:
+        threading.Thread(target=precalentar, name="hakari-precalentar", daemon=True).start()
+    return gr.mount_gradio_app(api, crear_interfaz(), path="/")
+
+def servir(puerto: int = PUERTO, host: str = HOST):
+    import uvicorn
     
-    btn_limpiar.click(
-        fn=lambda: [],
-        outputs=[chatbot]
-    )
+    uvicorn.run(crear_app(), host=host, port=puerto)
+
+# Cabeceras de un solo salto: no se reenvían entre el cliente y el trabajador
+CABECERAS_SALTO = frozenset({'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                             'te', 'trailer', 'transfer-encoding', 'upgrade'})
+
+def crear_proxy(puertos: List[int]):
+    # Aplicación ASGI del proceso principal: reenvía cada petición al trabajador que toca al
+    # cliente. El cliente se identifica por el primer salto de X-Forwarded-For (la plataforma
+    # puede tener su propio proxy delante) o por su IP; el mismo cliente va siempre al mismo
+    # trabajador, que es donde están su cola de Gradio y sus caches
+    import zlib
+    import httpx
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import PlainTextResponse, StreamingResponse
+    from starlette.routing import Route
+    
+    cliente_http = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+    
+    async def reenviar(request: Request):
+        reenviado = request.headers.get('x-forwarded-for', '')
+        ip = request.client.host if request.client else ''
+        cliente = reenviado.split(',')[0].strip() or ip
+        puerto = puertos[zlib.crc32(cliente.encode()) % len(puertos)]
+        
+        # Se conserva Host (Gradio construye sus URLs con él) y se añade la IP a X-Forwarded-For
+        cabeceras = [(k, v) for k, v in request.headers.raw
+                     if k.decode('latin-1').lower() not in CABECERAS_SALTO | {'x-forwarded-for'}]
+        saltos = ", ".join(filter(None, (reenviado, ip)))
+        if saltos:
+            cabeceras.append((b'x-forwarded-for', saltos.encode('latin-1')))
+        url = httpx.URL(scheme='http', host='127.0.0.1', port=puerto, path=request.url.path,
+                        query=request.url.query.encode())
+        peticion = cliente_http.build_request(request.method, url, headers=cabeceras,
+                                              content=request.stream())
+        try:
+            respuesta = await cliente_http.send(peticion, stream=True)
+        except httpx.TransportError as e:
+            registrar_error("proxy_trabajador_inalcanzable", e, puerto=puerto)
+            return PlainTextResponse("Trabajador no disponible", status_code=502)
+        
+        async def cuerpo():
+            try:
+                async for fragmento in respuesta.aiter_raw():
+                    yield fragmento
+            finally:
+                await respuesta.aclose()
+        
+        salida = StreamingResponse(cuerpo(), status_code=respuesta.status_code)
+        # Lista cruda para conservar las cabeceras repetidas (Set-Cookie)
+        salida.raw_headers = [(k, v) for k, v in respuesta.headers.raw
+                              if k.decode('latin-1').lower() not in CABECERAS_SALTO]
+        return salida
+    
+    metodos = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+    return Starlette(routes=[Route('/{ruta:path}', reenviar, methods=metodos)],
+                     on_shutdown=[cliente_http.aclose])
+
+def servir_trabajadores(trabajadores: int = TRABAJADORES, proxy: bool = PROXY_INTEGRADO):
+    # Un proceso completo por trabajador, cada uno en su puerto. Comparten la base de datos
+    # (WAL, un escritor por proceso), las sesiones en SQLite y el ánimo de Hakari, que se lee
+    # de la base de datos; el resto de caches es de cada proceso y depende de la afinidad
+    import multiprocessing
+    import uvicorn
+    
+    if not ALMACENES_SESIONES[SESIONES_ALMACEN]().compartido:
+        raise SystemExit(f"HAKARI_SESIONES={SESIONES_ALMACEN} no se comparte entre procesos; usa sqlite")
+    # Las migraciones se aplican una vez aquí y no en cada proceso a la vez
+    db.cargar().cerrar()
+    
+    # Con el proxy integrado los trabajadores solo escuchan en local y PUERTO es el único público
+    host_trabajadores = "127.0.0.1" if proxy else HOST
+    puertos = [PUERTO + i for i in range(1, trabajadores + 1)]
+    contexto = multiprocessing.get_context("spawn")
+    procesos = [contexto.Process(target=servir, args=(puerto, host_trabajadores), name=f"hakari-{i}")
+                for i, puerto in enumerate(puertos, 1)]
+    for proceso, puerto in zip(procesos, puertos):
+        proceso.start()
+        registrar(logging.INFO, "trabajador_iniciado", nombre=proceso.name, pid=proceso.pid, puerto=puerto)
+    try:
+        if proxy:
+            uvicorn.run(crear_proxy(puertos), host=HOST, port=PUERTO)
+        else:
+            registrar(logging.WARNING, "proxy_desactivado", puerto=PUERTO, puertos=puertos,
+                      detalle="nadie escucha en PORT; hace falta un balanceador externo con afinidad")
+            for proceso in procesos:
+                proceso.join()
+    finally:
+        for proceso in procesos:
+            if proceso.is_alive():
+                proceso.terminate()
 
 if __name__ == "__main__":
-    app.launch(server_name="0.0.0.0", server_port=7860, share=False)
+    if TRABAJADORES > 1:
+        servir_trabajadores()
+    else:
+        servir()
@@ -0,0 +1,102 @@
+# Benchmark de arranque: cuánto tarda `import app`, qué módulos pesan más y cuánto
+# tardan después la construcción de la interfaz y el precalentamiento en segundo plano.
+#
+#   python benchmarks/bench_arranque.py [--top 15] [--repeticiones 3] [--max-import 6.0]
+#
+# Cada medida se toma en un proceso nuevo para que la caché de módulos no la falsee.
+# Con --max-import el script termina con código 1 si la importación supera ese tiempo,
+# para detectar regresiones (por ejemplo, un import pesado añadido a nivel de módulo).
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Se ejecuta en el proceso hijo: tiempos de cada fase en segundos
+FASES = """
+import json, time
+inicio = time.perf_counter()
+import app
+importado = time.perf_counter()
+interfaz = app.crear_interfaz()
+construida = time.perf_counter()
+app.precalentar()
+precalentado = time.perf_counter()
+print(json.dumps({
+    "import app": importado - inicio,
+    "crear_interfaz()": construida - importado,
+    "precalentar()": precalentado - construida,
+    "listo": app.estado_arranque()["listo"],
+}))
+"""
+
+def entorno(directorio: str) -> dict:
+    # Base de datos temporal y clave ficticia: el cliente se construye pero nunca llama a la API
+    return {
+        **os.environ,
+        "PYTHONPATH": RAIZ,
+        "HAKARI_DB_RUTA": os.path.join(directorio, "hakari_bench.db"),
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "clave-de-benchmark"),
+    }
+
+def medir_fases(directorio: str) -> dict:
+    salida = subprocess.run([sys.executable, "-c", FASES], env=entorno(directorio), cwd=directorio,
+                            capture_output=True, text=True, check=True)
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+def importtime(directorio: str) -> list:
+    # Líneas de `python -X importtime`: "import time: propio | acumulado | módulo" (µs)
+    salida = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], env=entorno(directorio),
+                            cwd=directorio, capture_output=True, text=True, check=True)
+    modulos = []
+    for linea in salida.stderr.splitlines():
+        if not linea.startswith("import time:") or "self [us]" in linea:
+            continue
+        propio, acumulado, nombre = linea[len("import time:"):].split("|")
+        profundidad = (len(nombre) - len(nombre.lstrip())) // 2
+        modulos.append((nombre.strip(), int(propio), int(acumulado), profundidad))
+    return modulos
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque de app.py")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--max-import", type=float, default=None,
+                        help="segundos máximos de `import app`; si se superan, código de salida 1")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directorio:
+        medidas = [medir_fases(directorio) for _ in range(args.repeticiones)]
+        modulos = importtime(directorio)
+
+    print(f"Fases (mejor de {args.repeticiones} procesos, segundos)")
+    for fase in ("import app", "crear_interfaz()", "precalentar()"):
+        print(f"  {fase:<18} {min(m[fase] for m in medidas):7.3f}")
+    print(f"  listo tras precalentar: {all(m['listo'] for m in medidas)}")
+
+    # importtime escribe los hijos antes que el padre: los de profundidad 1 justo antes de "app"
+    posicion = next(i for i, m in enumerate(modulos) if m[0] == "app" and m[3] == 0)
+    inicio = max((i for i, m in enumerate(modulos[:posicion]) if m[3] == 0), default=-1) + 1
+    directos = sorted((m for m in modulos[inicio:posicion] if m[3] == 1), key=lambda m: m[2], reverse=True)
+    print("\nImportaciones directas de app más lentas (-X importtime, ms acumulados)")
+    for nombre, _, acumulado, _ in directos[:args.top]:
+        print(f"  {nombre:<40} {acumulado / 1000:8.1f}")
+
+    print("\nMódulos con más tiempo propio (ms)")
+    for nombre, propio, _, _ in sorted(modulos, key=lambda m: m[1], reverse=True)[:args.top]:
+        print(f"  {nombre:<40} {propio / 1000:8.1f}")
+
+    # El cliente de Gemini debe importarse al precalentar, nunca al importar app
+    if any(m[0] == "google.genai" for m in modulos):
+        print("\nAviso: `import app` carga google.genai")
+
+    mejor_import = min(m["import app"] for m in medidas)
+    if args.max_import is not None and mejor_import > args.max_import:
+        print(f"\nRegresión: `import app` tarda {mejor_import:.3f}s (máximo {args.max_import}s)")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+# Prueba de carga del camino de chat (handle_login -> handle_chat -> generar_respuesta_simple
+# -> DatabaseManager) con un Gemini falso local: no hace falta clave ni red.
+#
+#   python benchmarks/bench_carga.py [--usuarios 50] [--mensajes 20] [--latencia 0.3]
+#                                    [--errores 0.02] [--salida carga.json] [--comparar anterior.json]
+#
+# Cada usuario simulado se registra, inicia sesión con handle_login (en un hilo, como lo
+# ejecuta Gradio) y envía --mensajes mensajes con handle_chat, todos a la vez en el mismo
+# bucle de eventos. El falso tarda --latencia segundos (± --jitter) en dar el primer
+# fragmento y falla con ConnectionError en una fracción --errores de las llamadas, así que
+# los reintentos y el cortocircuito de ClienteGemini se ejercitan igual que en producción.
+#
+# Informa de p50/p95/p99 del primer fragmento y del turno completo, turnos por segundo,
+# tiempo dentro de DatabaseManager por método y crecimiento de memoria, y lo guarda todo
+# en JSON para comparar ejecuciones (--comparar muestra la diferencia con una anterior).
+#
+# Los límites de uso de app.py se aplican igual que en producción. Los turnos que
+# terminan en un aviso de límite se cuentan aparte y no entran en las latencias; en los
+# que esperan turno en la cola global, el primer fragmento es el de la respuesta y no el
+# aviso de espera. HAKARI_LIMITE_USUARIO_RITMO=0 y HAKARI_LIMITE_GLOBAL_RITMO=0 los
+# desactivan para medir solo el camino de chat.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+FRASES = [
+    "hola, ¿qué tal estás hoy?",
+    "¿Por qué dices eso? Explica tu razón",
+    "¿Recuerdas lo que hablamos antes?",
+    "Eso es muy interesante, cuéntame más",
+    "no se, estoy cansado de todo",
+    "¿sabes algo de musica alternativa?",
+    "cuando era pequeño veia mucho anime",
+    "me gusta leer novelas de terror por la noche",
+]
+
+RESPUESTA = "Mm. No sé si quiero hablar de eso ahora, pero supongo que puedo intentarlo. Aunque no prometo nada."
+
+# Métodos de DatabaseManager cuyo tiempo se acumula (lecturas, escrituras y lotes del hilo de escritura)
+METODOS_DB = (
+    'obtener_id_usuario', 'obtener_datos_usuario_por_id', 'obtener_estado_hakari', 'obtener_pagina_conversaciones',
+    'obtener_logros_usuario', 'obtener_resumen', 'registrar_usuario',
+    'actualizar_estadisticas', 'guardar_conversacion', 'registrar_logro', '_confirmar_lote',
+)
+
+# ==================== GEMINI FALSO ====================
+class Fragmento:
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+class ModelosFalsos:
+    # Imita client.aio.models: lo único que usa ClienteGemini
+    def __init__(self, latencia: float, jitter: float, errores: float, fragmentos: int, entre_fragmentos: float):
+        self.latencia = latencia
+        self.jitter = jitter
+        self.errores = errores
+        self.fragmentos = fragmentos
+        self.entre_fragmentos = entre_fragmentos
+        self.llamadas = 0
+        self.fallos = 0
+
+    async def _esperar_primera(self):
+        self.llamadas += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latencia, self.jitter)))
+        if random.random() < self.errores:
+            self.fallos += 1
+            raise ConnectionError("fallo simulado")
+
+    async def generate_content(self, **kwargs):
+        await self._esperar_primera()
+        return Fragmento(RESPUESTA)
+
+    async def generate_content_stream(self, **kwargs):
+        await self._esperar_primera()
+        paso = -(-len(RESPUESTA) // self.fragmentos)
+        trozos = [RESPUESTA[i:i + paso] for i in range(0, len(RESPUESTA), paso)]
+
+        async def flujo():
+            for i, trozo in enumerate(trozos):
+                if i:
+                    await asyncio.sleep(self.entre_fragmentos)
+                yield Fragmento(trozo)
+        return flujo()
+
+class ClienteFalso:
+    def __init__(self, modelos: ModelosFalsos):
+        self.aio = type("Aio", (), {})()
+        self.aio.models = modelos
+
+# ==================== MEDIDAS ====================
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    posicion = (len(ordenados) - 1) * p / 100
+    bajo = int(posicion)
+    alto = min(bajo + 1, len(ordenados) - 1)
+    return ordenados[bajo] + (ordenados[alto] - ordenados[bajo]) * (posicion - bajo)
+
+def resumen_latencias(valores: list) -> dict:
+    # Milisegundos
+    return {
+        'n': len(valores),
+        'media': sum(valores) / len(valores) * 1000 if valores else 0.0,
+        'p50': percentil(valores, 50) * 1000,
+        'p95': percentil(valores, 95) * 1000,
+        'p99': percentil(valores, 99) * 1000,
+        'max': max(valores, default=0.0) * 1000,
+    }
+
+def rss_mb() -> float:
+    # Memoria residente actual (Linux); si no hay /proc, el máximo que da getrusage
+    try:
+        with open('/proc/self/status') as estado:
+            for linea in estado:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maximo / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+class TiemposDB:
+    # Tiempo de pared dentro de cada método medido, desde cualquier hilo
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segundos = defaultdict(float)
+        self.llamadas = defaultdict(int)
+
+    def envolver(self, clase, nombre: str):
+        original = getattr(clase, nombre)
+
+        def medido(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                transcurrido = time.perf_counter() - inicio
+                with self.lock:
+                    self.segundos[nombre] += transcurrido
+                    self.llamadas[nombre] += 1
+        setattr(clase, nombre, medido)
+
+    def informe(self) -> dict:
+        return {nombre: {'llamadas': self.llamadas[nombre], 'total_ms': self.segundos[nombre] * 1000,
+                         'media_ms': self.segundos[nombre] / self.llamadas[nombre] * 1000}
+                for nombre in sorted(self.segundos, key=self.segundos.get, reverse=True)}
+
+# ==================== USUARIOS SIMULADOS ====================
+async def usuario(app, indice: int, args, resultados: dict):
+    email = f"carga{indice}@bench.local"
+    inicio = time.perf_counter()
+    salida = await asyncio.to_thread(app.handle_login, email)
+    resultados['login'].append(time.perf_counter() - inicio)
+    sesion_id, historial = salida[1], salida[6]
+    if not sesion_id:
+        resultados['fallos_login'] += 1
+        return
+
+    for _ in range(args.mensajes):
+        if args.pausa:
+            await asyncio.sleep(random.uniform(0, 2 * args.pausa))
+        mensaje = random.choice(FRASES)
+        inicio = time.perf_counter()
+        primero = None
+        ultimo = ""
+        en_cola = False
+        async for _, turno, _, _ in app.handle_chat(mensaje, sesion_id, historial):
+            if not isinstance(turno, dict):
+                continue
+            ultimo = turno['turno'][1]
+            # El aviso de espera llega al instante: el primer fragmento es el primero de la respuesta
+            if ultimo in resultados['textos_avisos']:
+                en_cola = True
+            elif primero is None:
+                primero = time.perf_counter() - inicio
+        duracion = time.perf_counter() - inicio
+        # Los turnos que acabaron en un aviso de límite no llegaron al modelo y se cuentan aparte
+        if ultimo in resultados['textos_avisos']:
+            resultados['limitadas'] += 1
+            continue
+        resultados['primer_fragmento'].append(primero or duracion)
+        resultados['turno'].append(duracion)
+        if en_cola:
+            resultados['en_cola'] += 1
+        # Turnos que acabaron en una respuesta de reserva en lugar de la del modelo
+        if ultimo in resultados['textos_predefinidos']:
+            resultados['predefinidas'] += 1
+
+async def ejecutar(app, args) -> dict:
+    resultados = {'login': [], 'primer_fragmento': [], 'turno': [], 'fallos_login': 0, 'predefinidas': 0,
+                  'limitadas': 0, 'en_cola': 0,
+                  'textos_predefinidos': {r for estado in app.hakari.estados.values() for r in estado['respuestas']},
+                  'textos_avisos': {r for avisos in app.hakari.avisos.values() for r in avisos}}
+
+    # Los usuarios ya existen, como en producción: el registro no forma parte de la medida
+    for i in range(args.usuarios):
+        email = f"carga{i}@bench.local"
+        if not app.db.verificar_usuario_existe(email):
+            app.sistema_auth.registrar_usuario(email, f"Carga {i}")
+    app.db.esperar_escrituras()
+
+    memoria_inicio = rss_mb()
+    inicio = time.perf_counter()
+    await asyncio.gather(*(usuario(app, i, args, resultados) for i in range(args.usuarios)))
+    duracion = time.perf_counter() - inicio
+
+    # Lo encolado durante la prueba también cuenta como tiempo de base de datos
+    await asyncio.to_thread(lambda: app.executor_db.submit(lambda: None).result())
+    await asyncio.to_thread(app.db.esperar_escrituras, 30.0)
+
+    return {
+        'duracion_s': duracion,
+        'turnos': len(resultados['turno']),
+        'turnos_por_s': len(resultados['turno']) / duracion if duracion else 0.0,
+        'latencia_ms': {
+            'login': resumen_latencias(resultados['login']),
+            'primer_fragmento': resumen_latencias(resultados['primer_fragmento']),
+            'turno': resumen_latencias(resultados['turno']),
+        },
+        'fallos_login': resultados['fallos_login'],
+        'respuestas_predefinidas': resultados['predefinidas'],
+        'respuestas_limitadas': resultados['limitadas'],
+        'turnos_en_cola': resultados['en_cola'],
+        'memoria_mb': {'inicio': memoria_inicio, 'fin': rss_mb(), 'crecimiento': rss_mb() - memoria_inicio},
+    }
+
+# ==================== INFORME ====================
+def version_git() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def imprimir(informe: dict):
+    r = informe['resultados']
+    print(f"{r['turnos']} turnos de {informe['parametros']['usuarios']} usuarios en {r['duracion_s']:.2f}s "
+          f"({r['turnos_por_s']:.1f} turnos/s)")
+    print("\nLatencia (ms)          n     p50     p95     p99     max")
+    for nombre, lat in r['latencia_ms'].items():
+        print(f"  {nombre:<17} {lat['n']:5d} {lat['p50']:7.1f} {lat['p95']:7.1f} {lat['p99']:7.1f} {lat['max']:7.1f}")
+    print(f"\nRespuestas predefinidas: {r['respuestas_predefinidas']}   Avisos de límite: {r.get('respuestas_limitadas', 0)}"
+          f"   En cola del límite global: {r.get('turnos_en_cola', 0)}   Fallos de login: {r['fallos_login']}")
+    print(f"Memoria: {r['memoria_mb']['inicio']:.1f} MB -> {r['memoria_mb']['fin']:.1f} MB "
+          f"(+{r['memoria_mb']['crecimiento']:.1f})")
+    print("\nBase de datos            llamadas   total ms   media ms")
+    for nombre, t in informe['db'].items():
+        print(f"  {nombre:<24} {t['llamadas']:7d} {t['total_ms']:10.1f} {t['media_ms']:10.3f}")
+    print(f"\nGemini falso: {informe['gemini_falso']}")
+    print(f"ClienteGemini: {informe['cliente_gemini']}")
+
+def comparar(anterior: dict, actual: dict):
+    print(f"\nFrente a {anterior.get('commit') or '(anterior)'} ({anterior.get('fecha', '')})")
+    a, b = anterior['resultados'], actual['resultados']
+
+    def fila(nombre, x, y):
+        cambio = (y - x) / x * 100 if x else 0.0
+        print(f"  {nombre:<28} {x:10.1f} -> {y:10.1f}  ({cambio:+.1f}%)")
+    fila("turnos/s", a['turnos_por_s'], b['turnos_por_s'])
+    for medida in ('primer_fragmento', 'turno'):
+        for p in ('p50', 'p95', 'p99'):
+            fila(f"{medida} {p} ms", a['latencia_ms'][medida][p], b['latencia_ms'][medida][p])
+    fila("db total ms", sum(t['total_ms'] for t in anterior['db'].values()),
+         sum(t['total_ms'] for t in actual['db'].values()))
+    fila("crecimiento memoria MB", a['memoria_mb']['crecimiento'], b['memoria_mb']['crecimiento'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del chat con un Gemini falso")
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--mensajes", type=int, default=20, help="mensajes por usuario")
+    parser.add_argument("--pausa", type=float, default=0.0, help="segundos medios entre mensajes de un usuario")
+    parser.add_argument("--latencia", type=float, default=0.3, help="segundos hasta el primer fragmento")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--fragmentos", type=int, default=4)
+    parser.add_argument("--entre-fragmentos", type=float, default=0.02)
+    parser.add_argument("--errores", type=float, default=0.0, help="fracción de llamadas que fallan")
+    parser.add_argument("--db", default=None, help="base de datos (por defecto, una temporal nueva)")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", default="bench_carga.json")
+    parser.add_argument("--comparar", default=None, help="JSON de una ejecución anterior")
+    args = parser.parse_args()
+
+    random.seed(args.semilla)
+    with tempfile.TemporaryDirectory() as directorio:
+        os.environ["HAKARI_DB_RUTA"] = args.db or os.path.join(directorio, "hakari_carga.db")
+        os.environ.setdefault("GEMINI_API_KEY", "clave-de-benchmark")
+        import app
+
+        tiempos = TiemposDB()
+        for nombre in METODOS_DB:
+            tiempos.envolver(app.DatabaseManager, nombre)
+        modelos = ModelosFalsos(args.latencia, args.jitter, args.errores, args.fragmentos, args.entre_fragmentos)
+        app.gemini = app.COMPONENTES['gemini'] = app.Perezoso(lambda: app.ClienteGemini(ClienteFalso(modelos)))
+        app.precalentar()
+
+        resultados = asyncio.run(ejecutar(app, args))
+        informe = {
+            'fecha': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'commit': version_git(),
+            'python': platform.python_version(),
+            'parametros': vars(args),
+            'configuracion': {nombre: getattr(app, nombre) for nombre in (
+                'CHAT_CONCURRENCIA', 'GEMINI_CONCURRENCIA', 'GEMINI_REINTENTOS', 'DB_LOTE',
+                'DB_INTERVALO', 'DB_SYNCHRONOUS', 'SESIONES_ALMACEN', 'CACHE_RESPUESTAS',
+                'LIMITE_USUARIO_RITMO', 'LIMITE_USUARIO_RAFAGA', 'LIMITE_GLOBAL_RITMO', 'LIMITE_GLOBAL_RAFAGA')},
+            'resultados': resultados,
+            'db': tiempos.informe(),
+            'gemini_falso': {'llamadas': modelos.llamadas, 'fallos': modelos.fallos},
+            'cliente_gemini': app.gemini.estadisticas(),
+        }
+        app.db.cerrar()
+
+    imprimir(informe)
+    with open(args.salida, 'w', encoding='utf-8') as archivo:
+        json.dump(informe, archivo, ensure_ascii=False, indent=2)
+    print(f"\nResultados guardados en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as archivo:
+            comparar(json.load(archivo), informe)
+
+if __name__ == "__main__":
+    main()
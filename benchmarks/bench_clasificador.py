@@ -0,0 +1,109 @@
+# Micro-benchmark del clasificador de ánimo: coste por mensaje antes y después.
+#
+#   python benchmarks/bench_clasificador.py [--mensajes 20000] [--repeticiones 5]
+#
+# Además de las reglas actuales mide un conjunto ampliado de palabras clave,
+# porque el coste del clasificador original crece con cada palabra añadida
+# mientras que el compilado recorre el mensaje una sola vez. "normalizado" es el
+# clasificador compilado anterior, que quitaba las tildes del mensaje entero en lugar
+# de buscar también las variantes con tilde.
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("HAKARI_DB_RUTA", os.path.join(tempfile.gettempdir(), "hakari_bench.db"))
+
+from app import ClasificadorAnimo, REGLAS_ANIMO, normalizar_texto  # noqa: E402
+
+FRASES = [
+    "hola, ¿qué tal estás hoy?",
+    "¿Por qué dices eso? Explica tu razón",
+    "¿Recuerdas lo que hablamos antes?",
+    "Eso es muy interesante, cuéntame más",
+    "no se, estoy cansado de todo",
+    "¿sabes algo de musica alternativa?",
+    "cuando era pequeño veia mucho anime",
+    "me gusta leer novelas de terror por la noche",
+]
+
+# Palabras inventadas que no aparecen en FRASES: solo aumentan el trabajo por mensaje
+EXTRA = [f"palabra{i}" for i in range(20)]
+
+def clasificador_original(reglas):
+    # Misma lógica que el antiguo PersonalidadHakari.actualizar_estado:
+    # un any() por ánimo, en orden, sobre el mensaje en minúsculas
+    grupos = [(animo, list(palabras)) for animo, palabras in reglas]
+    
+    def clasificar(mensaje: str):
+        mensaje = mensaje.lower()
+        for animo, palabras in grupos:
+            if any(palabra in mensaje for palabra in palabras):
+                return animo
+        return None
+    return clasificar
+
+def clasificador_normalizado(reglas):
+    # Alternancia de las palabras sin tildes sobre el mensaje normalizado con NFD
+    animos = [animo for animo, _ in reglas]
+    pesos = {normalizar_texto(p): (prioridad, peso)
+             for prioridad, (_, palabras) in enumerate(reglas) for p, peso in palabras.items()}
+    patron = re.compile("|".join(re.escape(p) for p in sorted(pesos, key=len, reverse=True)))
+    
+    def clasificar(mensaje: str):
+        puntuaciones = [0] * len(animos)
+        encontradas = patron.findall(normalizar_texto(mensaje))
+        for palabra in encontradas:
+            prioridad, peso = pesos[palabra]
+            puntuaciones[prioridad] += peso
+        return animos[max(range(len(animos)), key=puntuaciones.__getitem__)] if encontradas else None
+    return clasificar
+
+def reglas_originales(reglas):
+    # El clasificador original comparaba con las palabras acentuadas tal cual
+    acentos = {'por que': 'por qué', 'razon': 'razón', 'cuentame': 'cuéntame'}
+    return [(animo, {acentos.get(p, p): peso for p, peso in palabras.items()}) for animo, palabras in reglas]
+
+def ampliar(reglas):
+    return [(animo, {**palabras, **{f"{p}{animo.value}": 1 for p in EXTRA}}) for animo, palabras in reglas]
+
+def medir(funcion, mensajes, repeticiones: int) -> float:
+    # Mejor tiempo de todas las repeticiones, en nanosegundos por mensaje
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(mensajes)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor / len(mensajes) * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark del clasificador de ánimo")
+    parser.add_argument("--mensajes", type=int, default=20000)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    mensajes = [random.choice(FRASES) for _ in range(args.mensajes)]
+
+    print(f"{args.mensajes} mensajes, mejor de {args.repeticiones} repeticiones (ns/mensaje)")
+    for titulo, reglas in (("reglas actuales", REGLAS_ANIMO), ("reglas ampliadas", ampliar(REGLAS_ANIMO))):
+        original = clasificador_original(reglas_originales(reglas))
+        normalizado = clasificador_normalizado(reglas)
+        compilado = ClasificadorAnimo(reglas)
+        assert [normalizado(m) for m in set(mensajes)] == [compilado.clasificar(m) for m in set(mensajes)]
+        palabras = sum(len(p) for _, p in reglas)
+        resultados = {
+            "original (any por ánimo)": medir(lambda ms: [original(m) for m in ms], mensajes, args.repeticiones),
+            "normalizado (NFD)": medir(lambda ms: [normalizado(m) for m in ms], mensajes, args.repeticiones),
+            "compilado (variantes)": medir(lambda ms: [compilado.clasificar(m) for m in ms], mensajes, args.repeticiones),
+        }
+        print(f"\n{titulo} ({palabras} palabras clave)")
+        for nombre, ns in resultados.items():
+            print(f"  {nombre:<26} {ns:8.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+# Herramienta de mantenimiento de la tabla de conversaciones: exportar, importar, archivar
+# y reconstruir la actividad agregada por usuario.
+#
+#   python hakari_datos.py exportar conversaciones.jsonl.gz [--filas-por-archivo 100000]
+#   python hakari_datos.py importar conversaciones-*.jsonl.gz [--nuevos-ids]
+#   python hakari_datos.py archivar --dias 90 archivo.jsonl.gz
+#   python hakari_datos.py actividad
+#
+# Los archivos son JSON Lines comprimidos con gzip, una conversación por línea, con el
+# email y el nombre del usuario para poder importarlos en otra base de datos y el origen
+# (la identidad de la base de datos exportada). Al importar se conservan los ids salvo en
+# las filas de otro origen y en las que chocan con una conversación distinta con el mismo
+# id, que reciben uno nuevo (--nuevos-ids lo hace con todas). La lectura
+# avanza con fetchmany y la escritura con executemany, así que la memoria no depende del
+# tamaño de la tabla. Usa la misma base de datos que app.py (HAKARI_DB_RUTA) y puede
+# ejecutarse con la aplicación en marcha: las transacciones se trocean (--por-transaccion
+# al importar, --lote al borrar y agregar) y mientras duran la cola de escritura de app.py
+# espera y reintenta sus lotes (HAKARI_DB_REINTENTOS). La primera compactación es un VACUUM
+# completo que bloquea la base de datos mientras reescribe el archivo: en bases grandes,
+# mejor con la aplicación parada o con --sin-vacuum.
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from app import COLUMNAS_ANIMO, DB_RUTA, NOMBRES_ANIMO, DatabaseManager
+
+CAMPOS = ('id', 'email', 'nombre', 'mensaje_usuario', 'mensaje_hakari', 'estado_emocional', 'fecha')
+
+CONSULTA_EXPORTAR = '''
+    SELECT c.id, u.email, u.nombre, c.mensaje_usuario, c.mensaje_hakari, c.estado_emocional, c.fecha
+    FROM conversaciones c JOIN usuarios u ON u.id = c.usuario_id
+    WHERE c.fecha < ? AND c.id <= ?
+    ORDER BY c.id
+'''
+
+# Suma un tramo de conversaciones a las tablas de actividad. Los días activos y las rachas
+# no se pueden sumar por tramos: se recalculan después con recalcular_rachas
+SUMAS_ANIMO = ", ".join(f"SUM(estado_emocional IS '{nombre}')" for nombre in NOMBRES_ANIMO)
+ACTUALIZAR_ANIMOS = ", ".join(f"{columna} = {columna} + excluded.{columna}" for columna in COLUMNAS_ANIMO)
+
+AGREGAR_DIARIA = f'''
+    INSERT INTO actividad_diaria (usuario_id, dia, mensajes, {", ".join(COLUMNAS_ANIMO)})
+    SELECT usuario_id, date(COALESCE(fecha, 'now')), COUNT(*), {SUMAS_ANIMO}
+    FROM conversaciones WHERE id > ? AND id <= ?
+    GROUP BY 1, 2
+    ON CONFLICT (usuario_id, dia) DO UPDATE SET mensajes = mensajes + excluded.mensajes, {ACTUALIZAR_ANIMOS}
+'''
+
+AGREGAR_USUARIOS = f'''
+    INSERT INTO actividad_usuarios (usuario_id, mensajes, {", ".join(COLUMNAS_ANIMO)},
+                                    primer_dia, ultimo_dia, ultima_actividad)
+    SELECT usuario_id, COUNT(*), {SUMAS_ANIMO},
+           MIN(date(COALESCE(fecha, 'now'))), MAX(date(COALESCE(fecha, 'now'))), MAX(fecha)
+    FROM conversaciones WHERE id > ? AND id <= ?
+    GROUP BY usuario_id
+    ON CONFLICT (usuario_id) DO UPDATE SET
+        mensajes = mensajes + excluded.mensajes, {ACTUALIZAR_ANIMOS},
+        primer_dia = MIN(primer_dia, excluded.primer_dia),
+        ultimo_dia = MAX(ultimo_dia, excluded.ultimo_dia),
+        ultima_actividad = MAX(ultima_actividad, excluded.ultima_actividad)
+'''
+
+def informar(accion: str, filas: int, inicio: float):
+    segundos = max(time.perf_counter() - inicio, 1e-9)
+    print(f"{accion}: {filas} filas en {segundos:.2f}s ({filas / segundos:,.0f} filas/s)")
+
+def nombre_parte(salida: str, parte: int, troceado: bool) -> str:
+    # conversaciones.jsonl.gz -> conversaciones-00001.jsonl.gz
+    if not troceado:
+        return salida
+    base, extension = salida, ""
+    for sufijo in ('.jsonl.gz', '.gz'):
+        if salida.endswith(sufijo):
+            base, extension = salida[:-len(sufijo)], sufijo
+            break
+    return f"{base}-{parte:05d}{extension}"
+
+def cerrar_parte(archivo, ruta: str):
+    # Cada archivo debe estar en disco antes de que archivar borre nada
+    archivo.close()
+    with open(ruta, 'rb') as escrito:
+        os.fsync(escrito.fileno())
+
+def origen_local(conn) -> str:
+    return conn.execute('SELECT origen FROM identidad WHERE id = 1').fetchone()[0]
+
+def exportar(db: DatabaseManager, salida: str, lote: int, filas_por_archivo: int = 0,
+             antes_de: str = "9999-12-31", hasta_id: int = None) -> tuple:
+    # Vuelca las conversaciones con fecha < antes_de en orden de id. Devuelve
+    # (filas, último id exportado, archivos escritos)
+    conn = db.pool.lectura()
+    origen = origen_local(conn)
+    if hasta_id is None:
+        hasta_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM conversaciones').fetchone()[0]
+
+    filas, ultimo_id, archivos = 0, 0, []
+    archivo = None
+    conn.execute('BEGIN')  # Una sola instantánea para toda la exportación
+    try:
+        cursor = conn.execute(CONSULTA_EXPORTAR, (antes_de, hasta_id))
+        while True:
+            bloque = cursor.fetchmany(lote)
+            if not bloque:
+                break
+            for fila in bloque:
+                if archivo is None or (filas_por_archivo and filas % filas_por_archivo == 0 and filas):
+                    if archivo is not None:
+                        cerrar_parte(archivo, archivos[-1])
+                    archivos.append(nombre_parte(salida, len(archivos) + 1, filas_por_archivo > 0))
+                    archivo = gzip.open(archivos[-1], 'wt', encoding='utf-8', compresslevel=6)
+                archivo.write(json.dumps(dict(zip(CAMPOS, fila), origen=origen), ensure_ascii=False))
+                archivo.write('\n')
+                filas += 1
+            ultimo_id = bloque[-1][0]
+    finally:
+        conn.execute('COMMIT')
+        if archivo is not None:
+            cerrar_parte(archivo, archivos[-1])
+    return filas, ultimo_id, archivos
+
+def leer_lotes(rutas: list, lote: int):
+    for ruta in rutas:
+        with gzip.open(ruta, 'rt', encoding='utf-8') as archivo:
+            bloque = []
+            for linea in archivo:
+                if linea.strip():
+                    bloque.append(json.loads(linea))
+                if len(bloque) >= lote:
+                    yield bloque
+                    bloque = []
+            if bloque:
+                yield bloque
+
+def separar_ajenas(conn, bloque: list, origen: str, ids_usuarios: dict) -> tuple:
+    # Divide un bloque en (filas que conservan su id, filas de otra base de datos, filas cuyo
+    # id ya usa otra conversación de esta). Las filas que ya están no van en ninguna lista:
+    # las propias por su id y las de otra base de datos por usuario, fecha y mensajes. Los
+    # archivos sin origen (anteriores a la migración 11) se tratan como propios
+    def contenido(fila: dict) -> tuple:
+        return ids_usuarios[fila['email']], fila['mensaje_usuario'], fila['mensaje_hakari'], fila['fecha']
+
+    propias = [fila for fila in bloque if fila.get('origen', origen) == origen]
+    ajenas = [fila for fila in bloque if fila.get('origen', origen) != origen]
+    por_id = {fila[0]: fila[1:] for fila in conn.execute('''
+        SELECT id, usuario_id, mensaje_usuario, mensaje_hakari, fecha FROM conversaciones
+        WHERE id IN (SELECT value FROM json_each(?))
+    ''', (json.dumps([fila['id'] for fila in propias]),))}
+    conservar, chocan = [], []
+    for fila in propias:
+        existente = por_id.get(fila['id'])
+        if existente is None:
+            conservar.append(fila)
+        elif existente != contenido(fila):
+            chocan.append(fila)
+
+    if ajenas:
+        presentes = set(conn.execute('''
+            SELECT c.usuario_id, c.mensaje_usuario, c.mensaje_hakari, c.fecha
+            FROM json_each(?) j JOIN conversaciones c
+                ON c.usuario_id = json_extract(j.value, '$[0]') AND c.fecha = json_extract(j.value, '$[1]')
+        ''', (json.dumps([[ids_usuarios[fila['email']], fila['fecha']] for fila in ajenas]),)))
+        ajenas = [fila for fila in ajenas if contenido(fila) not in presentes]
+    return conservar, ajenas, chocan
+
+def importar(db: DatabaseManager, rutas: list, lote: int, por_transaccion: int, nuevos_ids: bool) -> tuple:
+    # Inserta por bloques con executemany, confirmando cada `por_transaccion` filas.
+    # Conservando los ids, reimportar un archivo no duplica filas ni vuelve a sumar a la
+    # actividad las conversaciones ya contadas antes de archivarlas. Las filas de otra base de
+    # datos que aún no están, o cuyo id ya está ocupado, se insertan con id nuevo. Devuelve
+    # (leídas, insertadas, ids de los usuarios importados, filas de otra base de datos
+    # insertadas, ids que chocaban)
+    ids_usuarios = {}
+    reasignados = []
+    insertadas = leidas = ajenas = sin_confirmar = 0
+    insertar_nuevas = '''
+        INSERT INTO conversaciones (usuario_id, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+    insertar_con_id = '''
+        INSERT OR IGNORE INTO conversaciones (id, usuario_id, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+
+    def valores(filas: list, con_id: bool) -> list:
+        return [((fila['id'],) if con_id else ()) + (ids_usuarios[fila['email']], fila['mensaje_usuario'],
+                fila['mensaje_hakari'], fila['estado_emocional'], fila['fecha']) for fila in filas]
+
+    with db.lock_escritura:
+        conn = db.pool.escritura()
+        origen = origen_local(conn)
+        try:
+            for bloque in leer_lotes(rutas, lote):
+                # Usuarios que aún no existen en esta base de datos
+                nuevos = {fila['email']: fila['nombre'] for fila in bloque if fila['email'] not in ids_usuarios}
+                if nuevos:
+                    conn.executemany('''
+                        INSERT OR IGNORE INTO usuarios (email, nombre, fecha_registro, ultima_visita)
+                        VALUES (?, ?, datetime('now'), datetime('now'))
+                    ''', nuevos.items())
+                    for email in nuevos:
+                        ids_usuarios[email] = conn.execute('SELECT id FROM usuarios WHERE email = ?', (email,)).fetchone()[0]
+
+                if nuevos_ids:
+                    conservar, sin_id = [], bloque
+                else:
+                    conservar, de_fuera, chocan = separar_ajenas(conn, bloque, origen, ids_usuarios)
+                    ajenas += len(de_fuera)
+                    reasignados.extend(fila['id'] for fila in chocan)
+                    sin_id = de_fuera + chocan
+                # rowcount cuenta solo las filas de esta sentencia, sin las que añaden los triggers
+                if conservar:
+                    insertadas += conn.executemany(insertar_con_id, valores(conservar, True)).rowcount
+                if sin_id:
+                    insertadas += conn.executemany(insertar_nuevas, valores(sin_id, False)).rowcount
+                leidas += len(bloque)
+                sin_confirmar += len(bloque)
+                if sin_confirmar >= por_transaccion:
+                    conn.commit()
+                    sin_confirmar = 0
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return leidas, insertadas, list(ids_usuarios.values()), ajenas, reasignados
+
+def borrar_archivadas(db: DatabaseManager, antes_de: str, hasta_id: int, lote: int) -> int:
+    # Borra por tramos de id para que cada transacción sea corta
+    borradas = 0
+    desde_id = 0
+    while desde_id <= hasta_id:
+        tramo = min(desde_id + lote, hasta_id + 1)
+        with db.lock_escritura:
+            conn = db.pool.escritura()
+            try:
+                cursor = conn.execute('DELETE FROM conversaciones WHERE id >= ? AND id < ? AND fecha < ?',
+                                      (desde_id, tramo, antes_de))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        borradas += cursor.rowcount
+        desde_id = tramo
+    return borradas
+
+def compactar(db: DatabaseManager, paginas: int = 0):
+    # Devuelve al sistema de archivos las páginas libres. La primera vez cambia la base de
+    # datos a auto_vacuum=INCREMENTAL, lo que exige un VACUUM completo
+    with db.lock_escritura:
+        conn = db.pool.escritura()
+        conn.commit()
+        tamano = os.path.getsize(db.pool.ruta)
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            print("Activando auto_vacuum=INCREMENTAL (VACUUM completo, solo esta vez)...")
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.isolation_level = None
+            try:
+                conn.execute('VACUUM')
+            finally:
+                conn.isolation_level = ""
+        else:
+            # Cada paso de la sentencia libera una página y execute() solo da el primero:
+            # executescript la ejecuta hasta el final
+            conn.executescript(f'PRAGMA incremental_vacuum({int(paginas)});' if paginas else 'PRAGMA incremental_vacuum;')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    print(f"Base de datos: {tamano / 1e6:.1f} MB -> {os.path.getsize(db.pool.ruta) / 1e6:.1f} MB")
+
+def agregar_actividad(db: DatabaseManager, lote: int) -> int:
+    # Recorre por tramos de id las conversaciones anteriores a los triggers de actividad.
+    # Cada tramo avanza la marca en la misma transacción, así que se puede interrumpir y
+    # reanudar sin contar nada dos veces; lo posterior ya lo cuentan los triggers
+    filas = 0
+    while True:
+        with db.lock_escritura:
+            conn = db.pool.escritura()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                hasta_id, procesado_id = conn.execute(
+                    'SELECT hasta_id, procesado_id FROM actividad_reconstruccion WHERE id = 1').fetchone()
+                if procesado_id >= hasta_id:
+                    conn.rollback()
+                    return filas
+                fin = min(procesado_id + lote, hasta_id)
+                filas += conn.execute('SELECT COUNT(*) FROM conversaciones WHERE id > ? AND id <= ?',
+                                      (procesado_id, fin)).fetchone()[0]
+                conn.execute(AGREGAR_DIARIA, (procesado_id, fin))
+                conn.execute(AGREGAR_USUARIOS, (procesado_id, fin))
+                conn.execute('UPDATE actividad_reconstruccion SET procesado_id = ? WHERE id = 1', (fin,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+def rachas(dias: list) -> tuple:
+    # (días activos, racha que termina en el último día, racha más larga) de días ISO ordenados
+    actual = maxima = 0
+    anterior = None
+    for dia in map(date.fromisoformat, dias):
+        actual = actual + 1 if anterior is not None and (dia - anterior).days == 1 else 1
+        maxima = max(maxima, actual)
+        anterior = dia
+    return len(dias), actual, maxima
+
+def recalcular_rachas(db: DatabaseManager, lote: int, usuarios: list = None) -> int:
+    # Días activos y rachas desde actividad_diaria, por tramos de usuarios: todos, o solo los
+    # de `usuarios`. Lectura y escritura en la misma transacción para no pisar un turno guardado entretanto
+    pendientes = sorted(usuarios) if usuarios is not None else None
+    recalculados = 0
+    desde_id = 0
+    while True:
+        with db.lock_escritura:
+            conn = db.pool.escritura()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                if pendientes is None:
+                    ids = [fila[0] for fila in conn.execute(
+                        'SELECT usuario_id FROM actividad_usuarios WHERE usuario_id > ? ORDER BY usuario_id LIMIT ?',
+                        (desde_id, lote))]
+                else:
+                    ids = pendientes[recalculados:recalculados + lote]
+                if not ids:
+                    conn.rollback()
+                    return recalculados
+                dias = {}
+                for usuario_id, dia in conn.execute(
+                        f'SELECT usuario_id, dia FROM actividad_diaria WHERE usuario_id IN ({", ".join("?" * len(ids))}) '
+                        'ORDER BY usuario_id, dia', ids):
+                    dias.setdefault(usuario_id, []).append(dia)
+                conn.executemany(
+                    'UPDATE actividad_usuarios SET dias_activos = ?, racha_actual = ?, racha_maxima = ? WHERE usuario_id = ?',
+                    [rachas(dias.get(usuario_id, [])) + (usuario_id,) for usuario_id in ids])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        recalculados += len(ids)
+        desde_id = ids[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description="Exportar, importar y archivar conversaciones de Hakari")
+    parser.add_argument("--db", default=DB_RUTA, help=f"ruta de la base de datos (por defecto {DB_RUTA})")
+    parser.add_argument("--lote", type=int, default=5000, help="filas por fetchmany/executemany")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_exportar = sub.add_parser("exportar", help="volcar todas las conversaciones a JSONL comprimido")
+    p_exportar.add_argument("salida")
+    p_exportar.add_argument("--filas-por-archivo", type=int, default=0,
+                            help="trocear en varios archivos de como mucho N filas")
+
+    p_importar = sub.add_parser("importar", help="cargar conversaciones desde archivos exportados")
+    p_importar.add_argument("archivos", nargs="+")
+    p_importar.add_argument("--por-transaccion", type=int, default=5000)
+    p_importar.add_argument("--nuevos-ids", action="store_true",
+                            help="dejar que la base de datos asigne ids (para fusionar con otra base)")
+    p_importar.add_argument("--usuarios-por-tramo", type=int, default=500)
+
+    p_archivar = sub.add_parser("archivar", help="exportar y borrar las conversaciones de más de N días")
+    p_archivar.add_argument("salida")
+    p_archivar.add_argument("--dias", type=int, required=True)
+    p_archivar.add_argument("--filas-por-archivo", type=int, default=0)
+    p_archivar.add_argument("--sin-vacuum", action="store_true", help="no compactar el archivo después")
+
+    p_actividad = sub.add_parser("actividad", help="agregar la actividad de las conversaciones anteriores "
+                                                   "y recalcular días activos y rachas")
+    p_actividad.add_argument("--usuarios-por-tramo", type=int, default=500)
+
+    args = parser.parse_args()
+    if args.comando == "importar":
+        # Comprobarlo antes de empezar, para no dejar una importación a medias
+        faltan = [ruta for ruta in args.archivos if not os.path.isfile(ruta)]
+        if faltan:
+            parser.error(f"no existen: {', '.join(faltan)}")
+    db = DatabaseManager(args.db)
+
+    inicio = time.perf_counter()
+    if args.comando == "exportar":
+        filas, _, archivos = exportar(db, args.salida, args.lote, args.filas_por_archivo)
+        informar(f"Exportadas a {', '.join(archivos) or '(nada)'}", filas, inicio)
+
+    elif args.comando == "importar":
+        leidas, insertadas, usuarios, ajenas, reasignados = importar(db, args.archivos, args.lote,
+                                                                      args.por_transaccion, args.nuevos_ids)
+        informar(f"Importadas ({insertadas} nuevas, {leidas - insertadas} ya estaban)", leidas, inicio)
+        if ajenas:
+            print(f"Aviso: {ajenas} filas venían de otra base de datos y se importaron con ids nuevos",
+                  file=sys.stderr)
+        if reasignados:
+            muestra = ", ".join(map(str, reasignados[:20])) + (", ..." if len(reasignados) > 20 else "")
+            print(f"Aviso: {len(reasignados)} filas chocaban con otra conversación con el mismo id y se "
+                  f"importaron con ids nuevos: {muestra}", file=sys.stderr)
+        if insertadas:
+            # Los triggers suponen turnos en orden cronológico y lo importado suele ser anterior
+            inicio = time.perf_counter()
+            informar("Rachas recalculadas", recalcular_rachas(db, args.usuarios_por_tramo, usuarios), inicio)
+
+    elif args.comando == "archivar":
+        # Mismo formato que datetime('now') de SQLite
+        antes_de = (datetime.utcnow() - timedelta(days=args.dias)).strftime('%Y-%m-%d %H:%M:%S')
+        filas, ultimo_id, archivos = exportar(db, args.salida, args.lote, args.filas_por_archivo, antes_de)
+        informar(f"Archivadas en {', '.join(archivos) or '(nada)'}", filas, inicio)
+        if not filas:
+            return
+
+        inicio = time.perf_counter()
+        # Solo se borra lo exportado: fecha anterior al corte e id no mayor que el último escrito
+        borradas = borrar_archivadas(db, antes_de, ultimo_id, args.lote)
+        informar("Borradas de la base de datos", borradas, inicio)
+        if borradas != filas:
+            print(f"Aviso: se exportaron {filas} filas pero se borraron {borradas}", file=sys.stderr)
+
+        if not args.sin_vacuum:
+            compactar(db)
+
+    elif args.comando == "actividad":
+        filas = agregar_actividad(db, args.lote)
+        informar("Conversaciones agregadas a la actividad", filas, inicio)
+        inicio = time.perf_counter()
+        usuarios = recalcular_rachas(db, args.usuarios_por_tramo)
+        informar("Rachas recalculadas", usuarios, inicio)
+
+if __name__ == "__main__":
+    main()
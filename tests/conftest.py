@@ -0,0 +1,32 @@
+# Las pruebas importan app.py y hakari_datos.py desde la raíz del repositorio y usan bases
+# de datos temporales: importar app no abre la base de datos por defecto
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import DatabaseManager  # noqa: E402
+
+@pytest.fixture
+def crear_db(tmp_path):
+    # crear_db("a.db", intervalo=...) -> DatabaseManager que se cierra al terminar la prueba
+    creadas = []
+    
+    def crear(nombre: str = "hakari.db", **opciones) -> DatabaseManager:
+        db = DatabaseManager(str(tmp_path / nombre), **opciones)
+        creadas.append(db)
+        return db
+    
+    yield crear
+    for db in creadas:
+        db.cerrar()
+
+def con_conversaciones(db: DatabaseManager, email: str, mensajes: list) -> int:
+    # Registra al usuario y guarda un turno por mensaje, ya confirmados en disco
+    usuario_id = db.registrar_usuario(email, email.split('@')[0])
+    for mensaje in mensajes:
+        db.guardar_conversacion(usuario_id, mensaje, f"respuesta a {mensaje}", "curiosa")
+    assert db.esperar_escrituras()
+    return usuario_id
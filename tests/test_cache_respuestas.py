@@ -0,0 +1,35 @@
+from app import Animo, CacheRespuestas, ContextoUsuario
+
+def test_solo_frases_hechas_y_compartidas_entre_usuarios():
+    cache = CacheRespuestas(activa=True, variantes=2)
+    assert cache.clave("¡¡Holaaa!!", Animo.TIMIDA) == cache.clave("hola", Animo.TIMIDA) == ("hola", int(Animo.TIMIDA))
+    assert cache.clave("hola, ¿me ayudas con mi tarea?", Animo.TIMIDA) is None
+    assert cache.clave("hola", Animo.CURIOSA) != cache.clave("hola", Animo.TIMIDA)
+
+    clave = cache.clave("Hola", Animo.TIMIDA)
+    assert cache.obtener(clave) is None
+    cache.guardar(clave, "hola...", 1.0)
+    assert cache.obtener(clave) is None  # aún con una sola variante
+    cache.guardar(clave, "eh, hola", 2.0)
+    assert cache.obtener(clave) in ("hola...", "eh, hola")
+
+    stats = cache.estadisticas()
+    assert (stats['mensajes'], stats['aciertos'], stats['fallos']) == (6, 1, 2)
+    assert stats['tasa_aciertos'] == round(1 / 3, 3)
+    assert stats['tasa_aciertos_mensajes'] == round(1 / 6, 3)
+    assert stats['latencia_ahorrada_s'] == 1.5
+
+def test_inactiva_no_cuenta_mensajes():
+    cache = CacheRespuestas(activa=False)
+    assert cache.clave("hola", Animo.TIMIDA) is None
+    assert cache.estadisticas()['mensajes'] == 0
+
+def test_respuesta_generica_sin_datos_del_usuario():
+    contexto = ContextoUsuario(1, resumen="Se llama Ana y le gusta el jazz")
+    contexto.agregar("me llamo Ana", "encantada, Ana")
+
+    contenidos = contexto.contenidos("hola", generico=True)
+    assert [c.parts[0].text for c in contenidos] == ["Responde breve y natural: hola"]
+    assert "Ana" not in contexto.configuracion(generico=True).system_instruction
+    assert len(contexto.contenidos("hola")) == 3
+    assert "Ana" in contexto.configuracion().system_instruction
@@ -0,0 +1,31 @@
+import unicodedata
+
+import pytest
+
+from app import REGLAS_ANIMO, Animo, ClasificadorAnimo, normalizar_texto
+
+clasificador = ClasificadorAnimo()
+
+@pytest.mark.parametrize("mensaje, animo", [
+    ("¿Por qué dices eso?", Animo.DEFENSIVA),
+    ("POR QUE", Animo.DEFENSIVA),
+    ("Explica tu RAZÓN", Animo.DEFENSIVA),
+    ("¿Recuerdas cuando hablábamos?", Animo.NOSTALGICA),
+    ("Cuéntame más, ¿sabes?", Animo.CURIOSA),
+    ("cuentame algo interesante", Animo.CURIOSA),
+    ("hola", None),
+])
+def test_clasificar(mensaje, animo):
+    assert clasificador.clasificar(mensaje) is animo
+
+def test_tildes_combinantes():
+    # "qué" escrito como "que" + U+0301
+    assert clasificador.clasificar(unicodedata.normalize('NFD', "¿Por qué?")) is Animo.DEFENSIVA
+
+@pytest.mark.parametrize("palabra", [p for _, palabras in REGLAS_ANIMO for p in palabras])
+def test_cada_palabra_con_y_sin_tildes(palabra):
+    # Una tilde en cualquier vocal de cada palabra de la frase clave sigue contando
+    for i, letra in enumerate(palabra):
+        if letra in "aeiou":
+            conjunto = palabra[:i] + unicodedata.normalize('NFC', letra + "\u0301") + palabra[i + 1:]
+            assert clasificador.clasificar(f"x {conjunto} x") is clasificador.clasificar(normalizar_texto(palabra))
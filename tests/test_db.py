@@ -0,0 +1,142 @@
+import sqlite3
+import threading
+
+import app
+from app import MIGRACIONES, IdTurno
+from hakari_datos import agregar_actividad, recalcular_rachas
+
+def filas_guardadas(db, usuario_id):
+    return [fila[0] for fila in db.pool.lectura().execute(
+        'SELECT mensaje_usuario FROM conversaciones WHERE usuario_id = ? ORDER BY id', (usuario_id,))]
+
+# ---------- Cola de escritura diferida ----------
+def test_cada_usuario_lee_sus_escrituras_en_cola(crear_db):
+    # Con intervalo largo nada se confirma hasta la barrera: lo leído viene de los pendientes
+    db = crear_db(intervalo=60, tamano_lote=1000)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    id_turno = IdTurno()
+    db.guardar_conversacion(ana, "hola", "hola...", "tímida", id_turno)
+    db.actualizar_estadisticas(ana)
+    db.guardar_estado_hakari(ana, int(app.Animo.CURIOSA))
+    db.registrar_logro(ana, 'primer_conversacion', 'Primer Contacto', '')
+
+    def leido():
+        turnos, ids, _, _ = db.obtener_pagina_conversaciones(ana)
+        return turnos, db.obtener_estado_hakari(ana), db.obtener_logros_usuario(ana)
+
+    assert filas_guardadas(db, ana) == [] and id_turno.en_cola
+    antes = leido()
+    assert antes == ([["hola", "hola..."]], (int(app.Animo.CURIOSA), 1), ['Primer Contacto'])
+
+    assert db.esperar_escrituras()
+    assert filas_guardadas(db, ana) == ["hola"]
+    assert id_turno.id is not None and not id_turno.en_cola
+    # Confirmado, se lee lo mismo: los pendientes se liberan en el mismo paso que el commit
+    assert leido() == antes
+    assert db.pendientes_conversaciones == {} and db.pendientes_stats == {} and db.pendientes_estado == {}
+
+def test_lecturas_monotonas_mientras_se_confirma(crear_db):
+    # Cada lectura ve la base de datos y los pendientes de una misma instantánea: ni cuenta
+    # dos veces lo que se confirma entretanto ni lo pierde
+    db = crear_db(intervalo=0.002, tamano_lote=7)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    total = 300
+    terminado = threading.Event()
+
+    def escribir():
+        for i in range(total):
+            db.actualizar_estadisticas(ana)
+            db.guardar_conversacion(ana, f"m{i}", "r", "curiosa")
+        terminado.set()
+
+    hilo = threading.Thread(target=escribir)
+    hilo.start()
+    interacciones, turnos = [], []
+    while not terminado.is_set() or db.pendientes_stats:
+        interacciones.append(db.obtener_estado_hakari(ana)[1])
+        turnos.append(len(db.obtener_pagina_conversaciones(ana, limite=total)[0]))
+    hilo.join()
+    assert db.esperar_escrituras()
+
+    assert interacciones == sorted(interacciones) and turnos == sorted(turnos)
+    assert db.obtener_estado_hakari(ana)[1] == total
+    assert len(filas_guardadas(db, ana)) == total
+
+def test_lote_bloqueado_se_reintenta(crear_db, monkeypatch):
+    db = crear_db(intervalo=0.01)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    db.pool.escritura().execute('PRAGMA busy_timeout=50')
+    monkeypatch.setattr(app, 'DB_ESPERA_BASE', 0.05)
+    intentos = []
+    escribir = db._escribir
+    monkeypatch.setattr(db, '_escribir', lambda operaciones: intentos.append(len(operaciones)) or escribir(operaciones))
+
+    # Otro proceso (hakari_datos.py) retiene el bloqueo de escritura medio segundo
+    otra = sqlite3.connect(db.pool.ruta, isolation_level=None, check_same_thread=False)
+    otra.execute('BEGIN IMMEDIATE')
+    for i in range(3):
+        db.guardar_conversacion(ana, f"m{i}", "r", "curiosa")
+    threading.Timer(0.5, lambda: otra.execute('COMMIT')).start()
+
+    assert db.esperar_escrituras(10)
+    otra.close()
+    assert len(intentos) > 1 and set(intentos) == {3}
+    assert filas_guardadas(db, ana) == ["m0", "m1", "m2"]
+    assert db.pendientes_conversaciones == {}
+
+def test_operacion_defectuosa_no_tira_el_lote(crear_db):
+    db = crear_db(intervalo=60, tamano_lote=1000)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    ids = [IdTurno() for _ in range(3)]
+    db.guardar_conversacion(ana, "m0", "r", "curiosa", ids[0])
+    db._encolar(('estado', ana, object()))  # no se puede enlazar como parámetro de SQLite
+    db.guardar_conversacion(ana, "m1", "r", "curiosa", ids[1])
+    db.guardar_conversacion(ana, "m2", "r", "curiosa", ids[2])
+
+    assert db.esperar_escrituras()
+    assert filas_guardadas(db, ana) == ["m0", "m1", "m2"]
+    assert all(id_turno.id is not None for id_turno in ids)
+    assert db.pendientes_conversaciones == {}
+
+# ---------- Migraciones ----------
+def test_actualizar_base_de_datos_original(crear_db, tmp_path):
+    # Base de datos de la primera versión (tablas por email, sin schema_version)
+    ruta = tmp_path / "original.db"
+    conn = sqlite3.connect(ruta)
+    for sentencia in MIGRACIONES[0][2]:
+        conn.execute(sentencia)
+    conn.executemany("INSERT INTO usuarios (email, nombre, fecha_registro) VALUES (?, ?, datetime('now'))",
+                     [("ana@x.com", "Ana"), ("bea@x.com", "Bea")])
+    conn.executemany('''
+        INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [("ana@x.com", "me gusta el jazz", "a mí también", "curiosa", "2024-01-01 10:00:00"),
+          ("nadie@x.com", "sin usuario", "...", "tímida", "2024-01-01 11:00:00"),
+          ("ana@x.com", "¿recuerdas el concierto?", "sí", "nostálgica", "2024-01-02 10:00:00"),
+          ("bea@x.com", "hola", "hola", "tímida", "2024-01-02 12:00:00")])
+    conn.executemany("INSERT INTO logros (usuario_email, logro_id, nombre) VALUES (?, ?, ?)",
+                     [("ana@x.com", "primer_conversacion", "Primer Contacto")] * 2)
+    conn.commit()
+    conn.close()
+
+    db = crear_db("original.db")
+    lectura = db.pool.lectura()
+    assert [fila[0] for fila in lectura.execute('SELECT version FROM schema_version ORDER BY version')] == \
+        [version for version, _, _ in MIGRACIONES]
+    ana = db.obtener_id_usuario("ana@x.com")
+    assert filas_guardadas(db, ana) == ["me gusta el jazz", "¿recuerdas el concierto?"]
+    assert lectura.execute('SELECT COUNT(*) FROM conversaciones').fetchone()[0] == 3  # sin la huérfana
+    assert db.obtener_logros_usuario(ana) == ["Primer Contacto"]
+    assert db.obtener_estado_hakari(ana) == (int(app.Animo.TIMIDA), 0)
+    assert [turno['mensaje_usuario'] for turno in db.buscar_conversaciones("ana@x.com", "concierto")] == \
+        ["¿recuerdas el concierto?"]
+    assert lectura.execute('SELECT origen FROM identidad').fetchone()[0]
+
+    # Las conversaciones anteriores a la actividad se agregan una vez; las nuevas, con los triggers
+    assert agregar_actividad(db, 2) == 3
+    assert agregar_actividad(db, 2) == 0
+    recalcular_rachas(db, 10)
+    db.guardar_conversacion(ana, "otra", "r", "curiosa")
+    assert db.esperar_escrituras()
+    actividad = db.obtener_actividad(ana, 0)
+    assert actividad['mensajes'] == 3 and actividad['animos']['curiosa'] == 2 and actividad['racha_maxima'] == 2
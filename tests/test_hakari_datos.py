@@ -0,0 +1,81 @@
+import gzip
+import json
+
+from conftest import con_conversaciones
+from hakari_datos import exportar, importar
+
+def filas(db, usuario_id):
+    return db.pool.lectura().execute(
+        'SELECT id, mensaje_usuario FROM conversaciones WHERE usuario_id = ? ORDER BY id', (usuario_id,)).fetchall()
+
+def mensajes_actividad(db, usuario_id):
+    return db.obtener_actividad(usuario_id, 0)['mensajes']
+
+def test_reimportar_el_mismo_archivo_no_duplica(crear_db, tmp_path):
+    db = crear_db()
+    ana = con_conversaciones(db, "ana@x.com", ["m1", "m2", "m3"])
+    filas_exportadas, _, archivos = exportar(db, str(tmp_path / "c.jsonl.gz"), 100)
+
+    assert filas_exportadas == 3
+    assert importar(db, archivos, 100, 1000, False) == (3, 0, [ana], 0, [])
+    assert len(filas(db, ana)) == 3
+    assert mensajes_actividad(db, ana) == 3
+
+def test_archivar_y_reimportar_conserva_ids_sin_recontar(crear_db, tmp_path):
+    db = crear_db()
+    ana = con_conversaciones(db, "ana@x.com", ["m1", "m2", "m3"])
+    antes = filas(db, ana)
+    _, _, archivos = exportar(db, str(tmp_path / "c.jsonl.gz"), 100)
+    db.ejecutar_escritura('DELETE FROM conversaciones')
+
+    assert importar(db, archivos, 100, 1000, False)[:2] == (3, 3)
+    assert filas(db, ana) == antes
+    assert mensajes_actividad(db, ana) == 3
+
+def test_importar_en_otra_base_con_datos(crear_db, tmp_path):
+    # Los ids del archivo (1..3) ya los usan las conversaciones de otra usuaria
+    origen, destino = crear_db("origen.db"), crear_db("destino.db")
+    con_conversaciones(origen, "ana@x.com", ["a1", "a2", "a3"])
+    bea = con_conversaciones(destino, "bea@x.com", ["b1", "b2", "b3"])
+    de_bea = filas(destino, bea)
+    _, _, archivos = exportar(origen, str(tmp_path / "c.jsonl.gz"), 100)
+
+    leidas, insertadas, (ana,), ajenas, reasignados = importar(destino, archivos, 2, 1000, False)
+
+    assert (leidas, insertadas, ajenas, reasignados) == (3, 3, 3, [])
+    assert filas(destino, bea) == de_bea
+    assert [mensaje for _, mensaje in filas(destino, ana)] == ["a1", "a2", "a3"]
+    assert min(id for id, _ in filas(destino, ana)) > max(id for id, _ in de_bea)
+    assert mensajes_actividad(destino, ana) == 3
+
+def test_archivo_sin_origen_con_ids_ocupados(crear_db, tmp_path):
+    # Archivos anteriores a la migración 11: solo el choque delata que son de otra base
+    origen, destino = crear_db("origen.db"), crear_db("destino.db")
+    con_conversaciones(origen, "ana@x.com", ["a1", "a2", "a3"])
+    bea = con_conversaciones(destino, "bea@x.com", ["b1"])
+    _, _, (archivo,) = exportar(origen, str(tmp_path / "c.jsonl.gz"), 100)
+    with gzip.open(archivo, 'rt', encoding='utf-8') as entrada:
+        lineas = [json.loads(linea) for linea in entrada]
+    with gzip.open(archivo, 'wt', encoding='utf-8') as salida:
+        for linea in lineas:
+            linea.pop('origen')
+            salida.write(json.dumps(linea) + '\n')
+
+    leidas, insertadas, (ana,), ajenas, reasignados = importar(destino, [archivo], 100, 1000, False)
+
+    assert (leidas, insertadas, ajenas, reasignados) == (3, 3, 0, [1])
+    assert [mensaje for _, mensaje in filas(destino, bea)] == ["b1"]
+    assert sorted(mensaje for _, mensaje in filas(destino, ana)) == ["a1", "a2", "a3"]
+
+def test_reimportar_archivo_de_otra_base_no_duplica(crear_db, tmp_path):
+    origen, destino = crear_db("origen.db"), crear_db("destino.db")
+    con_conversaciones(origen, "ana@x.com", ["a1", "a2"])
+    con_conversaciones(destino, "bea@x.com", ["b1"])
+    _, _, archivos = exportar(origen, str(tmp_path / "c.jsonl.gz"), 100)
+
+    leidas, insertadas, (ana,), ajenas, _ = importar(destino, archivos, 100, 1000, False)
+    assert (leidas, insertadas, ajenas) == (2, 2, 2)
+    leidas, insertadas, _, ajenas, _ = importar(destino, archivos, 100, 1000, False)
+    assert (leidas, insertadas, ajenas) == (2, 0, 0)
+    assert [mensaje for _, mensaje in filas(destino, ana)] == ["a1", "a2"]
+    assert mensajes_actividad(destino, ana) == 2
@@ -0,0 +1,59 @@
+from app import HistorialChat, IdTurno
+
+def chat_con_avisos(db, usuario_id):
+    # m1 y m3 son avisos (solo en pantalla, nunca se guardan); el resto, turnos guardados
+    historial = HistorialChat()
+    for i in range(6):
+        id_turno = IdTurno()
+        if i not in (1, 3):
+            db.guardar_conversacion(usuario_id, f"m{i}", "r", "curiosa", id_turno)
+        historial.turnos.append([f"m{i}", "r"])
+        historial.ids.append(id_turno)
+    return historial
+
+def id_guardado(db, usuario_id, mensaje):
+    return db.pool.lectura().execute(
+        'SELECT id FROM conversaciones WHERE usuario_id = ? AND mensaje_usuario = ?',
+        (usuario_id, mensaje)).fetchone()[0]
+
+def cargar_anteriores(db, usuario_id, historial):
+    return [turno[0] for turno in db.obtener_pagina_conversaciones(usuario_id, historial.cursor)[0]]
+
+def test_cursor_al_recortar_el_chat(crear_db):
+    db = crear_db(intervalo=60, tamano_lote=1000)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    historial = chat_con_avisos(db, ana)
+    # Mientras el lote no se confirma no hay id con el que mover el cursor
+    assert historial.en_cola(4)
+    assert db.esperar_escrituras()
+    assert not historial.en_cola(4)
+
+    historial.quitar_antiguos(2)
+    assert [turno[0] for turno in historial.turnos] == ["m2", "m3", "m4", "m5"]
+    assert historial.cursor == id_guardado(db, ana, "m0") + 1
+    assert cargar_anteriores(db, ana, historial) == ["m0"]
+
+def test_cursor_al_limpiar_el_chat(crear_db):
+    db = crear_db(intervalo=60, tamano_lote=1000)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    historial = chat_con_avisos(db, ana)
+    assert db.esperar_escrituras()
+
+    historial.quitar_antiguos(len(historial.turnos))
+    assert historial.turnos == [] and historial.ids == []
+    assert historial.cursor == id_guardado(db, ana, "m5") + 1
+    assert cargar_anteriores(db, ana, historial) == ["m0", "m2", "m4", "m5"]
+
+def test_cursor_de_pagina_solo_con_pendientes(crear_db):
+    db = crear_db(intervalo=60, tamano_lote=1000)
+    ana = db.registrar_usuario("ana@x.com", "Ana")
+    db.guardar_conversacion(ana, "viejo", "r", "curiosa")
+    assert db.esperar_escrituras()
+    db.guardar_conversacion(ana, "nuevo1", "r", "curiosa")
+    db.guardar_conversacion(ana, "nuevo2", "r", "curiosa")
+
+    turnos, ids, cursor, hay_mas = db.obtener_pagina_conversaciones(ana, limite=2)
+    assert [turno[0] for turno in turnos] == ["nuevo1", "nuevo2"] and all(i.en_cola for i in ids)
+    # Todo lo guardado es anterior a la página: el cursor queda detrás del último guardado
+    assert hay_mas and cursor == id_guardado(db, ana, "viejo") + 1
+    assert [turno[0] for turno in db.obtener_pagina_conversaciones(ana, cursor)[0]] == ["viejo"]
@@ -0,0 +1,34 @@
+import pytest
+
+from app import sistema_logros
+
+def logros_de(mensaje: str) -> set:
+    return {sistema_logros.grupos_palabras[coincidencia.lastgroup]
+            for coincidencia in sistema_logros.patron_palabras.finditer(mensaje)}
+
+@pytest.mark.parametrize("mensaje", [
+    "me encanta el anime",
+    "¿Has visto ESTE anime?",
+    "Fan de anime desde pequeña",
+    "leo manga cada noche",
+    "los mangas de Junji Ito",
+    "soy muy otaku",
+    "¿qué opinas de Evangelion?",
+    "el mejor shōnen",
+    "Death  Note me marcó",
+])
+def test_menciones_de_anime(mensaje):
+    assert logros_de(mensaje) == {'descubrir_anime'}
+
+@pytest.mark.parametrize("mensaje", [
+    "espero que te animes",
+    "animemos la fiesta",
+    "ojalá se anime a venir",
+    "una camiseta de manga corta",
+    "la manga de la camisa",
+    "voy a remangarme",
+    "otakuismo",
+    "shonenes",
+])
+def test_palabras_parecidas_no_cuentan(mensaje):
+    assert logros_de(mensaje) == set()